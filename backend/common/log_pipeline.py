@@ -0,0 +1,227 @@
+"""
+Non-blocking logging for the backend services.
+
+:func:`configure_logging` sends root logger records either straight to a
+stream (the default) or, with a *queue_size*, through a bounded queue that a
+background listener drains, so request threads never wait on log I/O.  When
+the queue is full, records are dropped and counted instead of blocking; the
+number dropped is logged as soon as the queue has room again.
+
+Under a gevent worker, threads are greenlets, so the listener instead runs
+on a real OS thread from gevent's threadpool and reads a native queue; a slow
+log sink then stalls only that thread, not the event loop.
+
+Records of *sampled_loggers* (high-volume access logs) are kept with
+probability *sample_rate*; their warnings and errors are always kept.
+
+Both services import it from backend/common/; their images are built from
+the backend/ directory so that each Dockerfile can copy it next to its app.
+"""
+
+from __future__ import annotations
+
+import atexit
+import copy
+import json
+import logging
+import queue
+import random
+import sys
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import IO, Callable, Iterable, Optional
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(message)s"
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+LOG_FORMATS = ("text", "json")
+
+# Attributes every LogRecord has; anything else was passed via ``extra=``.
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; ``extra={...}`` fields become top-level keys."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a *rate* fraction of the INFO/DEBUG records of *loggers*."""
+
+    def __init__(self, loggers: Iterable[str], rate: float, rng: Callable[[], float] = random.random):
+        super().__init__()
+        self._loggers = frozenset(loggers)
+        self._rate = rate
+        self._rng = rng
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or record.name not in self._loggers:
+            return True
+        return self._rng() < self._rate
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that drops (and counts) records instead of blocking on a full queue.
+
+    *maxsize* bounds queues that have no bound of their own (``SimpleQueue``).
+    """
+
+    def __init__(self, log_queue: queue.Queue | queue.SimpleQueue, maxsize: int = 0):
+        super().__init__(log_queue)
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._reported = 0
+        self._lock = threading.Lock()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Like QueueHandler.prepare, but keeps the traceback out of the message
+        # so the listener's formatter can place it (e.g. a separate JSON key).
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        with self._lock:
+            try:
+                if self.dropped > self._reported:
+                    self._put(self._drop_notice(self.dropped - self._reported))
+                    self._reported = self.dropped
+                self._put(record)
+            except queue.Full:
+                self.dropped += 1
+
+    def _put(self, record: logging.LogRecord) -> None:
+        if self.maxsize and self.queue.qsize() >= self.maxsize:
+            raise queue.Full
+        self.queue.put_nowait(record)
+
+    @staticmethod
+    def _drop_notice(count: int) -> logging.LogRecord:
+        return logging.LogRecord(
+            __name__, logging.WARNING, __file__, 0, f"log queue full, dropped {count} records", None, None
+        )
+
+
+class ThreadpoolQueueListener(QueueListener):
+    """QueueListener that drains its queue on a thread of gevent's native threadpool.
+
+    The queue must be a native one (the unpatched ``SimpleQueue``): the
+    listener blocks on it from an OS thread, outside the gevent event loop.
+    """
+
+    def __init__(self, log_queue: queue.SimpleQueue, *handlers: logging.Handler, hub):
+        super().__init__(log_queue, *handlers)
+        self._hub = hub
+        self._result = None
+
+    def start(self) -> None:
+        self._result = self._hub.threadpool.spawn(self._monitor)
+
+    def stop(self) -> None:
+        if self._result is not None:
+            self.enqueue_sentinel()
+            self._result.get()  # waits cooperatively while the backlog is written
+            self._result = None
+
+
+def _gevent_hub():
+    """The gevent hub if this process is monkey-patched by gevent (a gevent worker), else None."""
+    monkey = sys.modules.get("gevent.monkey")
+    if monkey is None or not monkey.is_module_patched("threading"):
+        return None
+    import gevent
+
+    return gevent.get_hub()
+
+
+class LogPipeline:
+    """The handler installed by :func:`configure_logging`, plus its listener if queued."""
+
+    def __init__(self, handler: logging.Handler, listener: Optional[QueueListener]):
+        self.handler = handler
+        self.listener = listener
+
+    @property
+    def dropped(self) -> int:
+        return getattr(self.handler, "dropped", 0)
+
+    def stop(self) -> None:
+        """Detach from the root logger and write out everything still queued."""
+        logging.getLogger().removeHandler(self.handler)
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+
+_active: Optional[LogPipeline] = None
+
+
+def configure_logging(
+    level: str = "INFO",
+    *,
+    fmt: str = "text",
+    queue_size: int = 0,
+    sample_rate: float = 1.0,
+    sampled_loggers: Iterable[str] = (),
+    stream: Optional[IO[str]] = None,
+) -> LogPipeline:
+    """Install the service's log handler on the root logger.
+
+    Calling it again replaces the pipeline installed before; other handlers
+    on the root logger are left alone.
+    """
+    global _active
+    if _active is not None:
+        _active.stop()
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT, DATE_FORMAT))
+    handler: logging.Handler = output
+    listener = None
+    if queue_size > 0:
+        hub = _gevent_hub()
+        if hub is None:
+            handler = DroppingQueueHandler(queue.Queue(queue_size))
+            listener = QueueListener(handler.queue, output)
+        else:
+            monkey = sys.modules["gevent.monkey"]
+            native_queue = monkey.get_original("queue", "SimpleQueue")()
+            output.lock = monkey.get_original("_thread", "RLock")()  # only the listener thread writes
+            handler = DroppingQueueHandler(native_queue, maxsize=queue_size)
+            listener = ThreadpoolQueueListener(native_queue, output, hub=hub)
+        listener.start()
+    if sample_rate < 1:
+        handler.addFilter(SamplingFilter(sampled_loggers, sample_rate))
+
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(getattr(logging, level.upper(), logging.INFO))
+    _active = LogPipeline(handler, listener)
+    return _active
+
+
+@atexit.register
+def _flush_at_exit() -> None:
+    if _active is not None:
+        _active.stop()
@@ -10,20 +10,51 @@ Configuration is loaded from a YAML file (default: config.yaml).
 
 from __future__ import annotations
 
+import atexit
+import gzip
+import hashlib
+import hmac
+import http.cookiejar
 import json
 import logging
 import os
+import queue
+import random
+import re
+import signal
+import sqlite3
 import sys
+import threading
 import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-from typing import Callable, Optional
+from typing import Callable, Iterable, Iterator, Optional
+from urllib.parse import urlsplit
 
 import requests
+import urllib3
 import yaml
-from flask import Flask, Response, jsonify, request
+from flask import Flask, Response, g, jsonify, request, stream_with_context
+from requests.adapters import HTTPAdapter
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
 from flask_cors import CORS
 from flask_limiter import Limiter
 
+# log_pipeline.py lives in backend/common/ in a source checkout; the image copies it next to this file.
+_COMMON_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common")
+if os.path.isdir(_COMMON_DIR) and _COMMON_DIR not in sys.path:
+    sys.path.append(_COMMON_DIR)
+
+from log_pipeline import LOG_FORMATS, configure_logging  # noqa: E402
+
+try:  # optional: br response compression
+    import brotli
+except ImportError:
+    brotli = None
+
+
 # ---------------------------------------------------------------------------
 # Config dataclasses
 # ---------------------------------------------------------------------------
@@ -37,6 +68,10 @@ class EndpointConfig:
     auth_header: str = "Authorization"
     auth_prefix: str = "Bearer"
     extra_headers: dict[str, str] = field(default_factory=dict)
+    weight: int = 1
+    max_in_flight: int = 0  # 0 = unlimited
+    compress_requests: bool = False  # gzip request bodies; only if the provider accepts it
+    group: str = ""  # endpoints with the same group share load and fail over; "" = group by url
 
 
 @dataclass
@@ -47,6 +82,14 @@ class RateLimitConfig:
     requests_per_day: int
 
 
+@dataclass
+class ClientConfig:
+    name: str
+    key_sha256: str  # hex SHA-256 digest of the client's API key
+    rate_limits: Optional[RateLimitConfig] = None  # None = the global rate_limits
+    max_daily_tokens: Optional[int] = None  # None = limits.max_daily_tokens_per_ip; 0 = unlimited
+
+
 @dataclass
 class LimitsConfig:
     max_request_tokens: int
@@ -54,17 +97,126 @@ class LimitsConfig:
     max_request_bytes: int
 
 
+@dataclass
+class LoadBalancingConfig:
+    strategy: str = "round_robin"  # or "least_outstanding"
+    max_attempts: int = 2
+    failure_threshold: int = 3
+    cooldown_seconds: int = 30
+
+
+@dataclass
+class RetryConfig:
+    max_retries: int = 0
+    backoff_base_seconds: float = 0.25
+    backoff_max_seconds: float = 4.0
+    retry_on_status: list[int] = field(default_factory=lambda: [429, 502, 503, 504])
+    hedge: bool = False
+    hedge_quantile: float = 0.95
+    hedge_min_samples: int = 20
+
+
+@dataclass
+class QueueConfig:
+    max_queue: int = 100
+    timeout_seconds: float = 30
+
+
+@dataclass
+class StreamingConfig:
+    flush_interval_ms: int = 0  # 0 = forward every upstream chunk as it arrives
+    flush_bytes: int = 16384
+
+
+@dataclass
+class CompressionConfig:
+    enabled: bool = True  # compress non-streaming responses for clients that accept it
+    min_bytes: int = 1024
+    level: int = 6
+
+
+@dataclass
+class CacheConfig:
+    enabled: bool = False
+    ttl_seconds: int = 300
+    max_entries: int = 1024
+    max_bytes: int = 64 * 1024 * 1024
+    max_entry_bytes: int = 1024 * 1024
+    redis_url: str = ""
+
+
+@dataclass
+class CoalescingConfig:
+    enabled: bool = False
+    max_stream_buffer_bytes: int = 4 * 1024 * 1024
+
+
+@dataclass
+class BatchingConfig:
+    enabled: bool = False
+    window_ms: int = 5
+    max_batch_size: int = 64
+
+
+@dataclass
+class ModelsConfig:
+    ttl_seconds: int = 300
+    stale_seconds: int = 3600  # extra time a stale list is served while it refreshes
+    timeout_seconds: float = 10
+
+
+@dataclass
+class LedgerConfig:
+    path: str = ""  # SQLite file; empty disables the ledger
+    flush_interval_seconds: float = 1.0
+    batch_size: int = 500
+    retention_days: int = 90  # 0 keeps rows forever
+    admin_key_sha256: str = ""  # hex SHA-256 of the key that sees every client's usage on /usage
+
+
+@dataclass
+class LoggingConfig:
+    format: str = "text"  # or "json": one object per line, access log fields as keys
+    queue_size: int = 0  # > 0 writes logs from a background thread via a bounded queue
+    access_sample_rate: float = 1.0  # fraction of successful access log lines kept
+
+
+@dataclass
+class MetricsConfig:
+    enabled: bool = True
+    otlp_endpoint: str = ""
+    service_name: str = "mc-relay"
+
+
 @dataclass
 class RelayConfig:
     endpoints: list[EndpointConfig]
     rate_limits: RateLimitConfig
     limits: LimitsConfig
     relay_password: str = ""
+    clients: list[ClientConfig] = field(default_factory=list)
     allowed_origins: list[str] = field(default_factory=list)
     request_timeout: int = 180
     enable_streaming: bool = True
     enable_models_proxy: bool = True
     log_level: str = "INFO"
+    logging: LoggingConfig = field(default_factory=LoggingConfig)
+    load_balancing: LoadBalancingConfig = field(default_factory=LoadBalancingConfig)
+    queue: QueueConfig = field(default_factory=QueueConfig)
+    retry: RetryConfig = field(default_factory=RetryConfig)
+    streaming: StreamingConfig = field(default_factory=StreamingConfig)
+    compression: CompressionConfig = field(default_factory=CompressionConfig)
+    cache: CacheConfig = field(default_factory=CacheConfig)
+    batching: BatchingConfig = field(default_factory=BatchingConfig)
+    coalescing: CoalescingConfig = field(default_factory=CoalescingConfig)
+    models: ModelsConfig = field(default_factory=ModelsConfig)
+    ledger: LedgerConfig = field(default_factory=LedgerConfig)
+    metrics: MetricsConfig = field(default_factory=MetricsConfig)
+    routing: RoutingTable = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        # Compiled once per config so per-request routing is a trie walk.
+        self.routing = RoutingTable(self.endpoints)
 
 
 # ---------------------------------------------------------------------------
@@ -72,27 +224,41 @@ class RelayConfig:
 # ---------------------------------------------------------------------------
 
 
+class ConfigError(Exception):
+    """Raised by :func:`parse_config` for a missing or invalid config file."""
+
+
 def load_config(path: str) -> RelayConfig:
-    if not os.path.exists(path):
-        print(f"ERROR: Config file not found: {path}", file=sys.stderr)
-        print(
-            "Copy config.example.yaml to config.yaml and fill in your values.",
-            file=sys.stderr,
-        )
+    """Parse the config at startup, exiting with a message if it is invalid."""
+    try:
+        return parse_config(path)
+    except ConfigError as exc:
+        print(f"ERROR: {exc}", file=sys.stderr)
+        if not os.path.exists(path):
+            print(
+                "Copy config.example.yaml to config.yaml and fill in your values.",
+                file=sys.stderr,
+            )
         sys.exit(1)
 
-    with open(path, "r") as fh:
-        raw = yaml.safe_load(fh) or {}
 
-    if "endpoints" not in raw or not raw["endpoints"]:
-        print("ERROR: config.yaml must contain at least one endpoint under 'endpoints:'", file=sys.stderr)
-        sys.exit(1)
+def parse_config(path: str) -> RelayConfig:
+    if not os.path.exists(path):
+        raise ConfigError(f"Config file not found: {path}")
+
+    try:
+        with open(path, "r") as fh:
+            raw = yaml.safe_load(fh) or {}
+    except (OSError, yaml.YAMLError) as exc:
+        raise ConfigError(f"Cannot read {path}: {exc}") from exc
+
+    if not isinstance(raw, dict) or "endpoints" not in raw or not raw["endpoints"]:
+        raise ConfigError("config.yaml must contain at least one endpoint under 'endpoints:'")
 
     endpoints: list[EndpointConfig] = []
     for ep in raw["endpoints"]:
         if "name" not in ep or "url" not in ep:
-            print("ERROR: Each endpoint must have 'name' and 'url' fields.", file=sys.stderr)
-            sys.exit(1)
+            raise ConfigError("Each endpoint must have 'name' and 'url' fields.")
         endpoints.append(
             EndpointConfig(
                 name=ep["name"],
@@ -101,6 +267,10 @@ def load_config(path: str) -> RelayConfig:
                 auth_header=ep.get("auth_header", "Authorization"),
                 auth_prefix=ep.get("auth_prefix", "Bearer"),
                 extra_headers=ep.get("extra_headers") or {},
+                weight=max(1, int(ep.get("weight", 1))),
+                max_in_flight=ep.get("max_in_flight", 0),
+                compress_requests=ep.get("compress_requests", False),
+                group=str(ep.get("group") or ""),
             )
         )
 
@@ -112,6 +282,32 @@ def load_config(path: str) -> RelayConfig:
         requests_per_day=rl_raw.get("requests_per_day", 1000),
     )
 
+    clients: list[ClientConfig] = []
+    for entry in raw.get("clients") or []:
+        if "name" not in entry or "key_sha256" not in entry:
+            raise ConfigError("Each client must have 'name' and 'key_sha256' fields.")
+        digest = str(entry["key_sha256"]).strip().lower()
+        if not re.fullmatch(r"[0-9a-f]{64}", digest):
+            raise ConfigError(f"Client '{entry['name']}': key_sha256 must be a hex SHA-256 digest.")
+        if any(c.name == entry["name"] for c in clients):
+            raise ConfigError(f"Duplicate client name '{entry['name']}'.")
+        crl_raw = entry.get("rate_limits")
+        clients.append(
+            ClientConfig(
+                name=entry["name"],
+                key_sha256=digest,
+                rate_limits=None
+                if crl_raw is None
+                else RateLimitConfig(
+                    enabled=crl_raw.get("enabled", rate_limits.enabled),
+                    requests_per_minute=crl_raw.get("requests_per_minute", rate_limits.requests_per_minute),
+                    requests_per_hour=crl_raw.get("requests_per_hour", rate_limits.requests_per_hour),
+                    requests_per_day=crl_raw.get("requests_per_day", rate_limits.requests_per_day),
+                ),
+                max_daily_tokens=entry.get("max_daily_tokens"),
+            )
+        )
+
     lim_raw = raw.get("limits", {})
     limits = LimitsConfig(
         max_request_tokens=lim_raw.get("max_request_tokens", 10000),
@@ -119,6 +315,104 @@ def load_config(path: str) -> RelayConfig:
         max_request_bytes=lim_raw.get("max_request_bytes", 2 * 1024 * 1024),
     )
 
+    lb_raw = raw.get("load_balancing", {})
+    strategy = lb_raw.get("strategy", "round_robin")
+    if strategy not in ("round_robin", "least_outstanding"):
+        raise ConfigError("load_balancing.strategy must be 'round_robin' or 'least_outstanding'.")
+    load_balancing = LoadBalancingConfig(
+        strategy=strategy,
+        max_attempts=lb_raw.get("max_attempts", 2),
+        failure_threshold=lb_raw.get("failure_threshold", 3),
+        cooldown_seconds=lb_raw.get("cooldown_seconds", 30),
+    )
+
+    queue_raw = raw.get("queue", {})
+    queue = QueueConfig(
+        max_queue=queue_raw.get("max_queue", 100),
+        timeout_seconds=queue_raw.get("timeout_seconds", 30),
+    )
+
+    retry_raw = raw.get("retry", {})
+    retry = RetryConfig(
+        max_retries=retry_raw.get("max_retries", 0),
+        backoff_base_seconds=retry_raw.get("backoff_base_seconds", 0.25),
+        backoff_max_seconds=retry_raw.get("backoff_max_seconds", 4.0),
+        retry_on_status=retry_raw.get("retry_on_status", [429, 502, 503, 504]),
+        hedge=retry_raw.get("hedge", False),
+        hedge_quantile=retry_raw.get("hedge_quantile", 0.95),
+        hedge_min_samples=retry_raw.get("hedge_min_samples", 20),
+    )
+
+    streaming_raw = raw.get("streaming", {})
+    streaming = StreamingConfig(
+        flush_interval_ms=streaming_raw.get("flush_interval_ms", 0),
+        flush_bytes=streaming_raw.get("flush_bytes", 16384),
+    )
+
+    compression_raw = raw.get("compression", {})
+    compression = CompressionConfig(
+        enabled=compression_raw.get("enabled", True),
+        min_bytes=compression_raw.get("min_bytes", 1024),
+        level=compression_raw.get("level", 6),
+    )
+
+    cache_raw = raw.get("cache", {})
+    cache = CacheConfig(
+        enabled=cache_raw.get("enabled", False),
+        ttl_seconds=cache_raw.get("ttl_seconds", 300),
+        max_entries=cache_raw.get("max_entries", 1024),
+        max_bytes=cache_raw.get("max_bytes", 64 * 1024 * 1024),
+        max_entry_bytes=cache_raw.get("max_entry_bytes", 1024 * 1024),
+        redis_url=cache_raw.get("redis_url", ""),
+    )
+
+    batch_raw = raw.get("batching", {})
+    batching = BatchingConfig(
+        enabled=batch_raw.get("enabled", False),
+        window_ms=batch_raw.get("window_ms", 5),
+        max_batch_size=batch_raw.get("max_batch_size", 64),
+    )
+
+    coalescing_raw = raw.get("coalescing", {})
+    coalescing = CoalescingConfig(
+        enabled=coalescing_raw.get("enabled", False),
+        max_stream_buffer_bytes=coalescing_raw.get("max_stream_buffer_bytes", 4 * 1024 * 1024),
+    )
+
+    models_raw = raw.get("models", {})
+    models = ModelsConfig(
+        ttl_seconds=models_raw.get("ttl_seconds", 300),
+        stale_seconds=models_raw.get("stale_seconds", 3600),
+        timeout_seconds=models_raw.get("timeout_seconds", 10),
+    )
+
+    ledger_raw = raw.get("ledger", {})
+    ledger = LedgerConfig(
+        path=ledger_raw.get("path", ""),
+        flush_interval_seconds=ledger_raw.get("flush_interval_seconds", 1.0),
+        batch_size=ledger_raw.get("batch_size", 500),
+        retention_days=ledger_raw.get("retention_days", 90),
+        admin_key_sha256=str(ledger_raw.get("admin_key_sha256") or "").strip().lower(),
+    )
+    if ledger.admin_key_sha256 and not re.fullmatch(r"[0-9a-f]{64}", ledger.admin_key_sha256):
+        raise ConfigError("ledger.admin_key_sha256 must be a hex SHA-256 digest.")
+
+    logging_raw = raw.get("logging", {})
+    logging_cfg = LoggingConfig(
+        format=logging_raw.get("format", "text"),
+        queue_size=logging_raw.get("queue_size", 0),
+        access_sample_rate=logging_raw.get("access_sample_rate", 1.0),
+    )
+    if logging_cfg.format not in LOG_FORMATS:
+        raise ConfigError("logging.format must be 'text' or 'json'.")
+
+    metrics_raw = raw.get("metrics", {})
+    metrics = MetricsConfig(
+        enabled=metrics_raw.get("enabled", True),
+        otlp_endpoint=metrics_raw.get("otlp_endpoint", ""),
+        service_name=metrics_raw.get("service_name", "mc-relay"),
+    )
+
     # Support allowed_origins (list) and allowed_origin (singular string, backward compat)
     ao_raw = raw.get("allowed_origins") or raw.get("allowed_origin", "")
     if isinstance(ao_raw, str):
@@ -133,11 +427,24 @@ def load_config(path: str) -> RelayConfig:
         rate_limits=rate_limits,
         limits=limits,
         relay_password=raw.get("relay_password", ""),
+        clients=clients,
         allowed_origins=allowed_origins,
         request_timeout=raw.get("request_timeout", 180),
         enable_streaming=raw.get("enable_streaming", True),
         enable_models_proxy=raw.get("enable_models_proxy", True),
         log_level=raw.get("log_level", "INFO").upper(),
+        logging=logging_cfg,
+        load_balancing=load_balancing,
+        queue=queue,
+        retry=retry,
+        streaming=streaming,
+        compression=compression,
+        cache=cache,
+        batching=batching,
+        coalescing=coalescing,
+        models=models,
+        ledger=ledger,
+        metrics=metrics,
     )
 
 
@@ -146,25 +453,553 @@ def load_config(path: str) -> RelayConfig:
 # ---------------------------------------------------------------------------
 
 
+def _url_segments(url: str) -> list[str]:
+    """Split a URL into trie segments: lowercased origin, then path parts."""
+    parts = urlsplit(url.strip())
+    origin = f"{parts.scheme.lower()}://{parts.netloc.lower()}"
+    return [origin] + [seg for seg in parts.path.split("/") if seg]
+
+
+class RoutingTable:
+    """Longest-prefix-match index from upstream URL to endpoint.
+
+    Built from the endpoint list once; :meth:`match` walks one trie node per
+    URL segment, so its cost does not grow with the number of endpoints.
+    When several endpoints share a URL the first one configured is returned.
+    """
+
+    _ENDPOINT = ""  # trie node key holding the endpoint (never a real segment)
+
+    def __init__(self, endpoints: list[EndpointConfig]):
+        self._default = endpoints[0] if endpoints else None
+        self._root: dict = {}
+        for ep in endpoints:
+            node = self._root
+            for segment in _url_segments(ep.url):
+                node = node.setdefault(segment, {})
+            node.setdefault(self._ENDPOINT, ep)
+
+    def match(self, target_url: Optional[str] = None) -> Optional[EndpointConfig]:
+        if not target_url:
+            return self._default
+        best: Optional[EndpointConfig] = None
+        node = self._root
+        for segment in _url_segments(target_url):
+            node = node.get(segment)
+            if node is None:
+                break
+            best = node.get(self._ENDPOINT, best)
+        return best
+
+
 def find_endpoint(
     endpoints: list[EndpointConfig],
     target_url: Optional[str] = None,
 ) -> Optional[EndpointConfig]:
     """Resolve which configured endpoint to use for a request.
 
-    If *target_url* is provided (from the X-Relay-Endpoint header), the first
-    endpoint whose URL is a prefix match wins.  Returns None if a URL was
-    given but no endpoint matches (prevents silent misrouting).
+    If *target_url* is provided (from the X-Relay-Endpoint header), the
+    endpoint with the longest URL prefix match wins.  Returns None if a URL
+    was given but no endpoint matches (prevents silent misrouting).
 
     If no URL is provided, falls back to the first configured endpoint.
+
+    Builds a throwaway :class:`RoutingTable`; the app itself uses the one
+    precompiled on ``RelayConfig.routing``.
     """
-    if target_url:
-        normalized = target_url.rstrip("/")
-        for ep in endpoints:
-            if normalized == ep.url or normalized.startswith(ep.url + "/"):
-                return ep
-        return None  # URL given but no match — refuse rather than misroute
-    return endpoints[0] if endpoints else None
+    return RoutingTable(endpoints).match(target_url)
+
+
+# ---------------------------------------------------------------------------
+# Endpoint groups (load balancing + failover)
+# Endpoints with the same `group` — e.g. mirrors of one model at different
+# providers — form a group; without one, endpoints sharing the same URL
+# (several API keys for one provider) do.  Each member has a circuit breaker: after `failure_threshold`
+# consecutive 5xx/connection failures it is ejected for `cooldown_seconds`,
+# then a single trial request decides whether it rejoins.
+# ---------------------------------------------------------------------------
+
+
+class _MemberState:
+    def __init__(self, ep: EndpointConfig) -> None:
+        self.ep = ep
+        self.current_weight = 0
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.trial_in_flight = False
+
+
+class EndpointGroup:
+    def __init__(
+        self,
+        members: list[EndpointConfig],
+        cfg: LoadBalancingConfig,
+        now_fn: Callable[[], float] = time.monotonic,
+    ):
+        self._cfg = cfg
+        self._now = now_fn
+        self._lock = threading.Lock()
+        self._members = [_MemberState(ep) for ep in members]
+
+    @property
+    def size(self) -> int:
+        return len(self._members)
+
+    def acquire(
+        self,
+        exclude: Optional[set[str]] = None,
+        has_slot: Optional[Callable[[EndpointConfig], bool]] = None,
+    ) -> Optional[EndpointConfig]:
+        """Pick the next member, skipping names in *exclude*.
+
+        Ejected members are skipped while any healthy member remains; if all
+        are ejected, the one whose cooldown ends first is used rather than
+        failing outright.  Among healthy members, those for which *has_slot*
+        is true (no queueing needed) are preferred.  The caller must pass the
+        result to :meth:`release`.
+        """
+        exclude = exclude or set()
+        with self._lock:
+            now = self._now()
+            candidates = [m for m in self._members if m.ep.name not in exclude]
+            if not candidates:
+                return None
+            healthy = [m for m in candidates if self._available(m, now)]
+            if healthy and has_slot is not None:
+                healthy = [m for m in healthy if has_slot(m.ep)] or healthy
+            if healthy:
+                chosen = self._pick(healthy)
+            else:
+                chosen = min(candidates, key=lambda m: m.ejected_until)
+            if chosen.ejected_until and chosen.ejected_until <= now:
+                chosen.trial_in_flight = True  # half-open: this request decides
+            chosen.outstanding += 1
+            return chosen.ep
+
+    def release(self, ep: EndpointConfig, ok: Optional[bool]) -> None:
+        """Return a member acquired with :meth:`acquire` and record the outcome.
+
+        Pass ``ok=None`` if the member was never contacted.
+        """
+        with self._lock:
+            member = next((m for m in self._members if m.ep is ep), None)
+            if member is None:
+                return
+            member.outstanding = max(0, member.outstanding - 1)
+            member.trial_in_flight = False
+            if ok is None:
+                return
+            if ok:
+                member.failures = 0
+                member.ejected_until = 0.0
+                return
+            member.failures += 1
+            if member.failures >= self._cfg.failure_threshold:
+                member.ejected_until = self._now() + self._cfg.cooldown_seconds
+
+    def ejected(self) -> list[str]:
+        with self._lock:
+            now = self._now()
+            return [m.ep.name for m in self._members if m.ejected_until > now]
+
+    def _available(self, member: _MemberState, now: float) -> bool:
+        if not member.ejected_until:
+            return True
+        return member.ejected_until <= now and not member.trial_in_flight
+
+    def _pick(self, members: list[_MemberState]) -> _MemberState:
+        if self._cfg.strategy == "least_outstanding":
+            return min(members, key=lambda m: m.outstanding / m.ep.weight)
+        # Smooth weighted round-robin (as used by nginx)
+        total = sum(m.ep.weight for m in members)
+        for m in members:
+            m.current_weight += m.ep.weight
+        chosen = max(members, key=lambda m: m.current_weight)
+        chosen.current_weight -= total
+        return chosen
+
+
+def group_name(ep: EndpointConfig) -> str:
+    """Name of the endpoint group *ep* belongs to: its ``group``, else its URL."""
+    return ep.group or ep.url
+
+
+def build_endpoint_groups(
+    endpoints: list[EndpointConfig],
+    cfg: LoadBalancingConfig,
+) -> dict[str, EndpointGroup]:
+    """Group endpoints by :func:`group_name`, keeping configuration order within a group."""
+    by_group: dict[str, list[EndpointConfig]] = {}
+    for ep in endpoints:
+        by_group.setdefault(group_name(ep), []).append(ep)
+    return {name: EndpointGroup(members, cfg) for name, members in by_group.items()}
+
+
+# ---------------------------------------------------------------------------
+# Retries and hedging
+# ---------------------------------------------------------------------------
+
+
+# Statuses with which a provider turns a request away without running it, so
+# even a sampled completion can be retried without producing a second answer.
+UNPROCESSED_STATUSES = frozenset({429})
+
+
+def backoff_delay(attempt: int, cfg: RetryConfig, retry_after: Optional[str] = None) -> float:
+    """Full-jitter exponential backoff, never shorter than a numeric Retry-After."""
+    delay = random.uniform(0, min(cfg.backoff_max_seconds, cfg.backoff_base_seconds * 2 ** attempt))
+    if retry_after:
+        try:
+            delay = max(delay, float(retry_after))
+        except ValueError:
+            pass  # HTTP-date form; fall back to the computed backoff
+    return delay
+
+
+class LatencyTracker:
+    """Rolling window of successful upstream latencies, used as hedge delay."""
+
+    def __init__(self, window: int = 200):
+        self._window = window
+        self._lock = threading.Lock()
+        self._samples: dict[str, deque[float]] = {}
+
+    def record(self, key: str, seconds: float) -> None:
+        with self._lock:
+            self._samples.setdefault(key, deque(maxlen=self._window)).append(seconds)
+
+    def quantile(self, key: str, q: float, min_samples: int) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples.get(key, ()))
+        if not samples or len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+# ---------------------------------------------------------------------------
+# Concurrency limiter (per endpoint)
+# At most `max_in_flight` upstream requests per endpoint; excess requests wait
+# in a bounded queue.  Waiters are served by priority class (non-streaming
+# before streaming), and round-robin across client IPs within a class so one
+# client cannot monopolize the queue.
+# ---------------------------------------------------------------------------
+
+PRIORITY_SHORT = 0
+PRIORITY_STREAM = 1
+
+
+class QueueFull(Exception):
+    """Raised when a request could not get an upstream slot in time."""
+
+
+class _Waiter:
+    __slots__ = ("granted",)
+
+    def __init__(self) -> None:
+        self.granted = False
+
+
+class ConcurrencyLimiter:
+    def __init__(self, max_in_flight: int, cfg: QueueConfig, now_fn: Callable[[], float] = time.monotonic):
+        self._max = max_in_flight
+        self._cfg = cfg
+        self._now = now_fn
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._waiting = 0
+        # priority -> ip -> waiters, in FIFO order; ips rotate after each grant
+        self._queues: dict[int, OrderedDict[str, deque[_Waiter]]] = {
+            PRIORITY_SHORT: OrderedDict(),
+            PRIORITY_STREAM: OrderedDict(),
+        }
+
+    @property
+    def depth(self) -> int:
+        return self._waiting
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def has_free_slot(self) -> bool:
+        """True if :meth:`acquire` would not have to wait right now."""
+        return self._in_flight < self._max and not self._waiting
+
+    def acquire(self, ip: str, priority: int, timeout: Optional[float] = None) -> float:
+        """Take a slot, waiting if necessary; returns the time spent queued.
+
+        Raises :class:`QueueFull` if the queue is full or the wait times out.
+        """
+        timeout = self._cfg.timeout_seconds if timeout is None else timeout
+        with self._cond:
+            if self._in_flight < self._max and not self._waiting:
+                self._in_flight += 1
+                return 0.0
+            if self._waiting >= self._cfg.max_queue:
+                raise QueueFull("queue full")
+            waiter = _Waiter()
+            self._queues[priority].setdefault(ip, deque()).append(waiter)
+            self._waiting += 1
+            start = self._now()
+            deadline = start + timeout
+            while not waiter.granted:
+                remaining = deadline - self._now()
+                if remaining <= 0:
+                    self._remove(priority, ip, waiter)
+                    raise QueueFull("timed out waiting for an upstream slot")
+                self._cond.wait(remaining)
+            return self._now() - start
+
+    def release(self) -> None:
+        with self._cond:
+            self._in_flight -= 1
+            for queue in self._queues.values():
+                if queue:
+                    ip, waiters = next(iter(queue.items()))
+                    waiter = waiters.popleft()
+                    if waiters:
+                        queue.move_to_end(ip)
+                    else:
+                        del queue[ip]
+                    self._waiting -= 1
+                    self._in_flight += 1
+                    waiter.granted = True
+                    self._cond.notify_all()
+                    break
+
+    def _remove(self, priority: int, ip: str, waiter: _Waiter) -> None:
+        waiters = self._queues[priority][ip]
+        waiters.remove(waiter)
+        if not waiters:
+            del self._queues[priority][ip]
+        self._waiting -= 1
+
+
+# ---------------------------------------------------------------------------
+# SSE coalescing
+# Upstream token streams arrive as many tiny fragments.  Regrouping them into
+# whole events flushed per interval/size turns N writes into a few, without
+# delaying the first event.
+# ---------------------------------------------------------------------------
+
+_EVENT_SEPARATORS = (b"\n\n", b"\r\n\r\n")
+
+
+def _last_event_end(buffer: bytearray) -> int:
+    """Offset just past the last complete SSE event in *buffer*, or 0."""
+    end = 0
+    for separator in _EVENT_SEPARATORS:
+        idx = buffer.rfind(separator)
+        if idx >= 0:
+            end = max(end, idx + len(separator))
+    return end
+
+
+def coalesce_sse(chunks: Iterable[bytes], cfg: StreamingConfig) -> Iterator[bytes]:
+    """Re-chunk an SSE byte stream on event boundaries.
+
+    The first complete event is yielded immediately; afterwards complete
+    events are held until ``flush_interval_ms`` has passed since the last
+    flush or ``flush_bytes`` are pending.  Upstream is read by a background
+    thread, so held events are flushed on time even while upstream is quiet.
+    Partial events are never split off.
+    """
+    interval = cfg.flush_interval_ms / 1000
+    received: queue.Queue = queue.Queue()
+    stopped = threading.Event()
+    end_of_stream = object()
+
+    def read() -> None:
+        upstream = iter(chunks)
+        try:
+            for chunk in upstream:
+                received.put(chunk)
+                if stopped.is_set():
+                    break
+        except Exception as exc:  # re-raised to the reader of the coalesced stream
+            received.put(exc)
+        finally:
+            close = getattr(upstream, "close", None)
+            if close is not None:
+                close()
+            received.put(end_of_stream)
+
+    threading.Thread(target=read, name="sse-coalesce", daemon=True).start()
+    buffer = bytearray()
+    end = 0  # bytes of complete events held in buffer
+    last_flush: Optional[float] = None
+    try:
+        while True:
+            timeout = None if not end else max(0.0, last_flush + interval - time.monotonic())
+            try:
+                item = received.get(timeout=timeout)
+            except queue.Empty:
+                item = b""
+            if item is end_of_stream:
+                break
+            if isinstance(item, Exception):
+                raise item
+            if item:
+                buffer += item
+                end = _last_event_end(buffer)
+            if not end:
+                continue
+            now = time.monotonic()
+            if last_flush is None or end >= cfg.flush_bytes or now - last_flush >= interval:
+                with memoryview(buffer) as view:
+                    out = bytes(view[:end])
+                del buffer[:end]
+                end = 0
+                last_flush = now
+                yield out
+        if buffer:
+            yield bytes(buffer)
+    finally:
+        stopped.set()
+
+
+# ---------------------------------------------------------------------------
+# Request body decoding
+# Bodies are decoded once; the span of every top-level value is remembered so
+# a single field (max_tokens) can be rewritten without re-serializing a
+# potentially multi-MB chat history.
+# ---------------------------------------------------------------------------
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_scan_value = json.JSONDecoder().scan_once
+
+
+def read_limited(stream, limit: int, chunk_size: int = 64 * 1024) -> Optional[bytes]:
+    """Read *stream* to EOF, or return None as soon as it exceeds *limit* bytes.
+
+    Memory stays bounded by *limit* however the body is sent, including
+    chunked uploads without a Content-Length.
+    """
+    chunks: list[bytes] = []
+    total = 0
+    while True:
+        chunk = stream.read(min(chunk_size, limit + 1 - total))
+        if not chunk:
+            return b"".join(chunks)
+        total += len(chunk)
+        if total > limit:
+            return None
+        chunks.append(chunk)
+
+
+class JsonBody:
+    """A JSON request body decoded in one pass, with top-level value spans."""
+
+    def __init__(self, raw: bytes, value: object, spans: Optional[dict] = None):
+        self.raw = raw
+        self.value = value
+        # top-level key -> (start, end) character offsets of its value in the
+        # decoded text; the text itself is not kept, so a body is held once
+        self._spans: dict[str, tuple[int, int]] = spans or {}
+
+    @classmethod
+    def parse(cls, raw: bytes) -> JsonBody:
+        """Decode *raw*, raising ``ValueError`` (incl. JSONDecodeError) if invalid."""
+        encoding = json.detect_encoding(raw)
+        if encoding != "utf-8":
+            return cls(raw, json.loads(raw))
+        text = raw.decode("utf-8")
+        idx = _WHITESPACE.match(text).end()
+        if text[idx:idx + 1] != "{":
+            return cls(raw, json.loads(text))
+
+        value: dict = {}
+        spans: dict[str, tuple[int, int]] = {}
+        idx = _WHITESPACE.match(text, idx + 1).end()
+        if text[idx:idx + 1] == "}":
+            idx += 1
+        else:
+            while True:
+                if text[idx:idx + 1] != '"':
+                    raise json.JSONDecodeError("Expecting property name enclosed in double quotes", text, idx)
+                key, idx = json.decoder.scanstring(text, idx + 1)
+                idx = _WHITESPACE.match(text, idx).end()
+                if text[idx:idx + 1] != ":":
+                    raise json.JSONDecodeError("Expecting ':' delimiter", text, idx)
+                idx = _WHITESPACE.match(text, idx + 1).end()
+                try:
+                    item, end = _scan_value(text, idx)
+                except StopIteration as err:
+                    raise json.JSONDecodeError("Expecting value", text, err.value) from None
+                value[key] = item
+                spans[key] = (idx, end)
+                idx = _WHITESPACE.match(text, end).end()
+                delimiter = text[idx:idx + 1]
+                idx += 1
+                if delimiter == "}":
+                    break
+                if delimiter != ",":
+                    raise json.JSONDecodeError("Expecting ',' delimiter", text, idx - 1)
+                idx = _WHITESPACE.match(text, idx).end()
+        if _WHITESPACE.match(text, idx).end() != len(text):
+            raise json.JSONDecodeError("Extra data", text, idx)
+        return cls(raw, value, spans)
+
+    def with_value(self, key: str, new_value: object) -> bytes:
+        """Return the raw body with the top-level *key* set to *new_value*.
+
+        Existing keys are spliced in place; everything else stays byte-for-byte
+        identical.  Falls back to re-serializing only when no span is known.
+        """
+        span = self._spans.get(key)
+        if span is None:
+            assert isinstance(self.value, dict)
+            return json.dumps({**self.value, key: new_value}).encode()
+        start, end = span
+        if not self.raw.isascii():
+            # Character offsets differ from byte offsets once multi-byte
+            # UTF-8 sequences appear; only the prefix needs re-encoding.
+            text = self.raw.decode("utf-8")
+            start = len(text[:start].encode("utf-8"))
+            end = start + len(text[span[0]:end].encode("utf-8"))
+        raw = memoryview(self.raw)
+        return b"".join((raw[:start], json.dumps(new_value).encode(), raw[end:]))
+
+
+# ---------------------------------------------------------------------------
+# Compression
+# Clients may send gzip/deflate request bodies; non-streaming responses are
+# compressed per Accept-Encoding.  Upstream responses are already decoded by
+# requests, which advertises gzip/deflate (and br with brotli installed).
+# ---------------------------------------------------------------------------
+
+# Content-Encoding -> zlib wbits
+REQUEST_CODINGS = {"gzip": 31, "x-gzip": 31, "deflate": 15}
+RESPONSE_CODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def decompress_body(raw: bytes, coding: str, limit: int) -> Optional[bytes]:
+    """Inflate a gzip/deflate body, or return None once it exceeds *limit*.
+
+    The limit applies to the inflated size, since a few KiB of gzip can expand
+    to gigabytes.  Raises ``ValueError`` for unknown codings or corrupt data.
+    """
+    wbits = REQUEST_CODINGS.get(coding)
+    if wbits is None:
+        raise ValueError(f"Unsupported Content-Encoding '{coding}'")
+    decoder = zlib.decompressobj(wbits)
+    try:
+        out = decoder.decompress(raw, limit + 1)
+    except zlib.error as exc:
+        raise ValueError(f"Invalid {coding} body: {exc}") from exc
+    if len(out) > limit or decoder.unconsumed_tail:
+        return None
+    if not decoder.eof:
+        raise ValueError(f"Truncated {coding} body")
+    return out
+
+
+def compress_body(data: bytes, coding: str, level: int) -> bytes:
+    if coding == "br":
+        return brotli.compress(data, quality=min(level, 11))
+    return gzip.compress(data, compresslevel=level)
 
 
 # ---------------------------------------------------------------------------
@@ -174,50 +1009,1226 @@ def find_endpoint(
 
 
 class TokenTracker:
-    def __init__(self, cfg: LimitsConfig, now_fn: Callable[[], float] = time.time):
+    def __init__(
+        self,
+        cfg: LimitsConfig,
+        now_fn: Callable[[], float] = time.time,
+        ledger: Optional[UsageLedger] = None,
+    ):
         self._cfg = cfg
         self._now = now_fn
+        self._ledger = ledger
         # ip -> list of (unix_timestamp, tokens_used)
         self._usage: dict[str, list[tuple[float, int]]] = {}
+        if ledger is not None:  # rebuild the 24 h window after a restart
+            for ip, ts, tokens in ledger.window(self._now() - 86400):
+                self._usage.setdefault(ip, []).append((ts, tokens))
+
+    def update_config(self, cfg: LimitsConfig) -> None:
+        """Apply new limits on config reload; usage recorded so far is kept."""
+        self._cfg = cfg
 
-    def check_and_track(self, ip: str, requested_tokens: int) -> tuple[int, bool]:
+    def check_and_track(
+        self,
+        ip: str,
+        requested_tokens: int,
+        daily_limit: Optional[int] = None,
+        model: str = "",
+        endpoint: str = "",
+    ) -> tuple[int, bool]:
         """Cap requested_tokens to max_request_tokens, check daily limit.
 
         Returns (capped_tokens, allowed).
         Set max_daily_tokens_per_ip to 0 in config to disable daily tracking.
+        *daily_limit* overrides it, e.g. for a client's own token quota.
+        Allowed requests are also appended to the usage ledger, if any.
         """
         capped = min(requested_tokens, self._cfg.max_request_tokens)
-        # 0 means "no daily token limit"
-        if self._cfg.max_daily_tokens_per_ip <= 0:
-            return capped, True
+        if daily_limit is None:
+            daily_limit = self._cfg.max_daily_tokens_per_ip
         now = self._now()
-        cutoff = now - 86400
-        entries = self._usage.setdefault(ip, [])
-        self._usage[ip] = [(ts, tok) for ts, tok in entries if ts >= cutoff]
-        used_today = sum(tok for _, tok in self._usage[ip])
-        if used_today + capped > self._cfg.max_daily_tokens_per_ip:
-            return capped, False
-        self._usage[ip].append((now, capped))
+        # 0 means "no daily token limit"
+        if daily_limit > 0:
+            cutoff = now - 86400
+            entries = self._usage.setdefault(ip, [])
+            self._usage[ip] = [(ts, tok) for ts, tok in entries if ts >= cutoff]
+            used_today = sum(tok for _, tok in self._usage[ip])
+            if used_today + capped > daily_limit:
+                return capped, False
+            self._usage[ip].append((now, capped))
+        if self._ledger is not None:
+            self._ledger.record(now, ip, model, endpoint, capped)
         return capped, True
 
 
+# ---------------------------------------------------------------------------
+# Usage ledger
+# Charged tokens are appended to SQLite (WAL mode) by a background writer, so
+# daily budgets survive restarts and usage history can be aggregated without
+# touching the request path.
+# ---------------------------------------------------------------------------
+
+USAGE_GROUPINGS = ("client", "model", "endpoint")
+
+
+def _call_blocking(fn: Callable, *args):
+    """Call *fn*, on a native OS thread if gevent has patched threading.
+
+    In a gevent worker, threads are greenlets and a blocking SQLite call
+    would stall every request; gevent's threadpool runs it outside the event
+    loop while the calling greenlet waits cooperatively.
+    """
+    monkey = sys.modules.get("gevent.monkey")
+    if monkey is None or not monkey.is_module_patched("threading"):
+        return fn(*args)
+    import gevent
+
+    return gevent.get_hub().threadpool.apply(fn, args)
+
+
+class UsageLedger:
+    """Append-only SQLite log of the tokens charged per request.
+
+    :meth:`record` only queues a row; a writer thread commits queued rows in
+    one transaction every *flush_interval* seconds, or as soon as
+    *batch_size* rows are waiting.  A crash loses at most the rows queued
+    since the last flush.  Readers use their own connections, which WAL mode
+    lets run alongside the writer.  All SQLite calls go through
+    :func:`_call_blocking`, so under gevent they run on native threads.
+    """
+
+    _SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS usage ("
+        " ts REAL NOT NULL, client TEXT NOT NULL, model TEXT NOT NULL,"
+        " endpoint TEXT NOT NULL, tokens INTEGER NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS usage_ts ON usage (ts)",
+    )
+
+    def __init__(
+        self,
+        path: str,
+        flush_interval: float = 1.0,
+        batch_size: int = 500,
+        retention_days: int = 90,
+        now_fn: Callable[[], float] = time.time,
+    ):
+        self.path = path
+        self._flush_interval = flush_interval
+        self._batch_size = max(1, batch_size)
+        self._pending: list[tuple[float, str, str, str, int]] = []
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._closed = False
+        self._conn = _call_blocking(self._open, now_fn() - retention_days * 86400 if retention_days > 0 else None)
+        self._thread = threading.Thread(target=self._run, name="usage-ledger", daemon=True)
+        self._thread.start()
+
+    def _open(self, expired_before: Optional[float]) -> sqlite3.Connection:
+        conn = self._connect()
+        with conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            for statement in self._SCHEMA:
+                conn.execute(statement)
+            if expired_before is not None:
+                conn.execute("DELETE FROM usage WHERE ts < ?", (expired_before,))
+        return conn
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        conn.execute("PRAGMA synchronous=NORMAL")  # durable across process crashes in WAL mode
+        return conn
+
+    def record(self, ts: float, client: str, model: object, endpoint: str, tokens: int) -> None:
+        model_name = model[:128] if isinstance(model, str) else ""  # client-supplied
+        with self._cond:
+            self._pending.append((ts, client, model_name, endpoint, tokens))
+            if len(self._pending) >= self._batch_size:
+                self._cond.notify()
+
+    def flush(self) -> None:
+        """Write all queued rows now."""
+        with self._cond:
+            batch, self._pending = self._pending, []
+        self._write(batch)
+
+    def _write(self, batch: list[tuple[float, str, str, str, int]]) -> None:
+        if not batch:
+            return
+        with self._write_lock:
+            try:
+                _call_blocking(self._insert, batch)
+            except sqlite3.Error as exc:
+                logging.getLogger(__name__).warning("usage ledger: dropped %d rows: %s", len(batch), exc)
+
+    def _insert(self, batch: list[tuple[float, str, str, str, int]]) -> None:
+        with self._conn:
+            self._conn.executemany("INSERT INTO usage VALUES (?, ?, ?, ?, ?)", batch)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._closed or len(self._pending) >= self._batch_size, self._flush_interval
+                )
+                closed = self._closed
+            self.flush()
+            if closed:
+                return
+
+    def close(self) -> None:
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        _call_blocking(self._conn.close)
+
+    def _query(self, query: str, params) -> list[tuple]:
+        conn = self._connect()
+        try:
+            return conn.execute(query, params).fetchall()
+        finally:
+            conn.close()
+
+    def window(self, since: float) -> list[tuple[str, float, int]]:
+        """``(client, ts, tokens)`` rows recorded at or after *since*, oldest first."""
+        return _call_blocking(self._query, "SELECT client, ts, tokens FROM usage WHERE ts >= ? ORDER BY ts", (since,))
+
+    def aggregate(self, since: float, by: str = "client", client: Optional[str] = None) -> list[dict]:
+        """Requests and tokens per *by* value since *since*, largest first."""
+        if by not in USAGE_GROUPINGS:
+            raise ValueError(f"cannot group usage by '{by}'")
+        query = f"SELECT {by}, COUNT(*), SUM(tokens) FROM usage WHERE ts >= ?"
+        params: list = [since]
+        if client is not None:
+            query += " AND client = ?"
+            params.append(client)
+        query += f" GROUP BY {by} ORDER BY SUM(tokens) DESC"
+        rows = _call_blocking(self._query, query, params)
+        return [{by: key, "requests": count, "tokens": tokens} for key, count, tokens in rows]
+
+
+# ---------------------------------------------------------------------------
+# Client authentication
+# Clients present the shared relay_password or their own API key.  Keys are
+# configured as SHA-256 digests, so config.yaml holds no usable client keys;
+# comparisons are constant-time and verified tokens are cached.
+# ---------------------------------------------------------------------------
+
+# Returned by ClientAuth.verify for the shared relay_password; quotas stay per IP.
+SHARED_CLIENT = ClientConfig(name="", key_sha256="")
+
+
+def hash_api_key(key: str) -> str:
+    """Digest to put in a client's ``key_sha256``."""
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class ClientAuth:
+    """Bearer token verification against relay_password and client keys.
+
+    Only valid tokens are cached (LRU, *cache_size* entries), so requests with
+    random tokens cannot evict them.  The cache is keyed by the token itself;
+    dict lookups match on Python's randomized string hash first, so cached
+    tokens cannot be probed byte by byte.
+    """
+
+    def __init__(self, relay_password: str, clients: list[ClientConfig], cache_size: int = 1024):
+        self._password = relay_password.encode()
+        self._clients = {client.key_sha256: client for client in clients}
+        self._cache: OrderedDict[str, ClientConfig] = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+        self.required = bool(relay_password or clients)
+
+    def verify(self, token: str) -> Optional[ClientConfig]:
+        """Return the client *token* belongs to, or None if it is not valid."""
+        with self._lock:
+            client = self._cache.get(token)
+            if client is not None:
+                self._cache.move_to_end(token)
+                return client
+        client = self._lookup(token)
+        if client is not None:
+            with self._lock:
+                self._cache[token] = client
+                if len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+        return client
+
+    def _lookup(self, token: str) -> Optional[ClientConfig]:
+        encoded = token.encode()
+        if self._password and hmac.compare_digest(encoded, self._password):
+            return SHARED_CLIENT
+        digest = hashlib.sha256(encoded).hexdigest()
+        client = self._clients.get(digest)
+        if client is not None and hmac.compare_digest(digest, client.key_sha256):
+            return client
+        return None
+
+
+# ---------------------------------------------------------------------------
+# Response cache (deterministic requests only: embeddings and temperature 0)
+# In-memory LRU tier, optionally backed by a shared Redis tier.
+# ---------------------------------------------------------------------------
+
+
+def is_deterministic(upstream_path: str, parsed: dict) -> bool:
+    """Return True if the upstream response for *parsed* is deterministic.
+
+    Embeddings always are; completions only when sampling is disabled with
+    ``temperature: 0``.
+    """
+    if upstream_path == "/embeddings":
+        return True
+    temperature = parsed.get("temperature")
+    return not isinstance(temperature, bool) and temperature == 0
+
+
+def is_cacheable(upstream_path: str, parsed: dict) -> bool:
+    """Deterministic and not streamed."""
+    return not parsed.get("stream") and is_deterministic(upstream_path, parsed)
+
+
+def cache_key(endpoint_url: str, upstream_path: str, parsed: dict) -> str:
+    """Hash endpoint, path and the canonical (key-sorted, compact) JSON body."""
+    canonical = json.dumps(parsed, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(f"{endpoint_url}\n{upstream_path}\n{canonical}".encode()).hexdigest()
+
+
+class ResponseCache:
+    """TTL + LRU cache of successful upstream responses.
+
+    Entries are ``(content_type, content)`` pairs.  The memory tier is bounded
+    by both entry count and total content bytes; the optional Redis tier is
+    shared between relay instances and survives restarts.
+    """
+
+    _REDIS_PREFIX = "mc-relay:cache:"
+
+    def __init__(
+        self,
+        cfg: CacheConfig,
+        now_fn: Callable[[], float] = time.time,
+        redis_client: object = None,
+    ):
+        self._cfg = cfg
+        self._now = now_fn
+        self._lock = threading.Lock()
+        # key -> (expires_at, content_type, content); most recently used last
+        self._entries: OrderedDict[str, tuple[float, str, bytes]] = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.redis_hits = 0
+        self._redis = redis_client
+        if self._redis is None and cfg.redis_url:
+            import redis  # optional dependency, only needed for the shared tier
+
+            self._redis = redis.Redis.from_url(cfg.redis_url)
+
+    def get(self, key: str) -> Optional[tuple[str, bytes]]:
+        now = self._now()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1], entry[2]
+                self._evict(key)
+        if self._redis is not None:
+            try:
+                raw = self._redis.get(self._REDIS_PREFIX + key)
+            except Exception:
+                logging.getLogger(__name__).warning("cache: redis lookup failed", exc_info=True)
+                raw = None
+            if raw:
+                content_type, _, content = raw.partition(b"\0")
+                self._store_local(key, content_type.decode(), content, now)
+                with self._lock:
+                    self.hits += 1
+                    self.redis_hits += 1
+                return content_type.decode(), content
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, content_type: str, content: bytes) -> None:
+        if len(content) > self._cfg.max_entry_bytes:
+            return
+        self._store_local(key, content_type, content, self._now())
+        if self._redis is not None:
+            try:
+                self._redis.set(
+                    self._REDIS_PREFIX + key,
+                    content_type.encode() + b"\0" + content,
+                    ex=self._cfg.ttl_seconds,
+                )
+            except Exception:
+                logging.getLogger(__name__).warning("cache: redis store failed", exc_info=True)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "redis_hits": self.redis_hits,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+    def _store_local(self, key: str, content_type: str, content: bytes, now: float) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._evict(key)
+            self._entries[key] = (now + self._cfg.ttl_seconds, content_type, content)
+            self._bytes += len(content)
+            while self._entries and (
+                len(self._entries) > self._cfg.max_entries or self._bytes > self._cfg.max_bytes
+            ):
+                self._evict(next(iter(self._entries)))
+
+    def _evict(self, key: str) -> None:
+        _, _, content = self._entries.pop(key)
+        self._bytes -= len(content)
+
+
+# ---------------------------------------------------------------------------
+# Single-flight coalescing
+# Identical deterministic requests in flight at the same time share one
+# upstream call.  Non-streaming followers receive the leader's result; a
+# stream is read once by a pump thread and replayed from the start to every
+# client that joins before it ends.
+# ---------------------------------------------------------------------------
+
+
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: object = None
+        self.error: Optional[BaseException] = None
+
+
+class StreamTee:
+    """An upstream stream pumped into a buffer that the clients who joined replay.
+
+    Clients :meth:`join` while the tee is joinable and each replay it from the
+    start.  Once the buffer exceeds *max_buffer_bytes*, nobody can join any
+    more and chunks are dropped as soon as all remaining clients have read
+    them.  If every client leaves before the upstream stream ends, the tee is
+    closed to new clients too and the pump stops reading upstream.
+
+    *on_done* runs once the upstream stream has ended, failed or been
+    abandoned, after the last chunk is buffered.
+    """
+
+    def __init__(
+        self,
+        status: int,
+        content_type: str,
+        chunks: Iterable[bytes],
+        on_done: Callable[[], None],
+        max_buffer_bytes: int,
+        endpoint: str = "",
+    ):
+        self.status = status
+        self.content_type = content_type
+        self.endpoint = endpoint  # name of the group member serving the stream
+        self._source = chunks
+        self._on_done = on_done
+        self._max_bytes = max_buffer_bytes
+        self._chunks: list[bytes] = []
+        self._offset = 0  # position of _chunks[0] in the stream; earlier chunks were dropped
+        self._bytes = 0
+        self._readers: dict[int, int] = {}  # reader id -> position of its next chunk
+        self._next_reader = 0
+        self._cond = threading.Condition()
+        self.done = False
+        self.joinable = True
+        self.abandoned = False
+
+    def start(self) -> StreamTee:
+        threading.Thread(target=self._pump, name="stream-tee", daemon=True).start()
+        return self
+
+    def join(self) -> Optional[Iterator[bytes]]:
+        """Return an iterator over the whole stream, or None if the tee is closed to new clients."""
+        with self._cond:
+            if not self.joinable:
+                return None
+            reader = self._next_reader
+            self._next_reader += 1
+            self._readers[reader] = 0
+        return self._replay(reader)
+
+    @property
+    def buffered(self) -> int:
+        """Number of chunks currently held in memory."""
+        with self._cond:
+            return len(self._chunks)
+
+    def _pump(self) -> None:
+        try:
+            for chunk in self._source:
+                with self._cond:
+                    if self.abandoned:
+                        break
+                    if chunk:
+                        self._chunks.append(chunk)
+                        self._bytes += len(chunk)
+                        if self.joinable and self._bytes > self._max_bytes:
+                            self.joinable = False
+                            self._trim()
+                        self._cond.notify_all()
+        except Exception as exc:  # the clients see a truncated stream, as without coalescing
+            logging.getLogger(__name__).warning("coalesced stream failed: %s", exc)
+        finally:
+            with self._cond:
+                self.done = True
+                self._cond.notify_all()
+            self._on_done()
+
+    def _replay(self, reader: int) -> Iterator[bytes]:
+        try:
+            while True:
+                with self._cond:
+                    position = self._readers[reader]
+                    while position == self._offset + len(self._chunks) and not self.done:
+                        self._cond.wait()
+                    pending = self._chunks[position - self._offset:]
+                    self._readers[reader] = position + len(pending)
+                    if not self.joinable:
+                        self._trim()
+                if not pending:
+                    return
+                yield from pending
+        finally:
+            with self._cond:
+                del self._readers[reader]
+                if not self._readers and not self.done:
+                    # Nobody wants the rest: stop reading upstream instead of buffering it
+                    self.joinable = False
+                    self.abandoned = True
+                self._trim()
+
+    def _trim(self) -> None:
+        """Drop the chunks every reader has passed; only once nobody can join (hold _cond)."""
+        if self.joinable:
+            return
+        low = min(self._readers.values(), default=self._offset + len(self._chunks))
+        if low > self._offset:
+            del self._chunks[: low - self._offset]
+            self._offset = low
+
+
+class SingleFlight:
+    """Registry of in-flight upstream calls, keyed by request hash."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._flights: dict[str, _Flight] = {}
+        self._streams: dict[str, StreamTee] = {}
+
+    def do(self, key: str, fn: Callable[[], object], timeout: Optional[float] = None) -> tuple[object, bool]:
+        """Run *fn* once for concurrent callers with *key*; return ``(result, shared)``.
+
+        Followers block until the leader finishes and get its result, or
+        its exception re-raised; after *timeout* seconds they give up with
+        :class:`TimeoutError`.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            if not flight.done.wait(timeout):
+                raise TimeoutError("timed out waiting for an identical request")
+        else:
+            try:
+                flight.result = fn()
+            except BaseException as exc:
+                flight.error = exc
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result, not leader
+
+    def stream(
+        self, key: str, start: Callable[[], StreamTee], timeout: Optional[float] = None
+    ) -> Optional[tuple[StreamTee, Iterator[bytes], bool]]:
+        """Join the running stream for *key*, or open one with *start*.
+
+        *start* returns a tee that is not started yet; it is started once the
+        caller that opened it has joined.  Returns ``(tee, chunks, shared)``,
+        or None if the stream stopped accepting clients before this caller
+        could join, in which case the caller makes its own upstream call.
+        *timeout* bounds the wait for a stream another caller is opening.
+        """
+        with self._lock:
+            tee = self._streams.get(key)
+        if tee is not None:
+            chunks = tee.join()
+            if chunks is not None:
+                return tee, chunks, True
+        tee, shared = self.do(key, start, timeout)
+        chunks = tee.join()
+        if not shared:
+            with self._lock:
+                self._streams[key] = tee
+            tee.start()
+        if chunks is None:
+            return None
+        return tee, chunks, shared
+
+    def forget(self, key: str, tee: StreamTee) -> None:
+        with self._lock:
+            if self._streams.get(key) is tee:
+                del self._streams[key]
+
+
+# ---------------------------------------------------------------------------
+# Embedding micro-batching
+# Concurrent /embeddings requests with the same endpoint, model and options are
+# coalesced into one upstream call with an array input, then split per caller.
+# ---------------------------------------------------------------------------
+
+# (status, content_type, content) of a fully buffered upstream response
+UpstreamResult = tuple[int, str, bytes]
+
+
+def embedding_inputs(value: object) -> Optional[list]:
+    """Normalize an embeddings ``input`` to a list of single inputs.
+
+    Returns None for shapes that cannot be merged safely, including arrays
+    mixing strings and token arrays.
+    """
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, list) and value:
+        if all(isinstance(v, int) for v in value):
+            return [value]  # a single pre-tokenized input
+        if all(isinstance(v, str) for v in value) or all(isinstance(v, list) for v in value):
+            return list(value)
+    return None
+
+
+def batch_key(endpoint_url: str, parsed: dict, inputs: list) -> str:
+    """Key of the batches a request may join: same endpoint, options and kind of input.
+
+    Text and token-array inputs are never merged, since providers reject an
+    ``input`` array that mixes them.
+    """
+    kind = "text" if isinstance(inputs[0], str) else "tokens"
+    options = {k: v for k, v in parsed.items() if k != "input"}
+    return f"{endpoint_url}\n{kind}\n{json.dumps(options, sort_keys=True, separators=(',', ':'))}"
+
+
+class _EmbeddingBatch:
+    def __init__(self) -> None:
+        self.inputs: list = []
+        self.slices: list[tuple[int, int]] = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.result: Optional[UpstreamResult] = None
+        self.error: Optional[BaseException] = None
+
+
+class EmbeddingBatcher:
+    """Coalesce concurrent embedding requests into one upstream call.
+
+    The first caller for a key becomes the batch leader: it waits up to
+    ``window_ms`` (or until ``max_batch_size`` inputs have joined), sends the
+    merged request and publishes the result.  Every caller then extracts its
+    own slice of ``data`` with indices renumbered from zero.  If the merged
+    request is refused, each caller sends its own request instead, so one
+    caller's bad input does not fail the others.
+    """
+
+    def __init__(self, cfg: BatchingConfig):
+        self._cfg = cfg
+        self._lock = threading.Lock()
+        self._open: dict[str, _EmbeddingBatch] = {}
+
+    def submit(
+        self,
+        key: str,
+        inputs: list,
+        send: Callable[[Optional[list]], UpstreamResult],
+        timeout: Optional[float] = None,
+    ) -> UpstreamResult:
+        """Join (or open) the batch for *key* and return this caller's result.
+
+        *send* is only called on the leader; it receives the merged input list,
+        or None if nobody joined and the original body can be sent unchanged.
+        Other callers wait up to *timeout* seconds for the leader's result,
+        then raise :class:`TimeoutError`.
+        """
+        with self._lock:
+            batch = self._open.get(key)
+            is_leader = batch is None
+            if batch is None:
+                batch = _EmbeddingBatch()
+                self._open[key] = batch
+            offset = len(batch.inputs)
+            batch.inputs.extend(inputs)
+            position = len(batch.slices)
+            batch.slices.append((offset, len(batch.inputs)))
+            if len(batch.inputs) >= self._cfg.max_batch_size:
+                self._open.pop(key, None)
+                batch.full.set()
+
+        if not is_leader:
+            if not batch.done.wait(timeout):
+                raise TimeoutError("timed out waiting for a batched embedding request")
+        else:
+            batch.full.wait(self._cfg.window_ms / 1000)
+            with self._lock:
+                if self._open.get(key) is batch:
+                    del self._open[key]
+            try:
+                batch.result = send(batch.inputs if len(batch.slices) > 1 else None)
+            except BaseException as exc:
+                batch.error = exc
+            finally:
+                batch.done.set()
+
+        if batch.error is not None:
+            raise batch.error
+        assert batch.result is not None
+        if len(batch.slices) == 1:
+            return batch.result
+        if batch.result[0] != 200:
+            return send(None)
+        return self._split(batch.result, *batch.slices[position], len(batch.inputs))
+
+    @staticmethod
+    def _split(result: UpstreamResult, begin: int, end: int, total: int) -> UpstreamResult:
+        status, content_type, content = result
+        if status != 200:
+            return result
+        try:
+            payload = json.loads(content)
+            items = sorted(
+                (item for item in payload["data"] if begin <= item["index"] < end),
+                key=lambda item: item["index"],
+            )
+        except (ValueError, KeyError, TypeError):
+            return 502, "application/json", json.dumps(
+                {"error": {"message": "Malformed batched embedding response", "type": "relay_error"}}
+            ).encode()
+        payload["data"] = [{**item, "index": item["index"] - begin} for item in items]
+        usage = payload.get("usage")
+        if isinstance(usage, dict):
+            share = (end - begin) / total
+            payload["usage"] = {
+                k: round(v * share) if isinstance(v, int) else v for k, v in usage.items()
+            }
+        return status, content_type, json.dumps(payload).encode()
+
+
+# ---------------------------------------------------------------------------
+# Models list cache
+# GET /v1/models merges the model lists of all configured endpoints, tagged
+# with the endpoint each model came from, and is served from memory.  Past
+# ttl_seconds the stale list is still served for up to stale_seconds while a
+# single background refresh runs; only an empty or expired cache blocks.
+# ---------------------------------------------------------------------------
+
+
+class ModelsCache:
+    """Merged, TTL-cached ``/models`` listing across endpoints.
+
+    *fetch* returns one endpoint's ``data`` list or raises.  Endpoints sharing
+    a URL are one group serving the same models, so only the first is queried.
+    An endpoint that fails keeps its last known models.
+    """
+
+    def __init__(
+        self,
+        endpoints: list[EndpointConfig],
+        cfg: ModelsConfig,
+        fetch: Callable[[EndpointConfig], list],
+        now_fn: Callable[[], float] = time.monotonic,
+    ):
+        by_url: dict[str, EndpointConfig] = {}
+        for ep in endpoints:
+            by_url.setdefault(ep.url, ep)
+        self._endpoints = list(by_url.values())
+        self._cfg = cfg
+        self._fetch = fetch
+        self._now = now_fn
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._by_endpoint: dict[str, list[dict]] = {}
+        self._models: Optional[list[dict]] = None
+        self._fetched_at = 0.0
+        self._refreshing = False
+        self.last_error: Optional[Exception] = None
+
+    def get(self) -> tuple[Optional[list[dict]], str]:
+        """Return ``(models, state)``; state is ``HIT``, ``STALE`` or ``MISS``.
+
+        *models* is None when no endpoint has answered yet; see :attr:`last_error`.
+        """
+        with self._lock:
+            if self._models is not None:
+                age = self._now() - self._fetched_at
+                if age < self._cfg.ttl_seconds:
+                    return self._models, "HIT"
+                if age < self._cfg.ttl_seconds + self._cfg.stale_seconds:
+                    if not self._refreshing:
+                        self._refreshing = True
+                        threading.Thread(target=self._refresh_in_background, daemon=True).start()
+                    return self._models, "STALE"
+            fetched_at = self._fetched_at
+        with self._refresh_lock:
+            if self._fetched_at == fetched_at:  # nobody refreshed while we waited
+                self.refresh()
+        return self._models, "MISS"
+
+    def refresh(self) -> None:
+        """Query every endpoint in parallel and rebuild the merged list."""
+        with ThreadPoolExecutor(max_workers=len(self._endpoints) or 1) as pool:
+            outcomes = list(pool.map(self._fetch_one, self._endpoints))
+        with self._lock:
+            for ep, models in zip(self._endpoints, outcomes):
+                if models is not None:
+                    self._by_endpoint[ep.url] = models
+            if self._by_endpoint:
+                self._models = [
+                    model for ep in self._endpoints for model in self._by_endpoint.get(ep.url, [])
+                ]
+            self._fetched_at = self._now()
+
+    def _fetch_one(self, ep: EndpointConfig) -> Optional[list[dict]]:
+        try:
+            data = self._fetch(ep)
+        except Exception as exc:  # one failing endpoint must not hide the others
+            logging.getLogger(__name__).warning("endpoint=%s models request failed: %s", ep.name, exc)
+            self.last_error = exc
+            return None
+        return [
+            {**model, "relay_endpoint": ep.name, "relay_endpoint_url": ep.url}
+            for model in data
+            if isinstance(model, dict)
+        ]
+
+    def _refresh_in_background(self) -> None:
+        try:
+            with self._refresh_lock:
+                self.refresh()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+
+# ---------------------------------------------------------------------------
+# Metrics (Prometheus, optional OTLP spans)
+# ---------------------------------------------------------------------------
+
+# LLM calls range from milliseconds (cache, embeddings) to minutes (long streams).
+_LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class RelayMetrics:
+    """Prometheus collectors for one app instance (own registry, so several
+    apps — e.g. in tests — never collide on the global default registry)."""
+
+    MAX_MODEL_LABELS = 100
+
+    def __init__(self) -> None:
+        self.registry = CollectorRegistry()
+        r = self.registry
+        self.requests = Counter(
+            "relay_requests_total", "Requests handled by the relay.",
+            ["path", "endpoint", "model", "status"], registry=r,
+        )
+        self.duration = Histogram(
+            "relay_request_duration_seconds", "Total request duration, including full stream transfer.",
+            ["path", "endpoint"], buckets=_LATENCY_BUCKETS, registry=r,
+        )
+        self.ttfb = Histogram(
+            "relay_time_to_first_byte_seconds", "Time until the first response byte was available.",
+            ["path", "endpoint"], buckets=_LATENCY_BUCKETS, registry=r,
+        )
+        self.stream_duration = Histogram(
+            "relay_stream_duration_seconds", "Time from first to last byte of streamed responses.",
+            ["path", "endpoint"], buckets=_LATENCY_BUCKETS, registry=r,
+        )
+        self.upstream_headers = Histogram(
+            "relay_upstream_headers_seconds",
+            "Time until upstream response headers; includes the whole generation for non-streaming calls.",
+            ["endpoint"], buckets=_LATENCY_BUCKETS, registry=r,
+        )
+        self.upstream_connect = Histogram(
+            "relay_upstream_connect_seconds", "Time to open a new upstream connection, TLS handshake included.",
+            ["endpoint"], buckets=_LATENCY_BUCKETS, registry=r,
+        )
+        self.bytes_in = Counter("relay_request_bytes_total", "Request body bytes received.", ["endpoint"], registry=r)
+        self.bytes_out = Counter("relay_response_bytes_total", "Response body bytes sent.", ["endpoint"], registry=r)
+        self.tokens = Counter(
+            "relay_tokens_charged_total", "max_tokens charged against daily budgets.", ["endpoint", "model"], registry=r,
+        )
+        self.upstream_errors = Counter(
+            "relay_upstream_errors_total", "Failed upstream attempts (including ones retried on another member).",
+            ["endpoint", "kind"], registry=r,
+        )
+        self.streams_in_flight = Gauge("relay_streams_in_flight", "Streaming responses currently open.", registry=r)
+        self.queue_wait = Histogram(
+            "relay_queue_wait_seconds", "Time spent waiting for an upstream concurrency slot.",
+            ["endpoint"], buckets=_LATENCY_BUCKETS, registry=r,
+        )
+        self.queue_depth = Gauge("relay_queue_depth", "Requests waiting for an upstream slot.", ["endpoint"], registry=r)
+        self.retries = Counter(
+            "relay_upstream_retries_total", "Upstream attempts retried after backoff.", ["endpoint"], registry=r,
+        )
+        self.hedges = Counter(
+            "relay_hedged_requests_total", "Hedged second attempts, by whether the hedge won.",
+            ["endpoint", "winner"], registry=r,
+        )
+        self.queue_rejected = Counter(
+            "relay_queue_rejected_total", "Requests rejected because the queue was full or timed out.",
+            ["endpoint"], registry=r,
+        )
+        self.coalesced = Counter(
+            "relay_coalesced_requests_total", "Requests that shared another identical request's upstream call.",
+            ["endpoint", "kind"], registry=r,
+        )
+        self.log_dropped = Gauge(
+            "relay_log_records_dropped", "Log records dropped because the log queue was full.", registry=r,
+        )
+        self._models: set[str] = set()
+        self._models_lock = threading.Lock()
+
+    def model_label(self, model: object) -> str:
+        """Bound label cardinality: models are client-supplied strings."""
+        if not isinstance(model, str) or not model:
+            return ""
+        with self._models_lock:
+            if model in self._models:
+                return model
+            if len(self._models) < self.MAX_MODEL_LABELS and len(model) <= 128:
+                self._models.add(model)
+                return model
+        return "other"
+
+    def upstream_status(self, endpoint: str, status: int) -> None:
+        if status == 429:
+            self.upstream_errors.labels(endpoint, "429").inc()
+        elif status >= 500:
+            self.upstream_errors.labels(endpoint, "5xx").inc()
+
+    def render(self) -> bytes:
+        return generate_latest(self.registry)
+
+
+def make_tracer(cfg: MetricsConfig) -> object:
+    """Return an OpenTelemetry tracer exporting via OTLP/HTTP, or None.
+
+    OpenTelemetry is optional; install ``opentelemetry-sdk`` and
+    ``opentelemetry-exporter-otlp-proto-http`` to enable spans.
+    """
+    if not cfg.otlp_endpoint:
+        return None
+    try:
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        logging.getLogger(__name__).warning("metrics.otlp_endpoint is set but opentelemetry-sdk is not installed")
+        return None
+    provider = TracerProvider(resource=Resource.create({"service.name": cfg.service_name}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=cfg.otlp_endpoint)))
+    return provider.get_tracer(__name__)
+
+
+# ---------------------------------------------------------------------------
+# Runtime state and hot reload
+# Everything derived from one RelayConfig lives in a RelayRuntime.  A reload
+# builds a new runtime and swaps a single reference; requests keep the runtime
+# they started with, so in-flight streams finish on the old config.
+# ---------------------------------------------------------------------------
+
+# Access log lines go to their own logger so that they can be sampled.
+ACCESS_LOGGER = f"{__name__}.access"
+
+# Applied when the app is created; changing these requires a restart.
+RESTART_ONLY_SETTINGS = ("allowed_origins", "ledger", "logging", "metrics")
+
+
+def _upstream_headers(ep: EndpointConfig, accept: Optional[str]) -> dict[str, str]:
+    prefix = ep.auth_prefix
+    auth_value = f"{prefix} {ep.api_key}".strip() if prefix else ep.api_key
+    headers: dict[str, str] = {ep.auth_header: auth_value, "Content-Type": "application/json"}
+    if accept:
+        headers["Accept"] = accept
+    headers.update(ep.extra_headers)
+    return headers
+
+
+# Seconds the last new upstream connection of this thread (greenlet under
+# gevent) took to open, TLS handshake included; None if none was opened.
+_connect_timing = threading.local()
+
+
+class _TimedConnect:
+    def connect(self) -> None:
+        start = time.monotonic()
+        super().connect()
+        _connect_timing.seconds = time.monotonic() - start
+
+
+class _TimedHTTPConnection(_TimedConnect, urllib3.connection.HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnect, urllib3.connection.HTTPSConnection):
+    pass
+
+
+class _TimedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedConnectAdapter(HTTPAdapter):
+    """HTTPAdapter whose new connections record their connect time in ``_connect_timing``."""
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _TimedHTTPConnectionPool, "https": _TimedHTTPSConnectionPool}
+
+
+def _upstream_session() -> requests.Session:
+    """Keep-alive connection pool for upstream calls.
+
+    Cookies are disabled: the session is shared by all clients, so an
+    upstream Set-Cookie must not be replayed on other clients' requests.
+    """
+    session = requests.Session()
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    adapter = _TimedConnectAdapter()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class RelayRuntime:
+    """Routing, endpoint groups, queues, caches and connection pool for one config."""
+
+    def __init__(self, config: RelayConfig, previous: Optional[RelayRuntime] = None):
+        self.config = config
+        self.auth = ClientAuth(config.relay_password, config.clients)
+        self.endpoint_groups = build_endpoint_groups(config.endpoints, config.load_balancing)
+        # Requests still running on the previous runtime hold its slots, so the
+        # per-endpoint limit may briefly be exceeded right after a reload.
+        self.limiters: dict[str, ConcurrencyLimiter] = {
+            ep.name: ConcurrencyLimiter(ep.max_in_flight, config.queue)
+            for ep in config.endpoints
+            if ep.max_in_flight > 0
+        }
+        if previous is not None and previous.config.cache == config.cache:
+            self.response_cache = previous.response_cache  # keep the warm cache
+        else:
+            self.response_cache = ResponseCache(config.cache) if config.cache.enabled else None
+        self.embedding_batcher = EmbeddingBatcher(config.batching) if config.batching.enabled else None
+        self.single_flight = SingleFlight() if config.coalescing.enabled else None
+        self.session = _upstream_session()
+        if (
+            previous is not None
+            and previous.config.endpoints == config.endpoints
+            and previous.config.models == config.models
+        ):
+            self.models = previous.models
+        else:
+            self.models = ModelsCache(config.endpoints, config.models, self._fetch_models)
+
+    def _fetch_models(self, ep: EndpointConfig) -> list:
+        resp = self.session.get(
+            f"{ep.url}/models",
+            headers=_upstream_headers(ep, "application/json"),
+            timeout=self.config.models.timeout_seconds,
+        )
+        resp.raise_for_status()
+        data = resp.json().get("data")
+        if not isinstance(data, list):
+            raise ValueError("response has no 'data' list")
+        return data
+
+
+class RelayState:
+    """Holds the app's current :class:`RelayRuntime`.
+
+    :meth:`reload` builds the new runtime before swapping the reference, so a
+    request sees either the old config or the new one, never a mix.
+    """
+
+    def __init__(
+        self,
+        config: RelayConfig,
+        on_reload: Optional[Callable[[RelayRuntime, RelayRuntime], None]] = None,
+    ):
+        self.runtime = RelayRuntime(config)
+        self._on_reload = on_reload
+        self._lock = threading.Lock()
+
+    def reload(self, config: RelayConfig) -> RelayRuntime:
+        with self._lock:
+            old = self.runtime
+            self.runtime = RelayRuntime(config, old)
+            if self._on_reload is not None:
+                self._on_reload(old, self.runtime)
+        return self.runtime
+
+
+def reload_config(app: Flask, path: str) -> bool:
+    """Re-read *path* into *app*; on error keep serving the current config."""
+    try:
+        new_config = parse_config(path)
+    except (ConfigError, AttributeError, KeyError, TypeError, ValueError) as exc:
+        logging.getLogger(__name__).error("config reload from %s failed, keeping current config: %s", path, exc)
+        return False
+    app.extensions["mc_relay"].reload(new_config)
+    return True
+
+
+class ConfigWatcher:
+    """Reload the app when its config file changes on disk or on SIGHUP.
+
+    The file is polled every *interval* seconds (0 disables polling).  A
+    change in inode, size or mtime counts, so editors and ConfigMap updates
+    that replace the file atomically are picked up.  A changed file is
+    re-checked after *settle_seconds* so a half-written file is not loaded.
+    The SIGHUP handler only wakes the watcher thread, which does the reload.
+    """
+
+    def __init__(self, app: Flask, path: str, interval: float = 5.0, settle_seconds: float = 0.2):
+        self._app = app
+        self._path = path
+        self._interval = interval
+        self._settle = settle_seconds
+        self._wake = threading.Event()
+        self._forced = False
+        self._stopped = False
+        self._stamp = self._file_stamp()
+
+    def _file_stamp(self) -> Optional[tuple[int, int, int]]:
+        try:
+            st = os.stat(self._path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def check(self) -> bool:
+        """Reload if the file changed or a reload was requested; True if reloaded."""
+        forced, self._forced = self._forced, False
+        stamp = self._file_stamp()
+        if not forced:
+            if stamp is None or stamp == self._stamp:
+                return False
+            if self._settle > 0:
+                time.sleep(self._settle)
+                if self._file_stamp() != stamp:
+                    return False  # still being written; picked up on the next poll
+        self._stamp = stamp
+        return reload_config(self._app, self._path)
+
+    def trigger(self) -> None:
+        """Request a reload regardless of the file stamp."""
+        self._forced = True
+        self._wake.set()
+
+    def start(self) -> ConfigWatcher:
+        if hasattr(signal, "SIGHUP"):
+            try:
+                signal.signal(signal.SIGHUP, lambda signum, frame: self.trigger())
+            except ValueError:  # signal handlers can only be set from the main thread
+                logging.getLogger(__name__).warning("SIGHUP config reload unavailable outside the main thread")
+        threading.Thread(target=self._run, name="config-watcher", daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._wake.set()
+
+    def _run(self) -> None:
+        while not self._stopped:
+            self._wake.wait(self._interval if self._interval > 0 else None)
+            self._wake.clear()
+            if not self._stopped:
+                self.check()
+
+
 # ---------------------------------------------------------------------------
 # App factory
 # ---------------------------------------------------------------------------
 
 
 def create_app(config: RelayConfig) -> Flask:
-    logging.basicConfig(
-        level=getattr(logging, config.log_level, logging.INFO),
-        format="%(asctime)s %(levelname)s %(message)s",
-        datefmt="%Y-%m-%dT%H:%M:%S",
-        stream=sys.stdout,
+    logs = configure_logging(
+        config.log_level,
+        fmt=config.logging.format,
+        queue_size=config.logging.queue_size,
+        sample_rate=config.logging.access_sample_rate,
+        sampled_loggers=[ACCESS_LOGGER],
     )
     log = logging.getLogger(__name__)
-
-    token_tracker = TokenTracker(config.limits)
+    access_log = logging.getLogger(ACCESS_LOGGER)
+
+    # Kept across config reloads; everything else lives in RelayRuntime.
+    ledger = None
+    if config.ledger.path:
+        ledger = UsageLedger(
+            config.ledger.path,
+            flush_interval=config.ledger.flush_interval_seconds,
+            batch_size=config.ledger.batch_size,
+            retention_days=config.ledger.retention_days,
+        )
+        atexit.register(ledger.close)
+    usage_admin_sha256 = config.ledger.admin_key_sha256
+    token_tracker = TokenTracker(config.limits, ledger=ledger)
+    metrics = RelayMetrics() if config.metrics.enabled else None
+    if metrics is not None:
+        metrics.log_dropped.set_function(lambda: logs.dropped)
+    tracer = make_tracer(config.metrics)
+    latencies = LatencyTracker()
+
+    def _watch_queues(runtime: RelayRuntime) -> None:
+        if metrics is None:
+            return
+        for name, endpoint_limiter in runtime.limiters.items():
+            metrics.queue_depth.labels(name).set_function(lambda lim=endpoint_limiter: lim.depth)
+
+    def _on_reload(old: RelayRuntime, new: RelayRuntime) -> None:
+        token_tracker.update_config(new.config.limits)
+        logging.getLogger().setLevel(getattr(logging, new.config.log_level, logging.INFO))
+        if metrics is not None:
+            for name in old.limiters.keys() - new.limiters.keys():
+                metrics.queue_depth.remove(name)
+        _watch_queues(new)
+        restart_only = [n for n in RESTART_ONLY_SETTINGS if getattr(old.config, n) != getattr(new.config, n)]
+        if restart_only:
+            log.warning("config reload: changes to %s take effect after a restart", ", ".join(restart_only))
+        log.info("config reloaded: endpoints=%d", len(new.config.endpoints))
+
+    state = RelayState(config, _on_reload)
+    _watch_queues(state.runtime)
 
     app = Flask(__name__)
+    app.extensions["mc_relay"] = state
+    app.extensions["mc_relay_ledger"] = ledger
 
     # -----------------------------------------------------------------------
     # CORS (flask-cors)
@@ -227,7 +2238,7 @@ def create_app(config: RelayConfig) -> Flask:
     CORS(
         app,
         origins=origins,
-        allow_headers=["Authorization", "Content-Type", "X-Relay-Endpoint"],
+        allow_headers=["Authorization", "Content-Type", "Content-Encoding", "X-Relay-Endpoint", "X-Relay-Timeout"],
         methods=["GET", "POST", "OPTIONS"],
         max_age=86400,
     )
@@ -239,21 +2250,34 @@ def create_app(config: RelayConfig) -> Flask:
     def _client_ip() -> str:
         return request.remote_addr or ""
 
-    rl = config.rate_limits
-    default_limits = (
-        [
-            f"{rl.requests_per_minute} per minute",
-            f"{rl.requests_per_hour} per hour",
-            f"{rl.requests_per_day} per day",
-        ]
-        if rl.enabled
-        else []
-    )
+    # Registered before the limiter's own hook, so limits can be per client.
+    @app.before_request
+    def _identify_client() -> None:
+        auth_header = request.headers.get("Authorization", "")
+        token = auth_header[len("Bearer "):] if auth_header.startswith("Bearer ") else ""
+        g.relay_client = state.runtime.auth.verify(token) if token else None
+
+    def _client_id() -> str:
+        """Quota key: the client's name when it sent its own API key, else its IP."""
+        client = g.get("relay_client")
+        return f"client:{client.name}" if client is not None and client.name else _client_ip()
+
+    # Limits are read per request so that a config reload applies them.
+    def _rate_limits() -> RateLimitConfig:
+        client = g.get("relay_client")
+        if client is not None and client.rate_limits is not None:
+            return client.rate_limits
+        return state.runtime.config.rate_limits
+
+    def _default_limits() -> str:
+        rl = _rate_limits()
+        return f"{rl.requests_per_minute} per minute; {rl.requests_per_hour} per hour; {rl.requests_per_day} per day"
 
     limiter = Limiter(
-        key_func=_client_ip,
+        key_func=_client_id,
         app=app,
-        default_limits=default_limits,
+        default_limits=[_default_limits],
+        default_limits_exempt_when=lambda: not _rate_limits().enabled,
         storage_uri="memory://",
     )
 
@@ -261,26 +2285,91 @@ def create_app(config: RelayConfig) -> Flask:
     def _rate_limit_error(e):
         return jsonify({"error": {"message": "Rate limit exceeded", "type": "rate_limit_error"}}), 429
 
+    # -----------------------------------------------------------------------
+    # Response compression (non-streaming responses only)
+    # -----------------------------------------------------------------------
+
+    @app.after_request
+    def _compress_response(resp: Response) -> Response:
+        cfg = state.runtime.config.compression
+        if (
+            not cfg.enabled
+            or resp.is_streamed
+            or resp.status_code < 200
+            or "Content-Encoding" in resp.headers
+            or not ((resp.mimetype or "").startswith("text/") or (resp.mimetype or "").endswith("json"))
+        ):
+            return resp
+        data = resp.get_data()
+        if len(data) < cfg.min_bytes:
+            return resp
+        resp.vary.add("Accept-Encoding")
+        coding = request.accept_encodings.best_match(RESPONSE_CODINGS)
+        if coding is not None:
+            resp.set_data(compress_body(data, coding, cfg.level))
+            resp.headers["Content-Encoding"] = coding
+        return resp
+
     # -----------------------------------------------------------------------
     # Helpers
     # -----------------------------------------------------------------------
 
-    def _log(method: str, path: str, status: int, duration: float, model: Optional[str] = None) -> None:
-        parts = [
-            f"method={method}",
-            f"path={path}",
-            f"ip={_client_ip()}",
-            f"status={status}",
-            f"duration={duration:.3f}s",
-        ]
+    def _log(
+        method: str,
+        path: str,
+        status: int,
+        duration: float,
+        model: Optional[str] = None,
+        endpoint: str = "",
+    ) -> None:
+        """Write the access log line and record request metrics and spans."""
+        fields: dict[str, object] = {
+            "method": method,
+            "path": path,
+            "ip": _client_ip(),
+            "status": status,
+            "duration_ms": round(duration * 1000, 1),
+        }
+        client = g.get("relay_client")
+        if client is not None and client.name:
+            fields["client"] = client.name
         if model:
-            parts.append(f"model={model}")
-        log.info(" ".join(parts))
+            fields["model"] = model
+        if endpoint:
+            fields["endpoint"] = endpoint
+        line = " ".join(
+            f"duration={duration:.3f}s" if key == "duration_ms" else f"{key}={value}" for key, value in fields.items()
+        )
+        # 5xx lines are logged as warnings so that sampling never drops them.
+        access_log.log(logging.WARNING if status >= 500 else logging.INFO, line, extra=fields)
+        if metrics is not None:
+            metrics.requests.labels(path, endpoint, metrics.model_label(model), str(status)).inc()
+            metrics.duration.labels(path, endpoint).observe(duration)
+        if tracer is not None:
+            end_ns = time.time_ns()
+            span = tracer.start_span(f"{method} {path}", start_time=end_ns - int(duration * 1e9))
+            span.set_attribute("http.request.method", method)
+            span.set_attribute("http.route", path)
+            span.set_attribute("http.response.status_code", status)
+            span.set_attribute("relay.endpoint", endpoint)
+            if model:
+                span.set_attribute("gen_ai.request.model", model)
+            span.end(end_time=end_ns)
+
+    def _request_budget(config: RelayConfig) -> float:
+        """Seconds the client is willing to wait: X-Relay-Timeout, capped by request_timeout."""
+        try:
+            requested = float(request.headers.get("X-Relay-Timeout", ""))
+        except ValueError:
+            return config.request_timeout
+        if requested <= 0:
+            return config.request_timeout
+        return min(requested, config.request_timeout)
 
     def _error(message: str, error_type: str, status: int) -> tuple[Response, int]:
         return jsonify({"error": {"message": message, "type": error_type}}), status
 
-    def _parse_max_tokens(value: object) -> tuple[Optional[int], Optional[Response]]:
+    def _parse_max_tokens(value: object, config: RelayConfig) -> tuple[Optional[int], Optional[Response]]:
         if value is None:
             return config.limits.max_request_tokens, None
         try:
@@ -291,39 +2380,73 @@ def create_app(config: RelayConfig) -> Flask:
             return None, _error("max_tokens must be non-negative", "relay_error", 400)[0]
         return parsed, None
 
-    def _upstream_headers(ep: EndpointConfig) -> dict[str, str]:
-        prefix = ep.auth_prefix
-        auth_value = f"{prefix} {ep.api_key}".strip() if prefix else ep.api_key
-        headers: dict[str, str] = {ep.auth_header: auth_value, "Content-Type": "application/json"}
-        accept = request.headers.get("Accept")
-        if accept:
-            headers["Accept"] = accept
-        headers.update(ep.extra_headers)
-        return headers
-
     # -----------------------------------------------------------------------
     # Authentication
     # -----------------------------------------------------------------------
 
-    def _check_auth() -> Optional[Response]:
-        if not config.relay_password:
+    def _check_auth(auth: ClientAuth) -> Optional[Response]:
+        if not auth.required:
             return None  # open relay
-        auth_header = request.headers.get("Authorization", "")
-        if not auth_header.startswith("Bearer "):
+        if not request.headers.get("Authorization", "").startswith("Bearer "):
             return _error("Missing or invalid Authorization header", "relay_auth_error", 401)[0]
-        token = auth_header[len("Bearer "):]
-        if token != config.relay_password:
-            return _error("Invalid relay password", "relay_auth_error", 401)[0]
+        if g.get("relay_client") is None:  # verified by _identify_client
+            return _error("Invalid relay password or API key", "relay_auth_error", 401)[0]
         return None
 
     # -----------------------------------------------------------------------
     # Health
     # -----------------------------------------------------------------------
 
+    if metrics is not None:
+
+        @app.route("/metrics")
+        @limiter.exempt
+        def prometheus_metrics() -> tuple[Response, int] | Response:
+            auth_err = _check_auth(state.runtime.auth)
+            if auth_err:
+                return auth_err, 401
+            return Response(metrics.render(), content_type=CONTENT_TYPE_LATEST)
+
+    if ledger is not None:
+
+        @app.route("/usage")
+        def usage() -> tuple[Response, int] | Response:
+            # Only the admin key sees everyone's usage.  Anyone else must be
+            # authenticated and sees their own: a client key its client, the
+            # shared relay_password its IP.  An open relay serves no usage.
+            auth_header = request.headers.get("Authorization", "")
+            token = auth_header[len("Bearer "):] if auth_header.startswith("Bearer ") else ""
+            admin = bool(usage_admin_sha256 and token) and hmac.compare_digest(
+                hash_api_key(token), usage_admin_sha256
+            )
+            if not admin:
+                if not state.runtime.auth.required:
+                    return _error("Usage requires relay authentication", "relay_auth_error", 403)
+                auth_err = _check_auth(state.runtime.auth)
+                if auth_err:
+                    return auth_err, 401
+            by = request.args.get("by", "client")
+            if by not in USAGE_GROUPINGS:
+                return _error(f"'by' must be one of: {', '.join(USAGE_GROUPINGS)}", "relay_error", 400)
+            try:
+                hours = float(request.args.get("hours", 24))
+            except ValueError:
+                return _error("'hours' must be a number", "relay_error", 400)
+            rows = ledger.aggregate(time.time() - hours * 3600, by=by, client=None if admin else _client_id())
+            return jsonify({"by": by, "hours": hours, "data": rows})
+
     @app.route("/health")
     @limiter.exempt
     def health() -> Response:
-        return jsonify({"ok": True, "endpoints": len(config.endpoints)})
+        rt = state.runtime
+        status: dict = {"ok": True, "endpoints": len(rt.config.endpoints)}
+        if rt.response_cache is not None:
+            status["cache"] = rt.response_cache.stats()
+        if rt.limiters:
+            status["queues"] = {
+                name: {"in_flight": lim.in_flight, "waiting": lim.depth} for name, lim in rt.limiters.items()
+            }
+        return jsonify(status)
 
     # -----------------------------------------------------------------------
     # Models
@@ -331,135 +2454,458 @@ def create_app(config: RelayConfig) -> Flask:
 
     @app.route("/v1/models", methods=["GET"])
     def models() -> tuple[Response, int] | Response:
-        auth_err = _check_auth()
+        rt = state.runtime
+        config = rt.config
+        auth_err = _check_auth(rt.auth)
         if auth_err:
             return auth_err, 401
 
         if not config.enable_models_proxy:
             return _error("Models endpoint disabled", "relay_error", 404)
 
-        ep = find_endpoint(config.endpoints)
-        if ep is None:
-            return _error("No endpoint configured", "relay_routing_error", 500)
+        # X-Relay-Endpoint narrows the merged list to one endpoint's models
+        target_url = request.headers.get("X-Relay-Endpoint", "").strip() or None
+        ep = config.routing.match(target_url) if target_url else None
+        if target_url and ep is None:
+            return _error(
+                f"No configured endpoint matches upstream URL '{target_url}'",
+                "relay_routing_error",
+                400,
+            )
 
-        url = f"{ep.url}/models"
         start = time.monotonic()
-        try:
-            resp = requests.get(url, headers=_upstream_headers(ep), timeout=config.request_timeout)
-            _log("GET", "/v1/models", resp.status_code, time.monotonic() - start)
-            return Response(
-                resp.content,
-                status=resp.status_code,
-                content_type=resp.headers.get("Content-Type", "application/json"),
-            )
-        except requests.Timeout:
-            _log("GET", "/v1/models", 504, time.monotonic() - start)
-            return _error("Upstream timeout", "relay_error", 504)
-        except requests.ConnectionError:
-            _log("GET", "/v1/models", 502, time.monotonic() - start)
-            return _error("Upstream connection failed", "relay_error", 502)
+        data, cache_state = rt.models.get()
+        if data is None:
+            status = 504 if isinstance(rt.models.last_error, requests.Timeout) else 502
+            _log("GET", "/v1/models", status, time.monotonic() - start)
+            message = "Upstream timeout" if status == 504 else "Upstream models request failed"
+            return _error(message, "relay_error", status)
+        if ep is not None:
+            data = [model for model in data if model["relay_endpoint_url"] == ep.url]
+        _log("GET", "/v1/models", 200, time.monotonic() - start, endpoint="" if cache_state == "MISS" else "cache")
+        resp = jsonify({"object": "list", "data": data})
+        resp.headers["X-Relay-Cache"] = cache_state
+        return resp
 
     # -----------------------------------------------------------------------
     # Generic POST proxy
     # -----------------------------------------------------------------------
 
     def _proxy_post(upstream_path: str) -> tuple[Response, int] | Response:
-        auth_err = _check_auth()
+        rt = state.runtime  # held for the whole request, including a stream
+        config = rt.config
+        response_cache = rt.response_cache
+        limiters = rt.limiters
+        auth_err = _check_auth(rt.auth)
         if auth_err:
             return auth_err, 401
 
-        ip = _client_ip()
+        client = g.get("relay_client")
+        client_id = _client_id()
 
-        # Body size check
+        # Body size check: reject on Content-Length, else stop reading at the limit
         content_length = request.content_length
-        if content_length is not None and content_length > config.limits.max_request_bytes:
+        body = None
+        if content_length is None or content_length <= config.limits.max_request_bytes:
+            body = read_limited(request.stream, config.limits.max_request_bytes)
+        if body is None:
             return _error("Request body too large", "relay_error", 413)
 
-        body = request.get_data()
-        if len(body) > config.limits.max_request_bytes:
-            return _error("Request body too large", "relay_error", 413)
+        coding = request.headers.get("Content-Encoding", "").strip().lower()
+        if coding not in ("", "identity"):
+            if coding not in REQUEST_CODINGS:
+                return _error(f"Unsupported Content-Encoding '{coding}'", "relay_error", 415)
+            try:
+                body = decompress_body(body, coding, config.limits.max_request_bytes)
+            except ValueError as exc:
+                return _error(str(exc), "relay_error", 400)
+            if body is None:
+                return _error("Request body too large", "relay_error", 413)
 
         # Parse body for model, stream flag, and max_tokens
-        model: Optional[str] = None
-        is_stream = False
-        parsed: dict = {}
         try:
-            parsed = json.loads(body)
-            if not isinstance(parsed, dict):
-                return _error("Request body must be a JSON object", "relay_error", 400)
-            model = parsed.get("model")
-            if config.enable_streaming:
-                is_stream = bool(parsed.get("stream", False))
-        except json.JSONDecodeError:
+            json_body = JsonBody.parse(body)
+        except ValueError:
             return _error("Invalid JSON body", "relay_error", 400)
-
-        # Endpoint routing — match X-Relay-Endpoint URL, fall back to first endpoint
+        parsed = json_body.value
+        if not isinstance(parsed, dict):
+            return _error("Request body must be a JSON object", "relay_error", 400)
+        model: Optional[str] = parsed.get("model")
+        is_stream = config.enable_streaming and bool(parsed.get("stream", False))
+
+        # Endpoint routing — match X-Relay-Endpoint URL, fall back to first endpoint;
+        # the request is then served by the group of the matched endpoint
         target_url = request.headers.get("X-Relay-Endpoint", "").strip() or None
-        ep = find_endpoint(config.endpoints, target_url)
+        ep = config.routing.match(target_url)
         if ep is None:
             return _error(
                 f"No configured endpoint matches upstream URL '{target_url}'",
                 "relay_routing_error",
                 400,
             )
+        target = group_name(ep)
 
         # Token cap + daily limit
-        raw_max_tokens, token_parse_err = _parse_max_tokens(parsed.get("max_tokens"))
+        raw_max_tokens, token_parse_err = _parse_max_tokens(parsed.get("max_tokens"), config)
         if token_parse_err:
             return token_parse_err, 400
-        capped_tokens, token_ok = token_tracker.check_and_track(ip, raw_max_tokens)
+
+        # Response cache — served before the token tracker so hits cost no budget
+        entry_key: Optional[str] = None
+        if response_cache is not None and is_cacheable(upstream_path, parsed):
+            normalized = parsed
+            if "max_tokens" in parsed:
+                normalized = {**parsed, "max_tokens": min(raw_max_tokens, config.limits.max_request_tokens)}
+            entry_key = cache_key(target, upstream_path, normalized)
+            start = time.monotonic()
+            hit = response_cache.get(entry_key)
+            if hit is not None:
+                _log("POST", upstream_path, 200, time.monotonic() - start, model, endpoint="cache")
+                return Response(hit[1], status=200, content_type=hit[0], headers={"X-Relay-Cache": "HIT"})
+
+        daily_limit = client.max_daily_tokens if client is not None and client.name else None
+        capped_tokens, token_ok = token_tracker.check_and_track(
+            client_id, raw_max_tokens, daily_limit, model=model, endpoint=ep.name
+        )
         if not token_ok:
-            return _error("Daily token limit exceeded for your IP", "token_limit_error", 429)
+            who = "API key" if client is not None and client.name else "IP"
+            return _error(f"Daily token limit exceeded for your {who}", "token_limit_error", 429)
+        if metrics is not None:
+            metrics.tokens.labels(ep.name, metrics.model_label(model)).inc(capped_tokens)
+            metrics.bytes_in.labels(ep.name).inc(len(body))
         if capped_tokens != raw_max_tokens:
+            body = json_body.with_value("max_tokens", capped_tokens)
             parsed["max_tokens"] = capped_tokens
-            body = json.dumps(parsed).encode()
 
-        url = f"{ep.url}{upstream_path}"
+        group = rt.endpoint_groups[target]
+        priority = PRIORITY_STREAM if is_stream else PRIORITY_SHORT
+        accept = request.headers.get("Accept")
+        deadline = time.monotonic() + _request_budget(config)
+        latency_key = f"{target}{upstream_path}"
+
+        def _remaining() -> float:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise requests.Timeout("client deadline exceeded")
+            return remaining
+
+        def _acquire(member: EndpointConfig) -> None:
+            member_limiter = limiters.get(member.name)
+            if member_limiter is None:
+                return
+            try:
+                # Never queue past the client's deadline
+                waited = member_limiter.acquire(
+                    client_id, priority, min(config.queue.timeout_seconds, _remaining())
+                )
+            except (QueueFull, requests.Timeout):
+                group.release(member, ok=None)
+                if metrics is not None:
+                    metrics.queue_rejected.labels(member.name).inc()
+                if deadline <= time.monotonic():
+                    raise requests.Timeout("client deadline exceeded") from None
+                raise
+            if metrics is not None:
+                metrics.queue_wait.labels(member.name).observe(waited)
+
+        def _has_slot(member: EndpointConfig) -> bool:
+            member_limiter = limiters.get(member.name)
+            return member_limiter is None or member_limiter.has_free_slot
+
+        def _release(member: EndpointConfig, ok: bool) -> None:
+            group.release(member, ok)
+            member_limiter = limiters.get(member.name)
+            if member_limiter is not None:
+                member_limiter.release()
+
+        def _send(payload: bytes, tried: set[str]) -> tuple[requests.Response, EndpointConfig]:
+            """POST to a group member, failing over on 5xx and connection errors.
+
+            Members already in *tried* are skipped, and every member attempted
+            is added to it; a member whose queue is full is skipped without
+            counting as an attempt.  Non-streaming members are released here;
+            for streams the caller releases the returned member once the
+            stream has finished.
+            """
+            queue_full = 0  # members skipped because their queue was full
+            while True:
+                member = group.acquire(tried, _has_slot)
+                if member is None:
+                    raise requests.ConnectionError("no untried group member left")
+                tried.add(member.name)
+                try:
+                    _acquire(member)
+                except QueueFull:
+                    if len(tried) < group.size:
+                        log.warning("endpoint=%s queue full, trying next group member", member.name)
+                        queue_full += 1
+                        continue
+                    raise
+                try:
+                    attempt_timeout = _remaining()  # what is left after queueing for the slot
+                except requests.Timeout:
+                    _release(member, ok=None)
+                    raise
+                can_retry = len(tried) < min(group.size, config.load_balancing.max_attempts + queue_full)
+                headers = _upstream_headers(member, accept)
+                data = payload
+                if member.compress_requests and len(payload) >= config.compression.min_bytes:
+                    data = gzip.compress(payload, compresslevel=config.compression.level)
+                    headers["Content-Encoding"] = "gzip"
+                attempt_start = time.monotonic()
+                _connect_timing.seconds = None
+                try:
+                    resp = rt.session.post(
+                        f"{member.url}{upstream_path}",
+                        headers=headers,
+                        data=data,
+                        timeout=attempt_timeout,
+                        stream=is_stream,
+                    )
+                except requests.ConnectionError:
+                    _release(member, ok=False)
+                    if metrics is not None:
+                        metrics.upstream_errors.labels(member.name, "connection").inc()
+                    if can_retry:
+                        log.warning("endpoint=%s connection failed, trying next group member", member.name)
+                        continue
+                    raise
+                except requests.RequestException as exc:
+                    _release(member, ok=False)
+                    if metrics is not None:
+                        metrics.upstream_errors.labels(member.name, "timeout" if isinstance(exc, requests.Timeout) else "other").inc()
+                    raise
+                if metrics is not None:
+                    if _connect_timing.seconds is not None:  # None when a pooled connection was reused
+                        metrics.upstream_connect.labels(member.name).observe(_connect_timing.seconds)
+                    metrics.upstream_headers.labels(member.name).observe(resp.elapsed.total_seconds())
+                    metrics.upstream_status(member.name, resp.status_code)
+                ok = resp.status_code < 500
+                if not ok and can_retry:
+                    log.warning("endpoint=%s status=%d, trying next group member", member.name, resp.status_code)
+                    resp.close()
+                    _release(member, ok=False)
+                    continue
+                if not is_stream:
+                    _release(member, ok)
+                    if resp.status_code < 400:
+                        latencies.record(latency_key, time.monotonic() - attempt_start)
+                return resp, member
+
+        def _send_hedged(payload: bytes) -> tuple[requests.Response, EndpointConfig]:
+            """Like _send, but fire a second attempt at another group member if
+            the first is slower than the observed latency quantile."""
+            retry_cfg = config.retry
+            hedge_after = None
+            if retry_cfg.hedge and not is_stream and group.size > 1:
+                hedge_after = latencies.quantile(latency_key, retry_cfg.hedge_quantile, retry_cfg.hedge_min_samples)
+            tried: set[str] = set()
+            if hedge_after is None:
+                return _send(payload, tried)
+
+            results: queue.Queue = queue.Queue()
+
+            def attempt(is_hedge: bool) -> None:
+                try:
+                    results.put((is_hedge, _send(payload, tried), None))
+                except Exception as exc:  # handed to the waiting request thread
+                    results.put((is_hedge, None, exc))
+
+            threading.Thread(target=attempt, args=(False,), daemon=True).start()
+            pending = 1
+            hedged = False
+            try:
+                outcome = results.get(timeout=min(hedge_after, _remaining()))
+            except queue.Empty:
+                if len(tried) < group.size:
+                    threading.Thread(target=attempt, args=(True,), daemon=True).start()
+                    pending += 1
+                    hedged = True
+                outcome = None
+            while True:
+                if outcome is None:
+                    try:
+                        outcome = results.get(timeout=_remaining())
+                    except queue.Empty:
+                        raise requests.Timeout("client deadline exceeded") from None
+                pending -= 1
+                is_hedge, sent, error = outcome
+                usable = sent is not None and sent[0].status_code < 500
+                if usable or pending == 0:
+                    if hedged and metrics is not None:
+                        metrics.hedges.labels(ep.name, "hedge" if is_hedge else "primary").inc()
+                    if error is not None:
+                        raise error
+                    return sent
+                outcome = None
+
+        def _send_with_retries(payload: bytes) -> tuple[requests.Response, EndpointConfig]:
+            """Retry non-streaming calls with jittered backoff within the deadline.
+
+            Only deterministic requests are sent again after a failure the
+            provider may have run; sampled ones only when it turned them away.
+            """
+            retry_cfg = config.retry
+            idempotent = is_deterministic(upstream_path, parsed)
+            attempt = 0
+            while True:
+                retries_left = not is_stream and attempt < retry_cfg.max_retries
+                try:
+                    resp, member = _send_hedged(payload)
+                except requests.ConnectionError as exc:
+                    if not retries_left or not idempotent:
+                        raise
+                    delay, failed_member, error = backoff_delay(attempt, retry_cfg), ep, exc
+                else:
+                    retryable = resp.status_code in retry_cfg.retry_on_status and (
+                        idempotent or resp.status_code in UNPROCESSED_STATUSES
+                    )
+                    if not retries_left or not retryable:
+                        return resp, member
+                    delay = backoff_delay(attempt, retry_cfg, resp.headers.get("Retry-After"))
+                    failed_member, error = member, None
+                if time.monotonic() + delay >= deadline:
+                    if error is not None:
+                        raise error
+                    return resp, member
+                if metrics is not None:
+                    metrics.retries.labels(failed_member.name).inc()
+                time.sleep(delay)
+                attempt += 1
+
+        def _send_batch(merged: Optional[list]) -> UpstreamResult:
+            payload = body if merged is None else json.dumps({**parsed, "input": merged}).encode()
+            resp, _ = _send_with_retries(payload)
+            return resp.status_code, resp.headers.get("Content-Type", "application/json"), resp.content
+
+        batch_inputs: Optional[list] = None
+        if rt.embedding_batcher is not None and upstream_path == "/embeddings" and not is_stream:
+            batch_inputs = embedding_inputs(parsed.get("input"))
+
+        # Identical deterministic requests in flight share one upstream call
+        flight_key: Optional[str] = None
+        if rt.single_flight is not None and is_deterministic(upstream_path, parsed):
+            flight_key = cache_key(target, upstream_path, parsed)
+
+        def _fetch() -> tuple[UpstreamResult, EndpointConfig]:
+            if batch_inputs is not None:
+                result = rt.embedding_batcher.submit(
+                    batch_key(target, parsed, batch_inputs), batch_inputs, _send_batch, _remaining()
+                )
+                return result, ep
+            resp, member = _send_with_retries(body)
+            return (resp.status_code, resp.headers.get("Content-Type", "application/json"), resp.content), member
+
+        def _open_stream() -> StreamTee:
+            resp, member = _send_with_retries(body)
+
+            def done() -> None:
+                resp.close()
+                _release(member, ok=resp.status_code < 500)
+                rt.single_flight.forget(flight_key, tee)
+
+            tee = StreamTee(
+                resp.status_code,
+                resp.headers.get("Content-Type", "text/event-stream"),
+                resp.iter_content(chunk_size=None),
+                done,
+                config.coalescing.max_stream_buffer_bytes,
+                endpoint=member.name,
+            )
+            return tee
+
         start = time.monotonic()
+        member = ep  # actual group member, once known
+        upstream_resp: Optional[requests.Response] = None
+        tee: Optional[StreamTee] = None
+        tee_chunks: Optional[Iterator[bytes]] = None
+        shared = False
         try:
-            upstream_resp = requests.post(
-                url,
-                headers=_upstream_headers(ep),
-                data=body,
-                timeout=config.request_timeout,
-                stream=is_stream,
-            )
-        except requests.Timeout:
-            _log("POST", upstream_path, 504, time.monotonic() - start, model)
+            joined = None
+            if is_stream and flight_key is not None:
+                joined = rt.single_flight.stream(flight_key, _open_stream, _remaining())
+            if joined is not None:
+                tee, tee_chunks, shared = joined
+            elif is_stream:  # not coalesced, or the shared stream stopped accepting clients
+                upstream_resp, member = _send_with_retries(body)
+            elif flight_key is not None:
+                ((status, content_type, content), member), shared = rt.single_flight.do(
+                    flight_key, _fetch, _remaining()
+                )
+            else:
+                (status, content_type, content), member = _fetch()
+        except QueueFull:
+            _log("POST", upstream_path, 503, time.monotonic() - start, model, ep.name)
+            resp, status = _error("Upstream busy, please retry later", "relay_overloaded_error", 503)
+            resp.headers["Retry-After"] = "1"
+            return resp, status
+        except (requests.Timeout, TimeoutError):
+            _log("POST", upstream_path, 504, time.monotonic() - start, model, ep.name)
             return _error("Upstream timeout", "relay_error", 504)
         except requests.ConnectionError:
-            _log("POST", upstream_path, 502, time.monotonic() - start, model)
+            _log("POST", upstream_path, 502, time.monotonic() - start, model, ep.name)
             return _error("Upstream connection failed", "relay_error", 502)
         except requests.RequestException:
-            _log("POST", upstream_path, 502, time.monotonic() - start, model)
+            _log("POST", upstream_path, 502, time.monotonic() - start, model, ep.name)
             return _error("Upstream request failed", "relay_error", 502)
+        if shared and metrics is not None:
+            metrics.coalesced.labels(ep.name, "stream" if is_stream else "request").inc()
 
         if is_stream:
-            content_type = upstream_resp.headers.get("Content-Type", "text/event-stream")
-            status = upstream_resp.status_code
+            if tee is not None:
+                status, content_type, member_name = tee.status, tee.content_type, tee.endpoint
+                chunks: Iterable[bytes] = tee_chunks
+            else:
+                status, member_name = upstream_resp.status_code, member.name
+                content_type = upstream_resp.headers.get("Content-Type", "text/event-stream")
+                chunks = upstream_resp.iter_content(chunk_size=None)
+            if config.streaming.flush_interval_ms > 0 and content_type.startswith("text/event-stream"):
+                chunks = coalesce_sse(chunks, config.streaming)
 
             def generate():
+                first_byte_at: Optional[float] = None
+                sent = 0
+                if metrics is not None:
+                    metrics.streams_in_flight.inc()
                 try:
-                    for chunk in upstream_resp.iter_content(chunk_size=None):
+                    for chunk in chunks:
                         if chunk:
+                            if first_byte_at is None:
+                                first_byte_at = time.monotonic()
+                            sent += len(chunk)
                             yield chunk
                 finally:
-                    upstream_resp.close()
-                    _log("POST", upstream_path, status, time.monotonic() - start, model)
-
+                    if upstream_resp is not None:  # a coalesced stream is released by its tee
+                        upstream_resp.close()
+                        _release(member, ok=status < 500)
+                    end = time.monotonic()
+                    if metrics is not None:
+                        metrics.streams_in_flight.dec()
+                        metrics.bytes_out.labels(member_name).inc(sent)
+                        if first_byte_at is not None:
+                            metrics.ttfb.labels(upstream_path, member_name).observe(first_byte_at - start)
+                            metrics.stream_duration.labels(upstream_path, member_name).observe(end - first_byte_at)
+                    _log("POST", upstream_path, status, end - start, model, member_name)
+
+            # The generator runs after the view returns; keep request and g for _log.
             return Response(
-                generate(),
+                stream_with_context(generate()),
                 status=status,
                 content_type=content_type,
                 headers={"X-Accel-Buffering": "no"},
             )
 
-        _log("POST", upstream_path, upstream_resp.status_code, time.monotonic() - start, model)
-        return Response(
-            upstream_resp.content,
-            status=upstream_resp.status_code,
-            content_type=upstream_resp.headers.get("Content-Type", "application/json"),
-        )
+        duration = time.monotonic() - start
+        if metrics is not None:
+            metrics.ttfb.labels(upstream_path, member.name).observe(duration)
+            metrics.bytes_out.labels(member.name).inc(len(content))
+        _log("POST", upstream_path, status, duration, model, member.name)
+        headers: dict[str, str] = {}
+        if entry_key is not None:
+            headers["X-Relay-Cache"] = "MISS"
+            if status == 200 and not shared:
+                response_cache.put(entry_key, content_type, content)
+        return Response(content, status=status, content_type=content_type, headers=headers)
 
     # -----------------------------------------------------------------------
     # Completion routes
@@ -492,6 +2938,7 @@ if __name__ == "__main__":
     config_path = os.environ.get("CONFIG_PATH", "config.yaml")
     cfg = load_config(config_path)
     flask_app = create_app(cfg)
+    ConfigWatcher(flask_app, config_path, float(os.environ.get("CONFIG_RELOAD_INTERVAL", "5"))).start()
     host = os.environ.get("HOST", "0.0.0.0")
     port = int(os.environ.get("PORT", "8080"))
     logging.getLogger(__name__).info("MC Relay starting on %s:%d (development server)", host, port)
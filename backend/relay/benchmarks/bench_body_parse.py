@@ -0,0 +1,56 @@
+"""
+Request body micro-benchmark.
+
+Compares the previous max_tokens capping path (``json.loads`` followed by a
+full ``json.dumps``) with JsonBody, which decodes once and splices the capped
+value into the original bytes.
+
+Usage (from backend/relay/):
+    python benchmarks/bench_body_parse.py [--repeat 20]
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import JsonBody  # noqa: E402
+
+
+def make_body(target_bytes: int) -> bytes:
+    message = {"role": "user", "content": "Generate a JSON schema for this example. " * 20}
+    count = max(1, target_bytes // len(json.dumps(message)))
+    return json.dumps({"model": "gpt-4o", "messages": [message] * count, "max_tokens": 99999}).encode()
+
+
+def loads_dumps(body: bytes) -> bytes:
+    parsed = json.loads(body)
+    parsed["max_tokens"] = 1000
+    return json.dumps(parsed).encode()
+
+
+def splice(body: bytes) -> bytes:
+    return JsonBody.parse(body).with_value("max_tokens", 1000)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'body KiB':>9} {'loads+dumps ms':>15} {'JsonBody ms':>12}")
+    for size in (16 * 1024, 256 * 1024, 1024 * 1024, 2 * 1024 * 1024):
+        body = make_body(size)
+        assert json.loads(loads_dumps(body)) == json.loads(splice(body))
+        old = timeit.timeit(lambda: loads_dumps(body), number=args.repeat) / args.repeat
+        new = timeit.timeit(lambda: splice(body), number=args.repeat) / args.repeat
+        print(f"{len(body) // 1024:>9} {old * 1e3:>15.2f} {new * 1e3:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+"""
+End-to-end relay load benchmark.
+
+Starts benchmarks/fake_upstream.py and the relay under Gunicorn (or uses an
+already running relay via --relay-url, whose upstream settings should match
+the --latency-ms/--token-interval-ms given here), then drives it with concurrent
+clients in two phases:
+
+  stream   many concurrent SSE completions: time to first token (TTFT),
+           inter-token gaps and their overhead over the upstream's own
+           token interval, relay CPU time and resident memory per stream
+  request  concurrent non-streaming completions: throughput and latency
+
+Compare server modes with --mode:
+  gevent   one gevent worker (the Docker default)
+  gthread  one worker with --threads OS threads
+  sync     --workers pre-forked synchronous workers
+
+--slow-log-ms makes the relay's stdout a slow log sink (each line is read
+that long after the previous one) and logs every request; compare
+--log-queue-size 0 (lines written on the request path) with e.g. 10000
+(lines written by a background thread).
+
+CPU and memory are read from /proc for the relay process tree (Linux only;
+reported as n/a with --relay-url or elsewhere).
+
+Usage (from backend/relay/):
+    python benchmarks/bench_load.py [--mode gevent] [--concurrency 50] [--duration 10]
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Optional
+
+import requests
+import yaml
+
+RELAY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# ---------------------------------------------------------------------------
+# Processes
+# ---------------------------------------------------------------------------
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until_up(url: str, timeout: float = 20.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise SystemExit(f"{url} did not come up within {timeout:.0f}s")
+
+
+def start_upstream(args: argparse.Namespace) -> tuple[subprocess.Popen, str]:
+    port = _free_port()
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(RELAY_DIR, "benchmarks", "fake_upstream.py"),
+            f"--port={port}",
+            f"--latency-ms={args.latency_ms}",
+            f"--tokens={args.tokens}",
+            f"--token-interval-ms={args.token_interval_ms}",
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}/v1"
+    _wait_until_up(f"{url}/models")
+    return proc, url
+
+
+def _drain_slowly(pipe, delay: float) -> None:
+    for _ in pipe:
+        time.sleep(delay)
+
+
+def start_relay(args: argparse.Namespace, upstream_url: str, workdir: str) -> tuple[subprocess.Popen, str]:
+    config_path = os.path.join(workdir, "config.yaml")
+    with open(config_path, "w") as fh:
+        yaml.safe_dump(
+            {
+                "endpoints": [{"name": "fake", "url": upstream_url, "api_key": "bench"}],
+                "rate_limits": {"enabled": False},
+                "limits": {"max_request_tokens": 1 << 20, "max_daily_tokens_per_ip": 0},
+                "log_level": "INFO" if args.slow_log_ms > 0 else "WARNING",
+                "logging": {"queue_size": args.log_queue_size},
+            },
+            fh,
+        )
+    worker_args = {
+        "gevent": ["--worker-class", "gevent", "--workers", "1", "--worker-connections", "10000"],
+        "gthread": ["--worker-class", "gthread", "--workers", "1", "--threads", str(args.threads)],
+        "sync": ["--worker-class", "sync", "--workers", str(args.workers)],
+    }[args.mode]
+    port = _free_port()
+    gunicorn = shutil.which("gunicorn") or "gunicorn"
+    proc = subprocess.Popen(
+        [gunicorn, "--bind", f"127.0.0.1:{port}", "--timeout", "300", *worker_args, "wsgi:application"],
+        cwd=RELAY_DIR,
+        env={**os.environ, "CONFIG_PATH": config_path, "CONFIG_RELOAD_INTERVAL": "0"},
+        stdout=subprocess.PIPE if args.slow_log_ms > 0 else subprocess.DEVNULL,
+    )
+    if args.slow_log_ms > 0:
+        threading.Thread(target=_drain_slowly, args=(proc.stdout, args.slow_log_ms / 1000), daemon=True).start()
+    url = f"http://127.0.0.1:{port}"
+    _wait_until_up(f"{url}/health")
+    return proc, url
+
+
+# ---------------------------------------------------------------------------
+# Relay CPU and memory (/proc)
+# ---------------------------------------------------------------------------
+
+
+def _process_tree(pid: int) -> list[int]:
+    pids, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        pids.append(current)
+        try:
+            with open(f"/proc/{current}/task/{current}/children") as fh:
+                pending.extend(int(child) for child in fh.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def cpu_seconds(pid: Optional[int]) -> Optional[float]:
+    if pid is None or not os.path.exists(f"/proc/{pid}"):
+        return None
+    ticks = 0
+    for p in _process_tree(pid):
+        try:
+            with open(f"/proc/{p}/stat") as fh:
+                fields = fh.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        ticks += int(fields[11]) + int(fields[12])  # utime + stime
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+
+def rss_bytes(pid: Optional[int]) -> Optional[int]:
+    if pid is None or not os.path.exists(f"/proc/{pid}"):
+        return None
+    total = 0
+    for p in _process_tree(pid):
+        try:
+            with open(f"/proc/{p}/status") as fh:
+                for line in fh:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total
+
+
+class PeakRss:
+    """Sample the relay's resident memory in the background and keep the peak."""
+
+    def __init__(self, pid: Optional[int], interval: float = 0.1):
+        self.peak = rss_bytes(pid)
+        self._pid = pid
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self) -> PeakRss:
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._interval):
+            rss = rss_bytes(self._pid)
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+
+
+# ---------------------------------------------------------------------------
+# Load phases
+# ---------------------------------------------------------------------------
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _run_clients(concurrency: int, duration: float, one_call) -> float:
+    """Run *one_call(session)* in a loop on *concurrency* threads; return elapsed seconds."""
+    stop_at = time.monotonic() + duration
+    start = time.monotonic()
+
+    def client() -> None:
+        with requests.Session() as session:
+            while time.monotonic() < stop_at:
+                one_call(session)
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.monotonic() - start
+
+
+def stream_phase(relay_url: str, args: argparse.Namespace, pid: Optional[int]) -> None:
+    ttfts: list[float] = []
+    gaps: list[float] = []
+    errors = [0]
+    streams = [0]
+    lock = threading.Lock()
+    body = {"model": "fake-model", "messages": [{"role": "user", "content": "hi"}], "stream": True}
+
+    def one_stream(session: requests.Session) -> None:
+        start = time.monotonic()
+        stream_ttft: Optional[float] = None
+        stream_gaps: list[float] = []
+        last: Optional[float] = None
+        try:
+            with session.post(f"{relay_url}/v1/chat/completions", json=body, stream=True, timeout=300) as resp:
+                if resp.status_code != 200:
+                    raise requests.HTTPError(resp.status_code)
+                for chunk in resp.iter_content(chunk_size=None):
+                    now = time.monotonic()
+                    for _ in range(chunk.count(b"data: ")):
+                        if last is None:
+                            stream_ttft = now - start
+                        else:
+                            stream_gaps.append(now - last)
+                        last = now
+        except requests.RequestException:
+            with lock:
+                errors[0] += 1
+            return
+        with lock:
+            streams[0] += 1
+            if stream_ttft is not None:
+                ttfts.append(stream_ttft)
+            gaps.extend(stream_gaps[:-1])  # the last gap is to [DONE], which the upstream sends immediately
+
+    cpu_before = cpu_seconds(pid)
+    with PeakRss(pid) as memory:
+        baseline_rss = memory.peak
+        elapsed = _run_clients(args.concurrency, args.duration, one_stream)
+    cpu_after = cpu_seconds(pid)
+
+    interval = args.token_interval_ms / 1000
+    print(f"\nstream phase: {args.concurrency} concurrent streams for {elapsed:.1f}s")
+    print(f"  completed streams     {streams[0]} ({streams[0] / elapsed:.1f}/s), errors {errors[0]}")
+    print(f"  TTFT ms               p50 {_percentile(ttfts, .5) * 1e3:.1f}  p99 {_percentile(ttfts, .99) * 1e3:.1f}"
+          f"  (upstream latency {args.latency_ms:.0f})")
+    if gaps:
+        overhead = (statistics.fmean(gaps) - interval) * 1e3
+        print(f"  inter-token gap ms    p50 {_percentile(gaps, .5) * 1e3:.2f}  p99 {_percentile(gaps, .99) * 1e3:.2f}"
+              f"  (upstream {args.token_interval_ms:.0f}, mean overhead {overhead:+.2f})")
+    if cpu_before is not None and cpu_after is not None and streams[0]:
+        print(f"  relay CPU per stream  {(cpu_after - cpu_before) / streams[0] * 1e3:.2f} ms")
+    if baseline_rss is not None and memory.peak is not None:
+        per_stream = (memory.peak - baseline_rss) / args.concurrency
+        print(f"  relay RSS             peak {memory.peak / 2**20:.1f} MiB, {per_stream / 1024:.1f} KiB per open stream")
+    else:
+        print("  relay CPU / RSS       n/a")
+
+
+def request_phase(relay_url: str, args: argparse.Namespace, pid: Optional[int]) -> None:
+    latencies: list[float] = []
+    errors = [0]
+    lock = threading.Lock()
+    body = {"model": "fake-model", "messages": [{"role": "user", "content": "hi"}]}
+
+    def one_request(session: requests.Session) -> None:
+        start = time.monotonic()
+        try:
+            resp = session.post(f"{relay_url}/v1/chat/completions", json=body, timeout=300)
+            ok = resp.status_code == 200
+        except requests.RequestException:
+            ok = False
+        with lock:
+            if ok:
+                latencies.append(time.monotonic() - start)
+            else:
+                errors[0] += 1
+
+    cpu_before = cpu_seconds(pid)
+    elapsed = _run_clients(args.concurrency, args.duration, one_request)
+    cpu_after = cpu_seconds(pid)
+
+    print(f"\nrequest phase: {args.concurrency} concurrent clients for {elapsed:.1f}s")
+    print(f"  throughput            {len(latencies) / elapsed:.1f} req/s, errors {errors[0]}")
+    print(f"  latency ms            p50 {_percentile(latencies, .5) * 1e3:.1f}"
+          f"  p99 {_percentile(latencies, .99) * 1e3:.1f}  (upstream {args.latency_ms:.0f})")
+    if cpu_before is not None and cpu_after is not None and latencies:
+        print(f"  relay CPU per request {(cpu_after - cpu_before) / len(latencies) * 1e3:.2f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("gevent", "gthread", "sync"), default="gevent")
+    parser.add_argument("--workers", type=int, default=4, help="worker processes for --mode sync")
+    parser.add_argument("--threads", type=int, default=64, help="threads for --mode gthread")
+    parser.add_argument("--relay-url", help="benchmark a running relay instead of starting one")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--phase", choices=("all", "stream", "request"), default="all")
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--tokens", type=int, default=64)
+    parser.add_argument("--token-interval-ms", type=float, default=20)
+    parser.add_argument("--log-queue-size", type=int, default=0, help="relay logging.queue_size")
+    parser.add_argument("--slow-log-ms", type=float, default=0, help="read the relay's stdout this slowly")
+    args = parser.parse_args()
+
+    procs: list[subprocess.Popen] = []
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            pid: Optional[int] = None
+            relay_url = args.relay_url
+            if relay_url is None:
+                upstream, upstream_url = start_upstream(args)
+                procs.append(upstream)
+                relay, relay_url = start_relay(args, upstream_url, workdir)
+                procs.append(relay)
+                pid = relay.pid
+            print(f"relay {relay_url} (mode {args.mode if args.relay_url is None else 'external'})")
+            if args.phase in ("all", "stream"):
+                stream_phase(relay_url, args, pid)
+            if args.phase in ("all", "request"):
+                request_phase(relay_url, args, pid)
+        finally:
+            for proc in reversed(procs):
+                proc.terminate()
+                proc.wait(timeout=10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Routing micro-benchmark.
+
+Compares the precompiled RoutingTable against the previous linear
+`rstrip` + `startswith` scan as the number of configured endpoints grows.
+The table's per-lookup cost should stay flat; the scan grows linearly.
+
+Usage (from backend/relay/):
+    python benchmarks/bench_routing.py [--lookups 20000]
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import timeit
+from typing import Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import EndpointConfig, RoutingTable  # noqa: E402
+
+
+def linear_scan(endpoints: list[EndpointConfig], target_url: str) -> Optional[EndpointConfig]:
+    normalized = target_url.rstrip("/")
+    for ep in endpoints:
+        if normalized == ep.url or normalized.startswith(ep.url + "/"):
+            return ep
+    return None
+
+
+def make_endpoints(count: int) -> list[EndpointConfig]:
+    return [
+        EndpointConfig(name=f"tenant-{i}", url=f"https://provider-{i}.example.com/v1", api_key="k")
+        for i in range(count)
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lookups", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"{'endpoints':>10} {'linear µs':>10} {'table µs':>10}")
+    for count in (1, 10, 50, 100, 500, 1000):
+        endpoints = make_endpoints(count)
+        table = RoutingTable(endpoints)
+        # Worst case for the scan: the last configured endpoint.
+        target = f"{endpoints[-1].url}/"
+        assert linear_scan(endpoints, target) is table.match(target)
+
+        linear = timeit.timeit(lambda: linear_scan(endpoints, target), number=args.lookups)
+        trie = timeit.timeit(lambda: table.match(target), number=args.lookups)
+        print(f"{count:>10} {linear / args.lookups * 1e6:>10.2f} {trie / args.lookups * 1e6:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Fake OpenAI-compatible upstream for relay benchmarks.
+
+Serves POST /v1/chat/completions (streamed or not), POST /v1/embeddings and
+GET /v1/models with a configurable response latency and SSE token rate, so
+that the relay's own overhead can be measured without a real provider.
+
+Usage (from backend/relay/):
+    python benchmarks/fake_upstream.py [--port 9100] [--tokens 64] [--token-interval-ms 20]
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+@dataclass
+class UpstreamProfile:
+    latency_ms: float = 50  # before the response headers
+    tokens: int = 64  # SSE events per streamed completion
+    token_interval_ms: float = 20  # between SSE events
+    token_text: str = "tok "
+
+
+def _handler(profile: UpstreamProfile) -> type[BaseHTTPRequestHandler]:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body are separate writes; with Nagle on, each keep-alive
+        # response would wait ~40 ms for the client's delayed ACK.
+        disable_nagle_algorithm = True
+
+        def log_message(self, format: str, *args: object) -> None:  # keep benchmark output clean
+            pass
+
+        def _send_json(self, payload: dict) -> None:
+            body = json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self) -> None:
+            if self.path.rstrip("/").endswith("/models"):
+                self._send_json({"object": "list", "data": [{"id": "fake-model", "object": "model"}]})
+            else:
+                self.send_error(404)
+
+        def do_POST(self) -> None:
+            length = int(self.headers.get("Content-Length") or 0)
+            request = json.loads(self.rfile.read(length) or b"{}")
+            time.sleep(profile.latency_ms / 1000)
+            if self.path.endswith("/embeddings"):
+                inputs = request.get("input")
+                count = len(inputs) if isinstance(inputs, list) else 1
+                data = [{"object": "embedding", "index": i, "embedding": [0.0] * 8} for i in range(count)]
+                usage = {"prompt_tokens": count, "total_tokens": count}
+                self._send_json({"object": "list", "data": data, "usage": usage})
+            elif not self.path.endswith("/chat/completions"):
+                self.send_error(404)
+            elif request.get("stream"):
+                self._stream()
+            else:
+                message = {"role": "assistant", "content": profile.token_text * profile.tokens}
+                self._send_json({"object": "chat.completion", "choices": [{"index": 0, "message": message}]})
+
+        def _stream(self) -> None:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(profile.tokens):
+                if i:
+                    time.sleep(profile.token_interval_ms / 1000)
+                delta = {"choices": [{"index": 0, "delta": {"content": profile.token_text}}]}
+                self._chunk(f"data: {json.dumps(delta)}\n\n".encode())
+            self._chunk(b"data: [DONE]\n\n")
+            self._chunk(b"")
+
+        def _chunk(self, data: bytes) -> None:
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+    return Handler
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--tokens", type=int, default=64)
+    parser.add_argument("--token-interval-ms", type=float, default=20)
+    args = parser.parse_args()
+
+    profile = UpstreamProfile(latency_ms=args.latency_ms, tokens=args.tokens, token_interval_ms=args.token_interval_ms)
+    server = ThreadingHTTPServer((args.host, args.port), _handler(profile))
+    server.daemon_threads = True
+    print(f"fake upstream on http://{args.host}:{args.port}/v1 ({profile})")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 #!/usr/bin/env bash
 set -euo pipefail
 
-docker build -t mc-relay:latest .
+cd "$(dirname "$0")"
+docker build -t mc-relay:latest -f Dockerfile ..
 echo "Built mc-relay:latest"
@@ -1,6 +1,6 @@
 """
-pytest configuration — adds the relay/ directory to sys.path so that
-`from app import ...` works in tests without needing an installed package.
+pytest configuration — adds the relay/ and common/ directories to sys.path so
+that `from app import ...` works in tests without needing an installed package.
 """
 
 import sys
@@ -10,3 +10,8 @@ import os
 relay_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if relay_dir not in sys.path:
     sys.path.insert(0, relay_dir)
+
+# relay/tests/ -> common/ (log_pipeline.py, shared with snapshot_sharing)
+common_dir = os.path.join(os.path.dirname(relay_dir), "common")
+if common_dir not in sys.path:
+    sys.path.insert(0, common_dir)
@@ -111,7 +111,7 @@ run_test() {
 
 # ----------------------------------------------------------------
 test_dockerfile() {
-  docker build -t "$IMAGE" "$RELAY_DIR" || return 1
+  docker build -t "$IMAGE" -f "$RELAY_DIR/Dockerfile" "$RELAY_DIR/.." || return 1
   docker run -d \
     --name "mc-relay-df-$$" \
     -p 18090:8080 \
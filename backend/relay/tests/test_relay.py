@@ -5,18 +5,68 @@ Uses Flask test client for integration tests and the `responses` library to
 mock upstream HTTP calls without real network access.
 """
 
+import gzip
+import io
 import json
+import logging
+import queue
+import threading
+import time
 from typing import Any
 
+import pytest
 import responses as rsps_lib
 
+from log_pipeline import DroppingQueueHandler, JsonFormatter, SamplingFilter, configure_logging
+
 from app import (
+    BatchingConfig,
+    PRIORITY_SHORT,
+    PRIORITY_STREAM,
+    CacheConfig,
+    CoalescingConfig,
+    CompressionConfig,
+    ClientAuth,
+    ClientConfig,
+    ConcurrencyLimiter,
+    ConfigError,
+    ConfigWatcher,
+    EmbeddingBatcher,
     EndpointConfig,
+    EndpointGroup,
+    JsonBody,
+    LedgerConfig,
     LimitsConfig,
+    LoggingConfig,
+    LoadBalancingConfig,
+    MetricsConfig,
+    ModelsCache,
+    ModelsConfig,
+    QueueConfig,
+    QueueFull,
+    RetryConfig,
+    StreamingConfig,
     RateLimitConfig,
     RelayConfig,
+    ResponseCache,
+    RoutingTable,
+    SingleFlight,
+    StreamTee,
+    TokenTracker,
+    UsageLedger,
+    backoff_delay,
+    batch_key,
+    build_endpoint_groups,
+    cache_key,
+    coalesce_sse,
     create_app,
+    decompress_body,
+    embedding_inputs,
     find_endpoint,
+    hash_api_key,
+    is_cacheable,
+    parse_config,
+    read_limited,
 )
 
 # ---------------------------------------------------------------------------
@@ -146,6 +196,67 @@ def test_auth_error_has_relay_error_type():
     assert data["error"]["type"] == "relay_auth_error"
 
 
+def _bearer(token: str) -> dict:
+    return {"Authorization": f"Bearer {token}"}
+
+
+def test_client_keys_and_relay_password_both_accepted():
+    clients = [ClientConfig(name="team-a", key_sha256=hash_api_key("key-a"))]
+    app = create_app(make_config(relay_password="secret", clients=clients))
+    body = {"model": "m", "messages": []}
+    with rsps_lib.RequestsMock() as rsps, app.test_client() as client:
+        rsps.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"choices": []})
+        assert _post_json(client, "/v1/chat/completions", body, _bearer("key-a")).status_code == 200
+        assert _post_json(client, "/v1/chat/completions", body, _bearer("secret")).status_code == 200
+        assert _post_json(client, "/v1/chat/completions", body, _bearer("key-b")).status_code == 401
+
+
+def test_client_auth_caches_only_valid_tokens():
+    auth = ClientAuth("", [ClientConfig(name="team-a", key_sha256=hash_api_key("key-a"))], cache_size=1)
+    lookups: list[str] = []
+    original = auth._lookup
+    auth._lookup = lambda token: lookups.append(token) or original(token)
+
+    assert auth.verify("key-a").name == "team-a"
+    assert auth.verify("key-a").name == "team-a"
+    assert auth.verify("wrong") is None
+    assert auth.verify("wrong") is None
+    assert auth.verify("key-a").name == "team-a"
+    assert lookups == ["key-a", "wrong", "wrong"]
+
+
+def test_per_client_token_quota_and_rate_limit():
+    per_minute_1 = RateLimitConfig(enabled=True, requests_per_minute=1, requests_per_hour=100, requests_per_day=100)
+    clients = [
+        ClientConfig(name="small", key_sha256=hash_api_key("key-small"), max_daily_tokens=150),
+        ClientConfig(name="slow", key_sha256=hash_api_key("key-slow"), rate_limits=per_minute_1),
+        ClientConfig(name="other", key_sha256=hash_api_key("key-other")),
+    ]
+    app = create_app(make_config(clients=clients))
+    body = {"model": "m", "messages": [], "max_tokens": 100}
+    with rsps_lib.RequestsMock() as rsps, app.test_client() as client:
+        rsps.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"choices": []})
+        assert _post_json(client, "/v1/chat/completions", body, _bearer("key-small")).status_code == 200
+        over_quota = _post_json(client, "/v1/chat/completions", body, _bearer("key-small"))
+        assert over_quota.status_code == 429
+        assert "API key" in over_quota.get_json()["error"]["message"]
+
+        assert _post_json(client, "/v1/chat/completions", body, _bearer("key-slow")).status_code == 200
+        assert _post_json(client, "/v1/chat/completions", body, _bearer("key-slow")).status_code == 429
+        # Same IP, but quotas and limits are tracked per key.
+        assert _post_json(client, "/v1/chat/completions", body, _bearer("key-other")).status_code == 200
+
+
+def test_parse_config_rejects_plaintext_client_key(tmp_path):
+    path = tmp_path / "config.yaml"
+    path.write_text(
+        "endpoints: [{name: ep, url: 'https://x.example.com'}]\n"
+        "clients: [{name: team, key_sha256: not-a-digest}]\n"
+    )
+    with pytest.raises(ConfigError):
+        parse_config(str(path))
+
+
 # ===========================================================================
 # 3. Request forwarding
 # ===========================================================================
@@ -225,6 +336,32 @@ def test_url_routing_unknown_url_returns_none():
     assert find_endpoint([ep], "https://some-other-provider.com/v1") is None
 
 
+def test_url_routing_prefers_longest_prefix():
+    ep_base = EndpointConfig(name="base", url="https://gateway.example.com", api_key="k1")
+    ep_tenant = EndpointConfig(name="tenant", url="https://gateway.example.com/tenants/a/v1", api_key="k2")
+    endpoints = [ep_base, ep_tenant]
+    assert find_endpoint(endpoints, "https://gateway.example.com/tenants/a/v1/") is ep_tenant
+    assert find_endpoint(endpoints, "https://gateway.example.com/tenants/b/v1") is ep_base
+
+
+def test_url_routing_does_not_match_partial_segments():
+    ep = EndpointConfig(name="openai", url="https://api.openai.com/v1", api_key="k")
+    assert find_endpoint([ep], "https://api.openai.com/v10") is None
+
+
+def test_url_routing_normalizes_scheme_and_host_case():
+    ep = EndpointConfig(name="openai", url="https://api.openai.com/v1", api_key="k")
+    assert RoutingTable([ep]).match("HTTPS://API.OpenAI.com/v1") is ep
+
+
+def test_routing_table_compiled_on_config():
+    ep1 = EndpointConfig(name="first", url="https://a.example.com/v1", api_key="k1")
+    ep2 = EndpointConfig(name="second", url="https://b.example.com/v1", api_key="k2")
+    cfg = make_config(endpoints=[ep1, ep2])
+    assert cfg.routing.match() is ep1
+    assert cfg.routing.match("https://b.example.com/v1/") is ep2
+
+
 def test_no_url_falls_back_to_first_endpoint():
     ep1 = EndpointConfig(name="first", url="https://a.example.com/v1", api_key="k1")
     ep2 = EndpointConfig(name="second", url="https://b.example.com/v1", api_key="k2")
@@ -395,6 +532,36 @@ def test_max_tokens_within_limit_unchanged():
     assert captured_body[0]["max_tokens"] == 500
 
 
+@rsps_lib.activate
+def test_max_tokens_capped_in_place_without_reserializing():
+    captured: list[bytes] = []
+
+    def _callback(request):
+        captured.append(request.body)
+        return (200, {}, json.dumps({"choices": []}))
+
+    rsps_lib.add_callback(rsps_lib.POST, f"{UPSTREAM}/chat/completions", callback=_callback)
+
+    raw = '{ "model":"gpt-4o",  "messages": [{"content": "Grüße", "max_tokens": 5}], "max_tokens": 99999 }'
+    cfg = make_config(limits=LimitsConfig(max_request_tokens=1000, max_daily_tokens_per_ip=100000, max_request_bytes=2 * 1024 * 1024))
+    app = create_app(cfg)
+    with app.test_client() as client:
+        client.post("/v1/chat/completions", data=raw.encode(), headers={"Content-Type": "application/json"})
+
+    assert captured[0] == raw.replace("99999", "1000").encode()
+
+
+def test_json_body_matches_json_loads():
+    for raw in ['{}', ' {"a": [1, {"b": null}], "c": "ü"} ', '[1, 2]', '"text"']:
+        assert JsonBody.parse(raw.encode()).value == json.loads(raw)
+
+
+def test_json_body_rejects_invalid_documents():
+    for raw in [b'{"a": 1}{}', b'{"a": 1,}', b'{"a" 1}', b"", b"\xff"]:
+        with pytest.raises(ValueError):
+            JsonBody.parse(raw)
+
+
 def test_oversized_body_returns_413():
     cfg = make_config(limits=LimitsConfig(max_request_tokens=10000, max_daily_tokens_per_ip=100000, max_request_bytes=100))
     app = create_app(cfg)
@@ -409,6 +576,55 @@ def test_oversized_body_returns_413():
     assert resp.status_code == 413
 
 
+class _CountingStream(io.BytesIO):
+    def __init__(self, data: bytes):
+        super().__init__(data)
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = super().read(size)
+        self.bytes_read += len(chunk)
+        return chunk
+
+
+def test_read_limited_stops_at_the_limit():
+    stream = _CountingStream(b"x" * 1_000_000)
+    assert read_limited(stream, 100, chunk_size=64) is None
+    assert stream.bytes_read == 101
+    assert read_limited(io.BytesIO(b"x" * 100), 100, chunk_size=64) == b"x" * 100
+
+
+def test_chunked_oversized_body_returns_413_without_reading_it_all():
+    cfg = make_config(limits=LimitsConfig(max_request_tokens=10000, max_daily_tokens_per_ip=100000, max_request_bytes=100))
+    app = create_app(cfg)
+    stream = _CountingStream(b'{"model": "m", "messages": [{"role": "user", "content": "' + b"x" * 10**6 + b'"}]}')
+    with app.test_client() as client:
+        resp = client.post(
+            "/v1/chat/completions",
+            input_stream=stream,
+            headers={"Content-Type": "application/json", "Transfer-Encoding": "chunked"},
+            environ_overrides={"wsgi.input_terminated": True},  # as set by Gunicorn
+        )
+    assert resp.status_code == 413
+    assert stream.bytes_read <= 101
+
+
+@rsps_lib.activate
+def test_chunked_body_within_limit_is_forwarded():
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"choices": []}, status=200)
+    app = create_app(make_config())
+    body = json.dumps({"model": "m", "messages": []}).encode()
+    with app.test_client() as client:
+        resp = client.post(
+            "/v1/chat/completions",
+            input_stream=io.BytesIO(body),
+            headers={"Content-Type": "application/json", "Transfer-Encoding": "chunked"},
+            environ_overrides={"wsgi.input_terminated": True},  # as set by Gunicorn
+        )
+    assert resp.status_code == 200
+    assert rsps_lib.calls[0].request.body == body
+
+
 def test_non_integer_max_tokens_returns_400():
     app = create_app(make_config())
     with app.test_client() as client:
@@ -564,6 +780,75 @@ def test_models_endpoint_disabled_returns_404():
     assert resp.status_code == 404
 
 
+_SECOND_UPSTREAM = "https://second-upstream.example.com/v1"
+
+
+@rsps_lib.activate
+def test_models_merged_across_endpoints_and_cached():
+    rsps_lib.add(rsps_lib.GET, f"{UPSTREAM}/models", json={"data": [{"id": "gpt-4o"}]})
+    rsps_lib.add(rsps_lib.GET, f"{_SECOND_UPSTREAM}/models", json={"data": [{"id": "llama"}]})
+    endpoints = [
+        _DEFAULT_ENDPOINT,
+        EndpointConfig(name="test-2", url=UPSTREAM, api_key="second-key"),  # same group, not queried
+        EndpointConfig(name="second", url=_SECOND_UPSTREAM, api_key="k"),
+    ]
+    app = create_app(make_config(endpoints=endpoints))
+    with app.test_client() as client:
+        first = client.get("/v1/models")
+        second = client.get("/v1/models")
+    assert first.headers["X-Relay-Cache"] == "MISS"
+    assert second.headers["X-Relay-Cache"] == "HIT"
+    assert [(m["id"], m["relay_endpoint"], m["relay_endpoint_url"]) for m in second.get_json()["data"]] == [
+        ("gpt-4o", "test", UPSTREAM),
+        ("llama", "second", _SECOND_UPSTREAM),
+    ]
+    assert len(rsps_lib.calls) == 2
+
+
+@rsps_lib.activate
+def test_models_filtered_by_relay_endpoint_and_tolerates_failures():
+    rsps_lib.add(rsps_lib.GET, f"{UPSTREAM}/models", json={"data": [{"id": "gpt-4o"}]})
+    rsps_lib.add(rsps_lib.GET, f"{_SECOND_UPSTREAM}/models", status=500)
+    endpoints = [_DEFAULT_ENDPOINT, EndpointConfig(name="second", url=_SECOND_UPSTREAM, api_key="k")]
+    app = create_app(make_config(endpoints=endpoints))
+    with app.test_client() as client:
+        assert [m["id"] for m in client.get("/v1/models").get_json()["data"]] == ["gpt-4o"]
+        only_second = client.get("/v1/models", headers={"X-Relay-Endpoint": _SECOND_UPSTREAM})
+        unknown = client.get("/v1/models", headers={"X-Relay-Endpoint": "https://unknown.example.com"})
+    assert only_second.get_json()["data"] == []
+    assert unknown.status_code == 400
+
+
+@rsps_lib.activate
+def test_models_all_endpoints_failing_returns_502():
+    rsps_lib.add(rsps_lib.GET, f"{UPSTREAM}/models", status=503)
+    app = create_app(make_config())
+    with app.test_client() as client:
+        resp = client.get("/v1/models")
+    assert resp.status_code == 502
+
+
+def test_models_cache_serves_stale_while_refreshing():
+    now = [0.0]
+    calls: list[int] = []
+
+    def fetch(ep):
+        calls.append(1)
+        return [{"id": f"model-{len(calls)}"}]
+
+    models_cache = ModelsCache([_DEFAULT_ENDPOINT], ModelsConfig(ttl_seconds=10, stale_seconds=60), fetch, lambda: now[0])
+    assert models_cache.get()[0][0]["id"] == "model-1"
+
+    now[0] = 30.0
+    stale, state = models_cache.get()
+    assert (stale[0]["id"], state) == ("model-1", "STALE")
+    _wait_for(lambda: models_cache.get()[1] == "HIT")
+    assert models_cache.get()[0][0]["id"] == "model-2"
+
+    now[0] = 1000.0  # past ttl + stale: refreshed before answering
+    assert models_cache.get() == ([{"id": "model-3", "relay_endpoint": "test", "relay_endpoint_url": UPSTREAM}], "MISS")
+
+
 # ===========================================================================
 # 10. Invalid JSON body
 # ===========================================================================
@@ -579,3 +864,1419 @@ def test_invalid_json_body_returns_400():
         )
     assert resp.status_code == 400
     assert resp.get_json()["error"]["type"] == "relay_error"
+
+
+# ===========================================================================
+# 11. Response cache
+# ===========================================================================
+
+
+@rsps_lib.activate
+def test_cache_serves_repeated_embeddings_from_memory():
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/embeddings", json={"data": [{"embedding": [0.1]}]}, status=200)
+
+    app = create_app(make_config(cache=CacheConfig(enabled=True)))
+    body = {"model": "text-embedding-3-small", "input": "schema fragment"}
+    with app.test_client() as client:
+        first = _post_json(client, "/v1/embeddings", body)
+        second = _post_json(client, "/v1/embeddings", body)
+        health = client.get("/health").get_json()
+
+    assert first.headers["X-Relay-Cache"] == "MISS"
+    assert second.headers["X-Relay-Cache"] == "HIT"
+    assert second.get_json() == first.get_json()
+    assert len(rsps_lib.calls) == 1
+    assert health["cache"]["hits"] == 1
+    assert health["cache"]["misses"] == 1
+
+
+@rsps_lib.activate
+def test_cache_ignores_sampled_completions():
+    for _ in range(2):
+        rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"choices": []}, status=200)
+
+    app = create_app(make_config(cache=CacheConfig(enabled=True)))
+    with app.test_client() as client:
+        for _ in range(2):
+            resp = _post_json(client, "/v1/chat/completions", {"model": "gpt-4o", "messages": [], "temperature": 0.7})
+            assert "X-Relay-Cache" not in resp.headers
+    assert len(rsps_lib.calls) == 2
+
+
+@rsps_lib.activate
+def test_cache_does_not_store_upstream_errors():
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/embeddings", json={"error": "overloaded"}, status=503)
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/embeddings", json={"data": []}, status=200)
+
+    app = create_app(make_config(cache=CacheConfig(enabled=True)))
+    with app.test_client() as client:
+        assert _post_json(client, "/v1/embeddings", {"model": "m", "input": "x"}).status_code == 503
+        assert _post_json(client, "/v1/embeddings", {"model": "m", "input": "x"}).status_code == 200
+
+
+def test_is_cacheable_only_for_deterministic_requests():
+    assert is_cacheable("/embeddings", {"input": "x"})
+    assert is_cacheable("/chat/completions", {"temperature": 0})
+    assert not is_cacheable("/chat/completions", {})
+    assert not is_cacheable("/chat/completions", {"temperature": 0, "stream": True})
+
+
+def test_cache_key_ignores_body_key_order():
+    assert cache_key(UPSTREAM, "/embeddings", {"a": 1, "b": 2}) == cache_key(UPSTREAM, "/embeddings", {"b": 2, "a": 1})
+    assert cache_key(UPSTREAM, "/embeddings", {"a": 1}) != cache_key(UPSTREAM, "/completions", {"a": 1})
+
+
+def test_cache_entries_expire_after_ttl():
+    now = [1000.0]
+    cache = ResponseCache(CacheConfig(enabled=True, ttl_seconds=60), now_fn=lambda: now[0])
+    cache.put("k", "application/json", b"{}")
+    assert cache.get("k") == ("application/json", b"{}")
+    now[0] += 61
+    assert cache.get("k") is None
+
+
+def test_cache_evicts_least_recently_used_beyond_byte_limit():
+    cache = ResponseCache(CacheConfig(enabled=True, max_bytes=10, max_entry_bytes=10))
+    cache.put("a", "text/plain", b"12345")
+    cache.put("b", "text/plain", b"12345")
+    cache.get("a")  # touch a, so b is the LRU entry
+    cache.put("c", "text/plain", b"12345")
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.stats()["bytes"] == 10
+
+
+# ===========================================================================
+# 12. Embedding batching
+# ===========================================================================
+
+
+def _fake_embeddings(merged):
+    inputs = merged if merged is not None else ["solo"]
+    data = [{"object": "embedding", "index": i, "embedding": [float(len(text))]} for i, text in enumerate(inputs)]
+    body = {"object": "list", "data": data, "usage": {"prompt_tokens": 4 * len(inputs), "total_tokens": 4 * len(inputs)}}
+    return 200, "application/json", json.dumps(body).encode()
+
+
+def test_batcher_coalesces_concurrent_callers():
+    batcher = EmbeddingBatcher(BatchingConfig(enabled=True, window_ms=200, max_batch_size=64))
+    sent: list = []
+
+    def send(merged):
+        sent.append(merged)
+        return _fake_embeddings(merged)
+
+    results: dict[str, Any] = {}
+
+    def caller(name: str, inputs: list) -> None:
+        results[name] = json.loads(batcher.submit("k", inputs, send)[2])
+
+    threads = [
+        threading.Thread(target=caller, args=("a", ["x"])),
+        threading.Thread(target=caller, args=("b", ["yy", "zzz"])),
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(sent) == 1 and sorted(sent[0]) == ["x", "yy", "zzz"]
+    assert [item["index"] for item in results["b"]["data"]] == [0, 1]
+    assert [item["embedding"] for item in results["b"]["data"]] == [[2.0], [3.0]]
+    assert results["a"]["data"] == [{"object": "embedding", "index": 0, "embedding": [1.0]}]
+    assert results["a"]["usage"]["prompt_tokens"] + results["b"]["usage"]["prompt_tokens"] == 12
+
+
+def test_batcher_single_caller_sends_original_body():
+    batcher = EmbeddingBatcher(BatchingConfig(enabled=True, window_ms=1))
+    sent: list = []
+
+    def send(merged):
+        sent.append(merged)
+        return _fake_embeddings(merged)
+
+    batcher.submit("k", ["only"], send)
+    assert sent == [None]
+
+
+def test_batcher_full_batch_is_sent_without_waiting():
+    batcher = EmbeddingBatcher(BatchingConfig(enabled=True, window_ms=60000, max_batch_size=1))
+    status, _, _ = batcher.submit("k", ["x"], _fake_embeddings)
+    assert status == 200
+
+
+def test_batcher_propagates_upstream_errors_to_all_callers():
+    batcher = EmbeddingBatcher(BatchingConfig(enabled=True, window_ms=1))
+    error = (429, "application/json", b'{"error": "slow down"}')
+    assert batcher.submit("k", ["x"], lambda merged: error) == error
+
+
+def test_batcher_followers_give_up_at_their_deadline():
+    batcher = EmbeddingBatcher(BatchingConfig(enabled=True, window_ms=300))
+    leader = threading.Thread(target=batcher.submit, args=("k", ["x"], _fake_embeddings))
+    leader.start()
+    time.sleep(0.02)
+    with pytest.raises(TimeoutError):
+        batcher.submit("k", ["y"], _fake_embeddings, timeout=0.05)
+    leader.join()
+
+
+def test_embedding_inputs_normalization():
+    assert embedding_inputs("text") == ["text"]
+    assert embedding_inputs(["a", "b"]) == ["a", "b"]
+    assert embedding_inputs([1, 2, 3]) == [[1, 2, 3]]
+    assert embedding_inputs({"not": "mergeable"}) is None
+    assert embedding_inputs(["a", [1, 2]]) is None
+
+
+def test_batch_key_separates_text_and_token_inputs():
+    parsed = {"model": "m"}
+    assert batch_key(UPSTREAM, parsed, ["a"]) != batch_key(UPSTREAM, parsed, [[1, 2]])
+    assert batch_key(UPSTREAM, parsed, ["a"]) == batch_key(UPSTREAM, parsed, ["b", "c"])
+
+
+def test_batcher_resends_each_caller_when_merged_call_fails():
+    batcher = EmbeddingBatcher(BatchingConfig(enabled=True, window_ms=200))
+    sent: list = []
+
+    def sender(name: str):
+        def send(merged):
+            sent.append((name, merged))
+            if merged is not None or name == "bad":
+                return 400, "application/json", b'{"error": "invalid input"}'
+            return _fake_embeddings(None)
+
+        return send
+
+    results: dict[str, Any] = {}
+
+    def caller(name: str) -> None:
+        results[name] = batcher.submit("k", [name], sender(name))[0]
+
+    threads = [threading.Thread(target=caller, args=(name,)) for name in ("good", "bad")]
+    for t in threads:
+        t.start()
+        time.sleep(0.02)
+    for t in threads:
+        t.join()
+
+    assert results == {"good": 200, "bad": 400}
+    assert sorted(sent, key=str) == sorted([("good", ["good", "bad"]), ("good", None), ("bad", None)], key=str)
+
+
+@rsps_lib.activate
+def test_batching_enabled_embeddings_still_forwarded():
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/embeddings", json={"data": [{"index": 0, "embedding": [0.5]}]}, status=200)
+
+    app = create_app(make_config(batching=BatchingConfig(enabled=True, window_ms=1)))
+    with app.test_client() as client:
+        resp = _post_json(client, "/v1/embeddings", {"model": "m", "input": "hello"})
+    assert resp.status_code == 200
+    assert resp.get_json()["data"][0]["embedding"] == [0.5]
+    assert json.loads(rsps_lib.calls[0].request.body)["input"] == "hello"
+
+
+# ===========================================================================
+# 13. Load balancing and failover
+# ===========================================================================
+
+
+def _key_of(call) -> str:
+    return call.request.headers["Authorization"].removeprefix("Bearer ")
+
+
+@rsps_lib.activate
+def test_group_members_share_load_round_robin():
+    for _ in range(4):
+        rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"choices": []}, status=200)
+
+    cfg = make_config(
+        endpoints=[
+            EndpointConfig(name="key-a", url=UPSTREAM, api_key="a"),
+            EndpointConfig(name="key-b", url=UPSTREAM, api_key="b"),
+        ]
+    )
+    app = create_app(cfg)
+    with app.test_client() as client:
+        for _ in range(4):
+            _post_json(client, "/v1/chat/completions", {"model": "gpt-4o", "messages": []})
+
+    assert [_key_of(c) for c in rsps_lib.calls] == ["a", "b", "a", "b"]
+
+
+@rsps_lib.activate
+def test_group_fails_over_on_5xx():
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"error": "down"}, status=503)
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"choices": []}, status=200)
+
+    cfg = make_config(
+        endpoints=[
+            EndpointConfig(name="key-a", url=UPSTREAM, api_key="a"),
+            EndpointConfig(name="key-b", url=UPSTREAM, api_key="b"),
+        ]
+    )
+    app = create_app(cfg)
+    with app.test_client() as client:
+        resp = _post_json(client, "/v1/chat/completions", {"model": "gpt-4o", "messages": []})
+
+    assert resp.status_code == 200
+    assert [_key_of(c) for c in rsps_lib.calls] == ["a", "b"]
+
+
+@rsps_lib.activate
+def test_group_fails_over_on_connection_error():
+    import requests as req_lib
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", body=req_lib.ConnectionError())
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"choices": []}, status=200)
+
+    cfg = make_config(
+        endpoints=[
+            EndpointConfig(name="key-a", url=UPSTREAM, api_key="a"),
+            EndpointConfig(name="key-b", url=UPSTREAM, api_key="b"),
+        ]
+    )
+    app = create_app(cfg)
+    with app.test_client() as client:
+        resp = _post_json(client, "/v1/chat/completions", {"model": "gpt-4o", "messages": []})
+    assert resp.status_code == 200
+
+
+MIRROR = "https://mirror.example.org/v1"
+
+
+@rsps_lib.activate
+def test_explicit_group_fails_over_to_a_mirror():
+    import requests as req_lib
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", body=req_lib.ConnectionError())
+    rsps_lib.add(rsps_lib.POST, f"{MIRROR}/chat/completions", json={"from": "mirror"}, status=200)
+
+    cfg = make_config(
+        endpoints=[
+            EndpointConfig(name="primary", url=UPSTREAM, api_key="a", group="llama"),
+            EndpointConfig(name="mirror", url=MIRROR, api_key="b", group="llama"),
+        ]
+    )
+    app = create_app(cfg)
+    with app.test_client() as client:
+        # X-Relay-Endpoint selects the group of the endpoint it matches
+        resp = _post_json(
+            client, "/v1/chat/completions", {"model": "m", "messages": []}, headers={"X-Relay-Endpoint": UPSTREAM}
+        )
+    assert resp.status_code == 200
+    assert resp.get_json() == {"from": "mirror"}
+    assert [c.request.url for c in rsps_lib.calls] == [f"{UPSTREAM}/chat/completions", f"{MIRROR}/chat/completions"]
+
+
+def test_endpoint_groups_by_group_key_or_url(tmp_path):
+    _write_config(tmp_path / "config.yaml", UPSTREAM)
+    assert parse_config(str(tmp_path / "config.yaml")).endpoints[0].group == ""
+    endpoints = [
+        EndpointConfig(name="a", url=UPSTREAM, api_key="a", group="g"),
+        EndpointConfig(name="b", url=MIRROR, api_key="b", group="g"),
+        EndpointConfig(name="c", url=UPSTREAM, api_key="c"),
+        EndpointConfig(name="d", url=UPSTREAM, api_key="d"),
+    ]
+    groups = build_endpoint_groups(endpoints, LoadBalancingConfig())
+    assert {name: group.size for name, group in groups.items()} == {"g": 2, UPSTREAM: 2}
+
+
+def test_group_weighted_round_robin():
+    a = EndpointConfig(name="a", url=UPSTREAM, api_key="a", weight=2)
+    b = EndpointConfig(name="b", url=UPSTREAM, api_key="b")
+    group = EndpointGroup([a, b], LoadBalancingConfig())
+    picks = []
+    for _ in range(6):
+        ep = group.acquire()
+        picks.append(ep.name)
+        group.release(ep, ok=True)
+    assert picks.count("a") == 4 and picks.count("b") == 2
+
+
+def test_group_least_outstanding_prefers_idle_member():
+    a = EndpointConfig(name="a", url=UPSTREAM, api_key="a")
+    b = EndpointConfig(name="b", url=UPSTREAM, api_key="b")
+    group = EndpointGroup([a, b], LoadBalancingConfig(strategy="least_outstanding"))
+    first = group.acquire()
+    assert group.acquire().name != first.name
+
+
+def test_group_prefers_members_with_a_free_slot():
+    a = EndpointConfig(name="a", url=UPSTREAM, api_key="a")
+    b = EndpointConfig(name="b", url=UPSTREAM, api_key="b")
+    group = EndpointGroup([a, b], LoadBalancingConfig())
+    busy = {"a"}
+    assert [group.acquire(has_slot=lambda ep: ep.name not in busy).name for _ in range(3)] == ["b"] * 3
+    busy.add("b")
+    assert {group.acquire(has_slot=lambda ep: ep.name not in busy).name for _ in range(2)} == {"a", "b"}
+
+
+def test_circuit_breaker_ejects_and_readmits_member():
+    now = [0.0]
+    a = EndpointConfig(name="a", url=UPSTREAM, api_key="a")
+    b = EndpointConfig(name="b", url=UPSTREAM, api_key="b")
+    group = EndpointGroup([a, b], LoadBalancingConfig(failure_threshold=2, cooldown_seconds=10), now_fn=lambda: now[0])
+    for _ in range(2):
+        group.release(group.acquire(exclude={"b"}), ok=False)
+    assert group.ejected() == ["a"]
+
+    picks = []
+    for _ in range(3):
+        ep = group.acquire()
+        picks.append(ep.name)
+        group.release(ep, ok=True)
+    assert picks == ["b", "b", "b"]
+
+    now[0] = 11.0
+    trial = group.acquire(exclude={"b"})
+    assert trial.name == "a"
+    group.release(trial, ok=True)
+    assert group.ejected() == []
+
+
+def test_group_with_all_members_ejected_still_serves():
+    ep = EndpointConfig(name="only", url=UPSTREAM, api_key="k")
+    group = EndpointGroup([ep], LoadBalancingConfig(failure_threshold=1))
+    group.release(group.acquire(), ok=False)
+    assert group.acquire() is ep
+
+
+# ===========================================================================
+# 14. Metrics
+# ===========================================================================
+
+
+def _metric_value(text: str, prefix: str) -> float:
+    for line in text.splitlines():
+        if line.startswith(prefix):
+            return float(line.rsplit(" ", 1)[1])
+    raise AssertionError(f"metric {prefix!r} not found")
+
+
+@rsps_lib.activate
+def test_metrics_count_requests_tokens_and_errors():
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"choices": []}, status=200)
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"error": "busy"}, status=429)
+
+    app = create_app(make_config())
+    with app.test_client() as client:
+        _post_json(client, "/v1/chat/completions", {"model": "gpt-4o", "messages": [], "max_tokens": 100})
+        _post_json(client, "/v1/chat/completions", {"model": "gpt-4o", "messages": [], "max_tokens": 100})
+        text = client.get("/metrics").get_data(as_text=True)
+
+    labels = 'endpoint="test",model="gpt-4o"'
+    assert _metric_value(text, f'relay_requests_total{{{labels},path="/chat/completions",status="200"}}') == 1
+    assert _metric_value(text, f'relay_requests_total{{{labels},path="/chat/completions",status="429"}}') == 1
+    assert _metric_value(text, f"relay_tokens_charged_total{{{labels}}}") == 200
+    assert _metric_value(text, 'relay_upstream_errors_total{endpoint="test",kind="429"}') == 1
+
+
+@rsps_lib.activate
+def test_metrics_track_streams():
+    rsps_lib.add(
+        rsps_lib.POST,
+        f"{UPSTREAM}/chat/completions",
+        body="data: {}\n\ndata: [DONE]\n\n",
+        status=200,
+        content_type="text/event-stream",
+    )
+
+    app = create_app(make_config())
+    with app.test_client() as client:
+        resp = _post_json(client, "/v1/chat/completions", {"model": "gpt-4o", "messages": [], "stream": True})
+        resp.get_data()
+        text = client.get("/metrics").get_data(as_text=True)
+
+    assert _metric_value(text, "relay_streams_in_flight") == 0
+    assert _metric_value(text, 'relay_stream_duration_seconds_count{endpoint="test",path="/chat/completions"}') == 1
+    assert _metric_value(text, 'relay_response_bytes_total{endpoint="test"}') == 24
+
+
+def test_metrics_time_new_upstream_connections_only():
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Upstream(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, so the second call reuses the connection
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            body = b'{"choices": []}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Upstream)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        endpoint = EndpointConfig(name="local", url=f"http://127.0.0.1:{server.server_address[1]}/v1", api_key="k")
+        app = create_app(make_config(endpoints=[endpoint]))
+        with app.test_client() as client:
+            for _ in range(2):
+                assert _post_json(client, "/v1/chat/completions", {"model": "m", "messages": []}).status_code == 200
+            text = client.get("/metrics").get_data(as_text=True)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert _metric_value(text, 'relay_upstream_connect_seconds_count{endpoint="local"}') == 1
+    assert _metric_value(text, 'relay_upstream_headers_seconds_count{endpoint="local"}') == 2
+
+def test_metrics_require_relay_password():
+    app = create_app(make_config(relay_password="secret"))
+    with app.test_client() as client:
+        assert client.get("/metrics").status_code == 401
+        assert client.get("/metrics", headers={"Authorization": "Bearer secret"}).status_code == 200
+
+
+def test_metrics_disabled():
+    app = create_app(make_config(metrics=MetricsConfig(enabled=False)))
+    with app.test_client() as client:
+        assert client.get("/metrics").status_code == 404
+
+
+# ===========================================================================
+# 15. Concurrency limiter and queue
+# ===========================================================================
+
+
+def _wait_for(predicate, timeout: float = 2.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.005)
+
+
+def test_limiter_queues_beyond_max_in_flight():
+    limiter = ConcurrencyLimiter(1, QueueConfig(max_queue=10, timeout_seconds=5))
+    limiter.acquire("a", PRIORITY_SHORT)
+    acquired = threading.Event()
+
+    def waiter():
+        limiter.acquire("b", PRIORITY_SHORT)
+        acquired.set()
+
+    t = threading.Thread(target=waiter)
+    t.start()
+    _wait_for(lambda: limiter.depth == 1)
+    assert not acquired.is_set()
+    limiter.release()
+    t.join(2)
+    assert acquired.is_set()
+    assert limiter.in_flight == 1 and limiter.depth == 0
+
+
+def test_limiter_rejects_when_queue_full_or_timed_out():
+    limiter = ConcurrencyLimiter(1, QueueConfig(max_queue=0, timeout_seconds=5))
+    limiter.acquire("a", PRIORITY_SHORT)
+    with pytest.raises(QueueFull):
+        limiter.acquire("b", PRIORITY_SHORT)
+
+    limiter = ConcurrencyLimiter(1, QueueConfig(max_queue=5, timeout_seconds=0.05))
+    limiter.acquire("a", PRIORITY_SHORT)
+    with pytest.raises(QueueFull):
+        limiter.acquire("b", PRIORITY_SHORT)
+    assert limiter.depth == 0
+
+
+def test_limiter_prefers_short_calls_and_rotates_ips():
+    limiter = ConcurrencyLimiter(1, QueueConfig(max_queue=10, timeout_seconds=5))
+    limiter.acquire("holder", PRIORITY_SHORT)
+    order: list[str] = []
+    lock = threading.Lock()
+
+    def waiter(name: str, ip: str, priority: int) -> None:
+        limiter.acquire(ip, priority)
+        with lock:
+            order.append(name)
+        limiter.release()
+
+    threads = []
+    for name, ip, priority in [
+        ("stream", "x", PRIORITY_STREAM),
+        ("a1", "a", PRIORITY_SHORT),
+        ("a2", "a", PRIORITY_SHORT),
+        ("b1", "b", PRIORITY_SHORT),
+    ]:
+        t = threading.Thread(target=waiter, args=(name, ip, priority))
+        t.start()
+        threads.append(t)
+        _wait_for(lambda n=len(threads): limiter.depth == n)
+
+    limiter.release()
+    for t in threads:
+        t.join(2)
+    assert order == ["a1", "b1", "a2", "stream"]
+
+
+@rsps_lib.activate
+def test_queue_full_returns_503():
+    release_upstream = threading.Event()
+    entered = threading.Event()
+
+    def _slow(request):
+        entered.set()
+        release_upstream.wait(2)
+        return (200, {}, json.dumps({"choices": []}))
+
+    rsps_lib.add_callback(rsps_lib.POST, f"{UPSTREAM}/chat/completions", callback=_slow)
+
+    ep = EndpointConfig(name="test", url=UPSTREAM, api_key="k", max_in_flight=1)
+    app = create_app(make_config(endpoints=[ep], queue=QueueConfig(max_queue=0)))
+
+    first: dict = {}
+
+    def first_request():
+        with app.test_client() as c:
+            first["status"] = _post_json(c, "/v1/chat/completions", {"model": "m", "messages": []}).status_code
+
+    t = threading.Thread(target=first_request)
+    t.start()
+    assert entered.wait(2)
+    with app.test_client() as client:
+        resp = _post_json(client, "/v1/chat/completions", {"model": "m", "messages": []})
+        queues = client.get("/health").get_json()["queues"]
+    release_upstream.set()
+    t.join(2)
+
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == "1"
+    assert resp.get_json()["error"]["type"] == "relay_overloaded_error"
+    assert queues == {"test": {"in_flight": 1, "waiting": 0}}
+    assert first["status"] == 200
+
+
+@rsps_lib.activate
+def test_full_queue_fails_over_to_another_group_member(monkeypatch):
+    release_upstream = threading.Event()
+    entered = threading.Event()
+
+    def _callback(request):
+        if request.headers["Authorization"] == "Bearer a":
+            entered.set()
+            release_upstream.wait(2)
+        return (200, {}, json.dumps({"from": request.headers["Authorization"]}))
+
+    rsps_lib.add_callback(
+        rsps_lib.POST, f"{UPSTREAM}/chat/completions", callback=_callback, content_type="application/json"
+    )
+    # Make every member look free, so the second request is sent to the busy one first
+    monkeypatch.setattr(ConcurrencyLimiter, "has_free_slot", property(lambda self: True))
+    cfg = make_config(
+        endpoints=[
+            EndpointConfig(name="a", url=UPSTREAM, api_key="a", weight=3, max_in_flight=1),
+            EndpointConfig(name="b", url=UPSTREAM, api_key="b"),
+        ],
+        queue=QueueConfig(max_queue=0),
+    )
+    app = create_app(cfg)
+
+    first = threading.Thread(
+        target=lambda: _post_json(app.test_client(), "/v1/chat/completions", {"model": "m", "messages": []})
+    )
+    first.start()
+    assert entered.wait(2)
+    with app.test_client() as client:
+        resp = _post_json(client, "/v1/chat/completions", {"model": "m", "messages": []})
+    release_upstream.set()
+    first.join(2)
+    assert resp.status_code == 200
+    assert resp.get_json() == {"from": "Bearer b"}
+
+
+# ===========================================================================
+# 16. Retries, hedging and deadlines
+# ===========================================================================
+
+_FAST_RETRY = dict(backoff_base_seconds=0.001, backoff_max_seconds=0.001)
+
+
+@rsps_lib.activate
+def test_retry_after_transient_upstream_error():
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"error": "busy"}, status=503)
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"choices": []}, status=200)
+
+    app = create_app(make_config(retry=RetryConfig(max_retries=2, **_FAST_RETRY)))
+    with app.test_client() as client:
+        resp = _post_json(client, "/v1/chat/completions", {"model": "gpt-4o", "messages": [], "temperature": 0})
+        text = client.get("/metrics").get_data(as_text=True)
+    assert resp.status_code == 200
+    assert len(rsps_lib.calls) == 2
+    assert _metric_value(text, 'relay_upstream_retries_total{endpoint="test"}') == 1
+
+
+@rsps_lib.activate
+def test_sampled_requests_are_only_retried_when_turned_away():
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"error": "busy"}, status=503)
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"error": "slow down"}, status=429)
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"choices": []}, status=200)
+
+    app = create_app(make_config(retry=RetryConfig(max_retries=2, **_FAST_RETRY)))
+    with app.test_client() as client:
+        sampled = {"model": "gpt-4o", "messages": [], "temperature": 0.7}
+        assert _post_json(client, "/v1/chat/completions", sampled).status_code == 503  # may have run
+        assert _post_json(client, "/v1/chat/completions", sampled).status_code == 200  # 429 is retried
+    assert len(rsps_lib.calls) == 3
+
+
+@rsps_lib.activate
+def test_retry_disabled_by_default():
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"error": "busy"}, status=503)
+
+    app = create_app(make_config())
+    with app.test_client() as client:
+        resp = _post_json(client, "/v1/chat/completions", {"model": "gpt-4o", "messages": []})
+    assert resp.status_code == 503
+    assert len(rsps_lib.calls) == 1
+
+
+@rsps_lib.activate
+def test_streaming_requests_are_not_retried():
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"error": "busy"}, status=503)
+
+    app = create_app(make_config(retry=RetryConfig(max_retries=3, **_FAST_RETRY)))
+    with app.test_client() as client:
+        resp = _post_json(client, "/v1/chat/completions", {"model": "gpt-4o", "messages": [], "stream": True})
+        resp.get_data()
+    assert resp.status_code == 503
+    assert len(rsps_lib.calls) == 1
+
+
+@rsps_lib.activate
+def test_retry_backoff_respects_client_deadline():
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"error": "busy"}, status=503)
+
+    app = create_app(make_config(retry=RetryConfig(max_retries=5, backoff_base_seconds=10, backoff_max_seconds=10)))
+    started = time.monotonic()
+    with app.test_client() as client:
+        resp = _post_json(
+            client,
+            "/v1/chat/completions",
+            {"model": "gpt-4o", "messages": []},
+            headers={"X-Relay-Timeout": "0.2"},
+        )
+    # Either no retry fits the budget, or the jittered delay was tiny.
+    assert resp.status_code in (503, 504)
+    assert time.monotonic() - started < 1
+
+
+@rsps_lib.activate
+def test_queue_wait_respects_client_deadline():
+    release_upstream = threading.Event()
+    entered = threading.Event()
+
+    def _slow(request):
+        entered.set()
+        release_upstream.wait(2)
+        return (200, {}, json.dumps({"choices": []}))
+
+    rsps_lib.add_callback(rsps_lib.POST, f"{UPSTREAM}/chat/completions", callback=_slow)
+    ep = EndpointConfig(name="test", url=UPSTREAM, api_key="k", max_in_flight=1)
+    app = create_app(make_config(endpoints=[ep], queue=QueueConfig(timeout_seconds=30)))
+
+    first = threading.Thread(
+        target=lambda: _post_json(app.test_client(), "/v1/chat/completions", {"model": "m", "messages": []})
+    )
+    first.start()
+    assert entered.wait(2)
+    started = time.monotonic()
+    with app.test_client() as client:
+        resp = _post_json(
+            client, "/v1/chat/completions", {"model": "m", "messages": []}, headers={"X-Relay-Timeout": "0.2"}
+        )
+    elapsed = time.monotonic() - started
+    release_upstream.set()
+    first.join(2)
+    assert resp.status_code == 504
+    assert elapsed < 1
+
+
+def test_single_flight_followers_give_up_at_their_deadline():
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(2)
+        return "late"
+
+    leader = threading.Thread(target=flights.do, args=("k", slow))
+    leader.start()
+    started.wait()
+    with pytest.raises(TimeoutError):
+        flights.do("k", lambda: pytest.fail("follower must not run"), timeout=0.05)
+    release.set()
+    leader.join()
+
+
+def test_backoff_delay_honors_retry_after():
+    cfg = RetryConfig(backoff_base_seconds=0.01, backoff_max_seconds=0.01)
+    assert backoff_delay(0, cfg) <= 0.01
+    assert backoff_delay(0, cfg, retry_after="2") == 2
+    assert backoff_delay(0, cfg, retry_after="Wed, 21 Oct 2015 07:28:00 GMT") <= 0.01
+
+
+@rsps_lib.activate
+def test_hedged_request_takes_faster_member():
+    def _callback(request):
+        if request.headers["Authorization"] == "Bearer slow" and json.loads(request.body).get("slow"):
+            time.sleep(0.5)
+            return (200, {}, json.dumps({"from": "slow"}))
+        return (200, {}, json.dumps({"from": request.headers["Authorization"]}))
+
+    rsps_lib.add_callback(
+        rsps_lib.POST, f"{UPSTREAM}/chat/completions", callback=_callback, content_type="application/json"
+    )
+
+    cfg = make_config(
+        endpoints=[
+            EndpointConfig(name="slow", url=UPSTREAM, api_key="slow"),
+            EndpointConfig(name="fast", url=UPSTREAM, api_key="fast"),
+        ],
+        retry=RetryConfig(hedge=True, hedge_quantile=0.5, hedge_min_samples=2),
+    )
+    app = create_app(cfg)
+    with app.test_client() as client:
+        for _ in range(2):  # warm up the latency window on both members
+            _post_json(client, "/v1/chat/completions", {"model": "m", "messages": []})
+        started = time.monotonic()
+        resp = _post_json(client, "/v1/chat/completions", {"model": "m", "messages": [], "slow": True})
+        elapsed = time.monotonic() - started
+        text = client.get("/metrics").get_data(as_text=True)
+
+    assert resp.get_json() == {"from": "Bearer fast"}
+    assert elapsed < 0.4
+    assert _metric_value(text, 'relay_hedged_requests_total{endpoint="slow",winner="hedge"}') == 1
+
+
+# ===========================================================================
+# 17. SSE coalescing
+# ===========================================================================
+
+
+def test_coalesce_flushes_first_event_then_groups_by_interval():
+    def chunks():
+        yield b"data: a"
+        yield b"\n\n"
+        yield b"data: b\n\n"
+        yield b"data: c\n\ndata: d"
+        time.sleep(0.6)
+        yield b"\n\n"
+
+    out = list(coalesce_sse(chunks(), StreamingConfig(flush_interval_ms=200, flush_bytes=1 << 20)))
+    assert out == [b"data: a\n\n", b"data: b\n\ndata: c\n\n", b"data: d\n\n"]
+
+
+def test_coalesce_flushes_held_events_while_upstream_pauses():
+    def chunks():
+        yield b"data: a\n\n"
+        yield b"data: b\n\n"
+        time.sleep(2)
+        yield b"data: c\n\n"
+
+    start = time.monotonic()
+    arrivals = []
+    for out in coalesce_sse(chunks(), StreamingConfig(flush_interval_ms=50)):
+        arrivals.append((out, time.monotonic() - start))
+    assert [out for out, _ in arrivals] == [b"data: a\n\n", b"data: b\n\n", b"data: c\n\n"]
+    assert arrivals[1][1] < 1.0  # sent after the interval, not after the pause
+    assert arrivals[2][1] >= 2.0
+
+
+def test_coalesce_flushes_on_byte_threshold_and_keeps_partial_events():
+    out = list(
+        coalesce_sse(
+            [b"data: 1\n\n", b"data: 2\n\n", b"data: 3\n\ndata: par", b"tial\r\n\r\n"],
+            StreamingConfig(flush_interval_ms=60000, flush_bytes=18),
+        )
+    )
+    assert out == [b"data: 1\n\n", b"data: 2\n\ndata: 3\n\n", b"data: partial\r\n\r\n"]
+
+
+def test_coalesce_emits_trailing_bytes_at_end_of_stream():
+    out = list(coalesce_sse([b"data: x\n\n", b"data: unterminated"], StreamingConfig(flush_interval_ms=10)))
+    assert b"".join(out) == b"data: x\n\ndata: unterminated"
+
+
+@rsps_lib.activate
+def test_coalesced_stream_is_byte_identical():
+    payload = "".join(f"data: {{\"token\": {i}}}\n\n" for i in range(50)) + "data: [DONE]\n\n"
+    rsps_lib.add(
+        rsps_lib.POST, f"{UPSTREAM}/chat/completions", body=payload, status=200, content_type="text/event-stream"
+    )
+
+    app = create_app(make_config(streaming=StreamingConfig(flush_interval_ms=20)))
+    with app.test_client() as client:
+        resp = _post_json(client, "/v1/chat/completions", {"model": "m", "messages": [], "stream": True})
+        assert resp.get_data(as_text=True) == payload
+
+
+# ===========================================================================
+# 18. Config hot reload
+# ===========================================================================
+
+_OTHER_UPSTREAM = "https://other-upstream.example.com/v1"
+
+
+def _write_config(path, url: str, **extra: Any) -> None:
+    import yaml
+
+    path.write_text(yaml.safe_dump({"endpoints": [{"name": "ep", "url": url, "api_key": "k"}], **extra}))
+
+
+def test_parse_config_raises_instead_of_exiting(tmp_path):
+    with pytest.raises(ConfigError):
+        parse_config(str(tmp_path / "missing.yaml"))
+    bad = tmp_path / "bad.yaml"
+    bad.write_text("endpoints: [")
+    with pytest.raises(ConfigError):
+        parse_config(str(bad))
+
+
+@rsps_lib.activate
+def test_reload_swaps_endpoints():
+    rsps_lib.add(rsps_lib.POST, f"{_OTHER_UPSTREAM}/chat/completions", json={"choices": []}, status=200)
+    app = create_app(make_config())
+    other = EndpointConfig(name="other", url=_OTHER_UPSTREAM, api_key="k")
+    app.extensions["mc_relay"].reload(make_config(endpoints=[other]))
+    with app.test_client() as client:
+        resp = _post_json(client, "/v1/chat/completions", {"model": "m", "messages": []})
+        assert resp.status_code == 200
+        assert client.get("/health").get_json()["endpoints"] == 1
+
+
+@rsps_lib.activate
+def test_reload_lets_in_flight_stream_finish_on_old_config():
+    payload = "data: 1\n\ndata: [DONE]\n\n"
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", body=payload, content_type="text/event-stream")
+    old_ep = EndpointConfig(name="test", url=UPSTREAM, api_key="k", max_in_flight=1)
+    app = create_app(make_config(endpoints=[old_ep]))
+    state = app.extensions["mc_relay"]
+    old_runtime = state.runtime
+    with app.test_client() as client:
+        resp = client.post(
+            "/v1/chat/completions",
+            data=json.dumps({"model": "m", "messages": [], "stream": True}),
+            content_type="application/json",
+            buffered=False,
+        )
+        state.reload(make_config(endpoints=[EndpointConfig(name="other", url=_OTHER_UPSTREAM, api_key="k")]))
+        assert state.runtime is not old_runtime
+        assert resp.get_data(as_text=True) == payload
+    assert old_runtime.limiters["test"].in_flight == 0
+
+
+def test_reload_applies_rate_limits_and_keeps_token_usage():
+    limits = LimitsConfig(max_request_tokens=100, max_daily_tokens_per_ip=150, max_request_bytes=1 << 20)
+    rate_limits = RateLimitConfig(enabled=True, requests_per_minute=1, requests_per_hour=100, requests_per_day=100)
+    app = create_app(make_config(limits=limits, rate_limits=rate_limits))
+    with rsps_lib.RequestsMock() as rsps, app.test_client() as client:
+        rsps.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"choices": []}, status=200)
+        body = {"model": "m", "messages": [], "max_tokens": 100}
+        assert _post_json(client, "/v1/chat/completions", body).status_code == 200
+        assert _post_json(client, "/v1/chat/completions", body).status_code == 429
+
+        app.extensions["mc_relay"].reload(make_config(limits=limits))
+        # Rate limiting is now off, but the 100 tokens used before the reload still count.
+        resp = _post_json(client, "/v1/chat/completions", body)
+        assert resp.status_code == 429
+        assert resp.get_json()["error"]["type"] == "token_limit_error"
+
+
+def test_config_watcher_reloads_changed_file_and_keeps_config_on_error(tmp_path):
+    path = tmp_path / "config.yaml"
+    _write_config(path, UPSTREAM)
+    app = create_app(parse_config(str(path)))
+    state = app.extensions["mc_relay"]
+    watcher = ConfigWatcher(app, str(path), interval=0, settle_seconds=0)
+
+    assert watcher.check() is False
+    _write_config(path, _OTHER_UPSTREAM, request_timeout=30)
+    assert watcher.check() is True
+    assert state.runtime.config.endpoints[0].url == _OTHER_UPSTREAM
+
+    path.write_text("endpoints: []")
+    assert watcher.check() is False
+    assert state.runtime.config.endpoints[0].url == _OTHER_UPSTREAM
+
+    watcher.trigger()
+    assert watcher.check() is False  # forced, but the file is still invalid
+    _write_config(path, UPSTREAM)
+    assert watcher.check() is True
+    assert state.runtime.config.endpoints[0].url == UPSTREAM
+
+
+@rsps_lib.activate
+def test_stream_logs_after_request_context_is_gone():
+    """Without `with app.test_client()`, the context is popped before the body is read."""
+    rsps_lib.add(
+        rsps_lib.POST, f"{UPSTREAM}/chat/completions", body="data: 1\n\n", content_type="text/event-stream"
+    )
+    app = create_app(make_config())
+    resp = _post_json(app.test_client(), "/v1/chat/completions", {"model": "m", "messages": [], "stream": True})
+    assert resp.get_data() == b"data: 1\n\n"
+
+
+# ===========================================================================
+# 19. Compression
+# ===========================================================================
+
+
+def _gzip_post(client, body: bytes, coding: str = "gzip"):
+    return client.post(
+        "/v1/chat/completions",
+        data=body,
+        headers={"Content-Type": "application/json", "Content-Encoding": coding},
+    )
+
+
+def test_preflight_allows_compressed_request_bodies():
+    app = create_app(make_config())
+    with app.test_client() as client:
+        resp = client.options(
+            "/v1/chat/completions",
+            headers={
+                "Origin": "http://localhost:5173",
+                "Access-Control-Request-Method": "POST",
+                "Access-Control-Request-Headers": "content-type,content-encoding",
+            },
+        )
+    allowed = {h.strip().lower() for h in resp.headers["Access-Control-Allow-Headers"].split(",")}
+    assert {"content-type", "content-encoding"} <= allowed
+
+
+@rsps_lib.activate
+def test_gzip_request_body_is_inflated_before_forwarding():
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"choices": []}, status=200)
+    body = json.dumps({"model": "m", "messages": [{"role": "user", "content": "schema " * 500}]}).encode()
+    app = create_app(make_config())
+    with app.test_client() as client:
+        resp = _gzip_post(client, gzip.compress(body))
+    assert resp.status_code == 200
+    assert rsps_lib.calls[0].request.body == body
+    assert "Content-Encoding" not in rsps_lib.calls[0].request.headers
+
+
+def test_compressed_request_body_limits_and_errors():
+    app = create_app(make_config())  # max_request_bytes = 2 MiB
+    bomb = gzip.compress(b'{"model": "' + b"0" * (16 * 1024 * 1024) + b'"}')
+    with app.test_client() as client:
+        assert _gzip_post(client, bomb).status_code == 413
+        assert _gzip_post(client, b"not gzip").status_code == 400
+        assert _gzip_post(client, b"{}", coding="compress").status_code == 415
+
+
+def test_decompress_body_bounds_inflated_size():
+    data = b"x" * 1000
+    assert decompress_body(gzip.compress(data), "gzip", 1000) == data
+    assert decompress_body(gzip.compress(data), "gzip", 999) is None
+    with pytest.raises(ValueError):
+        decompress_body(gzip.compress(data)[:-12], "gzip", 1000)
+
+
+@rsps_lib.activate
+def test_response_compressed_when_client_accepts_gzip():
+    content = {"choices": [{"message": {"content": "x" * 5000}}]}
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json=content, status=200)
+    app = create_app(make_config())
+    body = {"model": "m", "messages": []}
+    with app.test_client() as client:
+        compressed = _post_json(client, "/v1/chat/completions", body, {"Accept-Encoding": "gzip"})
+        plain = _post_json(client, "/v1/chat/completions", body, {"Accept-Encoding": "gzip;q=0"})
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in compressed.headers["Vary"]
+    assert json.loads(gzip.decompress(compressed.get_data())) == content
+    assert "Content-Encoding" not in plain.headers
+    assert plain.get_json() == content
+
+
+@rsps_lib.activate
+def test_small_or_disabled_responses_are_not_compressed():
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"choices": ["x" * 5000]}, status=200)
+    headers = {"Accept-Encoding": "gzip"}
+    with create_app(make_config()).test_client() as client:
+        assert "Content-Encoding" not in client.get("/health", headers=headers).headers
+    disabled = create_app(make_config(compression=CompressionConfig(enabled=False)))
+    with disabled.test_client() as client:
+        resp = _post_json(client, "/v1/chat/completions", {"model": "m", "messages": []}, headers)
+    assert "Content-Encoding" not in resp.headers
+
+
+@rsps_lib.activate
+def test_upstream_request_compressed_when_endpoint_allows():
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"choices": []}, status=200)
+    ep = EndpointConfig(name="test", url=UPSTREAM, api_key="k", compress_requests=True)
+    body = {"model": "m", "messages": [{"role": "user", "content": "schema " * 500}]}
+    with create_app(make_config(endpoints=[ep])).test_client() as client:
+        assert _post_json(client, "/v1/chat/completions", body).status_code == 200
+    sent = rsps_lib.calls[0].request
+    assert sent.headers["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(sent.body)) == body
+
+
+# ===========================================================================
+# 20. Single-flight coalescing
+# ===========================================================================
+
+
+def _concurrent_posts(app, body: dict, count: int) -> list:
+    results: list = [None] * count
+
+    def run(i: int) -> None:
+        with app.test_client() as client:
+            resp = _post_json(client, "/v1/chat/completions", body)
+            results[i] = (resp.status_code, resp.get_data())
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def _slow_upstream(payload: bytes, content_type: str = "application/json", delay: float = 0.2):
+    calls: list[int] = []
+
+    def callback(request):
+        calls.append(1)
+        time.sleep(delay)
+        return 200, {}, payload
+
+    rsps_lib.add_callback(rsps_lib.POST, f"{UPSTREAM}/chat/completions", callback=callback, content_type=content_type)
+    return calls
+
+
+@rsps_lib.activate
+def test_identical_deterministic_requests_share_one_upstream_call():
+    calls = _slow_upstream(b'{"choices": ["same"]}')
+    app = create_app(make_config(coalescing=CoalescingConfig(enabled=True)))
+    results = _concurrent_posts(app, {"model": "m", "messages": [], "temperature": 0}, 5)
+    assert len(calls) == 1
+    assert results == [(200, b'{"choices": ["same"]}')] * 5
+    assert _metric_value(app.test_client().get("/metrics").get_data(as_text=True), "relay_coalesced_requests_total") == 4
+
+
+@rsps_lib.activate
+def test_sampled_requests_are_not_coalesced():
+    calls = _slow_upstream(b'{"choices": []}', delay=0.05)
+    app = create_app(make_config(coalescing=CoalescingConfig(enabled=True)))
+    _concurrent_posts(app, {"model": "m", "messages": [], "temperature": 0.7}, 3)
+    assert len(calls) == 3
+
+
+@rsps_lib.activate
+def test_identical_streams_are_read_once_and_replayed():
+    payload = b"".join(b"data: %d\n\n" % i for i in range(20)) + b"data: [DONE]\n\n"
+    calls = _slow_upstream(payload, content_type="text/event-stream")
+    app = create_app(make_config(coalescing=CoalescingConfig(enabled=True)))
+    results = _concurrent_posts(app, {"model": "m", "messages": [], "temperature": 0, "stream": True}, 4)
+    assert len(calls) == 1
+    assert results == [(200, payload)] * 4
+
+
+def test_single_flight_shares_errors_with_followers():
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    errors: list[BaseException] = []
+
+    def leader_call():
+        started.set()
+        release.wait()
+        raise ConnectionError("upstream down")
+
+    def call(fn):
+        try:
+            flights.do("k", fn)
+        except ConnectionError as exc:
+            errors.append(exc)
+
+    leader = threading.Thread(target=call, args=(leader_call,))
+    leader.start()
+    started.wait()
+    follower = threading.Thread(target=call, args=(lambda: pytest.fail("follower must not run"),))
+    follower.start()
+    time.sleep(0.05)
+    release.set()
+    leader.join()
+    follower.join()
+    assert len(errors) == 2
+    assert flights.do("k", lambda: "fresh") == ("fresh", False)
+
+
+def test_coalescing_disabled_by_default(tmp_path):
+    _write_config(tmp_path / "config.yaml", UPSTREAM)
+    assert not parse_config(str(tmp_path / "config.yaml")).coalescing.enabled
+
+
+def test_stream_tee_replays_from_start_and_drops_chunks_once_full():
+    gate = threading.Event()
+    finished: list[bool] = []
+
+    def source():
+        yield b"a"
+        yield b"b"
+        gate.wait()
+        yield b"c"
+
+    tee = StreamTee(200, "text/event-stream", source(), lambda: finished.append(True), max_buffer_bytes=1)
+    early = tee.join()
+    tee.start()
+    assert next(early) == b"a"
+    _wait_for(lambda: not tee.joinable)
+    assert tee.join() is None  # closed to new clients
+    assert not tee.done
+    gate.set()
+    assert b"".join(early) == b"bc"
+    assert tee.buffered == 0  # nothing kept once every reader has passed it
+    assert finished == [True]
+
+
+def test_stream_tee_stops_reading_upstream_when_all_clients_leave():
+    read: list[int] = []
+    finished: list[bool] = []
+
+    def source():
+        for i in range(50):
+            read.append(i)
+            time.sleep(0.01)
+            yield b"data: %d\n\n" % i
+
+    tee = StreamTee(200, "text/event-stream", source(), lambda: finished.append(True), max_buffer_bytes=1 << 20)
+    chunks = tee.join()
+    tee.start()
+    next(chunks)
+    chunks.close()  # the client disconnects
+    _wait_for(lambda: finished == [True])
+    assert tee.abandoned and not tee.joinable
+    assert len(read) < 5
+
+
+# ===========================================================================
+# 21. Usage ledger
+# ===========================================================================
+
+
+def test_ledger_batches_writes_and_aggregates(tmp_path):
+    ledger = UsageLedger(str(tmp_path / "usage.db"), flush_interval=60, batch_size=3)
+    now = time.time()
+    ledger.record(now, "1.2.3.4", "gpt-a", "openai", 100)
+    ledger.record(now, "1.2.3.4", "gpt-b", "openai", 50)
+    assert ledger.window(now - 1) == []  # queued, not yet written
+    ledger.record(now, "client:team-a", "gpt-a", "openai", 10)  # fills the batch
+    _wait_for(lambda: len(ledger.window(now - 1)) == 3)
+
+    assert ledger.aggregate(now - 60, by="model") == [
+        {"model": "gpt-a", "requests": 2, "tokens": 110},
+        {"model": "gpt-b", "requests": 1, "tokens": 50},
+    ]
+    assert ledger.aggregate(now - 60, client="client:team-a") == [
+        {"client": "client:team-a", "requests": 1, "tokens": 10}
+    ]
+    with pytest.raises(ValueError):
+        ledger.aggregate(now - 60, by="tokens; DROP TABLE usage")
+    ledger.close()
+
+
+def test_ledger_prunes_rows_past_retention(tmp_path):
+    path = str(tmp_path / "usage.db")
+    ledger = UsageLedger(path)
+    ledger.record(time.time() - 40 * 86400, "ip", "m", "ep", 1)
+    ledger.record(time.time(), "ip", "m", "ep", 2)
+    ledger.close()
+    reopened = UsageLedger(path, retention_days=30)
+    assert [tokens for _, _, tokens in reopened.window(0)] == [2]
+    reopened.close()
+
+
+
+def _run_under_gevent(script: str, *args: str) -> str:
+    """Run *script* in a gevent monkey-patched interpreter that can import app and log_pipeline."""
+    pytest.importorskip("gevent")
+    import os
+    import subprocess
+    import sys
+
+    import app
+    import log_pipeline
+
+    path = os.pathsep.join([os.path.dirname(app.__file__), os.path.dirname(log_pipeline.__file__)])
+    result = subprocess.run(
+        [sys.executable, "-c", "from gevent import monkey; monkey.patch_all()\n" + script, *args],
+        capture_output=True,
+        text=True,
+        timeout=60,
+        env={**os.environ, "PYTHONPATH": path},
+    )
+    assert result.returncode == 0, result.stderr
+    return result.stdout.strip()
+
+
+_GEVENT_LEDGER_SCRIPT = """
+import sys
+from gevent import monkey
+from app import UsageLedger
+
+get_ident = monkey.get_original("_thread", "get_ident")
+writers = set()
+insert = UsageLedger._insert
+
+def recording_insert(self, batch):
+    writers.add(get_ident())
+    insert(self, batch)
+
+UsageLedger._insert = recording_insert
+ledger = UsageLedger(sys.argv[1])
+ledger.record(1.0, "ip", "m", "ep", 5)
+ledger.close()
+print(bool(writers) and get_ident() not in writers and ledger.window(0) == [("ip", 1.0, 5)])
+"""
+
+
+def test_ledger_writes_from_an_os_thread_under_gevent(tmp_path):
+    assert _run_under_gevent(_GEVENT_LEDGER_SCRIPT, str(tmp_path / "usage.db")) == "True"
+
+
+def test_daily_budget_survives_restart(tmp_path):
+    path = str(tmp_path / "usage.db")
+    limits = LimitsConfig(max_request_tokens=1000, max_daily_tokens_per_ip=1500, max_request_bytes=1024)
+    clock = [1_000_000.0]
+
+    ledger = UsageLedger(path)
+    tracker = TokenTracker(limits, now_fn=lambda: clock[0], ledger=ledger)
+    assert tracker.check_and_track("1.2.3.4", 1000, model="m") == (1000, True)
+    ledger.close()
+
+    clock[0] += 3600
+    ledger = UsageLedger(path, now_fn=lambda: clock[0])
+    restarted = TokenTracker(limits, now_fn=lambda: clock[0], ledger=ledger)
+    assert restarted.check_and_track("1.2.3.4", 1000) == (1000, False)
+    assert restarted.check_and_track("5.6.7.8", 1000) == (1000, True)
+    clock[0] += 86400  # the first charge has left the window
+    assert restarted.check_and_track("1.2.3.4", 1000) == (1000, True)
+    ledger.close()
+
+
+@rsps_lib.activate
+def test_usage_endpoint_scopes_callers_to_their_own_usage(tmp_path):
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"choices": []})
+    clients = [
+        ClientConfig(name="team-a", key_sha256=hash_api_key("key-a")),
+        ClientConfig(name="team-b", key_sha256=hash_api_key("key-b")),
+    ]
+    ledger_cfg = LedgerConfig(path=str(tmp_path / "u.db"), admin_key_sha256=hash_api_key("admin"))
+    config = make_config(relay_password="shared", clients=clients, ledger=ledger_cfg)
+    app = create_app(config)
+    client = app.test_client()
+    _post_json(client, "/v1/chat/completions", {"model": "m1", "max_tokens": 10}, _bearer("key-a"))
+    _post_json(client, "/v1/chat/completions", {"model": "m2", "max_tokens": 20}, _bearer("key-b"))
+    _post_json(client, "/v1/chat/completions", {"model": "m3", "max_tokens": 30}, _bearer("shared"))
+    app.extensions["mc_relay_ledger"].flush()
+
+    everyone = client.get("/usage?by=model", headers=_bearer("admin")).get_json()
+    assert everyone["data"] == [
+        {"model": "m3", "requests": 1, "tokens": 30},
+        {"model": "m2", "requests": 1, "tokens": 20},
+        {"model": "m1", "requests": 1, "tokens": 10},
+    ]
+    own = client.get("/usage", headers=_bearer("key-a")).get_json()
+    assert own["data"] == [{"client": "client:team-a", "requests": 1, "tokens": 10}]
+    # The shared password only shows the caller's own IP, not the other clients
+    shared = client.get("/usage?by=model", headers=_bearer("shared")).get_json()
+    assert shared["data"] == [{"model": "m3", "requests": 1, "tokens": 30}]
+    assert client.get("/usage?by=ts", headers=_bearer("admin")).status_code == 400
+    assert client.get("/usage").status_code == 401
+    app.extensions["mc_relay_ledger"].close()
+
+
+def test_usage_endpoint_not_served_on_open_relay(tmp_path):
+    app = create_app(make_config(ledger=LedgerConfig(path=str(tmp_path / "u.db"))))
+    assert app.test_client().get("/usage").status_code == 403
+    app.extensions["mc_relay_ledger"].close()
+
+
+# ===========================================================================
+# 22. Logging
+# ===========================================================================
+
+
+def _record(name: str = "t", level: int = logging.INFO, msg: str = "hello", **extra: Any) -> logging.LogRecord:
+    record = logging.LogRecord(name, level, __file__, 1, msg, None, None)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_json_formatter_promotes_extra_fields():
+    line = json.loads(JsonFormatter().format(_record(status=200, model="m")))
+    assert line["msg"] == "hello" and line["level"] == "INFO"
+    assert line["status"] == 200 and line["model"] == "m"
+
+
+def test_sampling_keeps_warnings_and_other_loggers():
+    sampler = SamplingFilter(["access"], 0.25, rng=lambda: 0.5)
+    assert not sampler.filter(_record("access"))
+    assert sampler.filter(_record("access", logging.WARNING))
+    assert sampler.filter(_record("app"))
+
+
+def test_full_log_queue_drops_and_reports():
+    handler = DroppingQueueHandler(queue.Queue(2))
+    for i in range(4):
+        handler.handle(_record(msg=f"line {i}"))
+    assert handler.dropped == 2
+    handler.queue.get_nowait()
+    handler.queue.get_nowait()
+    handler.handle(_record(msg="after"))
+    assert "dropped 2 records" in handler.queue.get_nowait().getMessage()
+    assert handler.queue.get_nowait().getMessage() == "after"
+
+
+
+def test_bounded_simple_queue_drops():
+    handler = DroppingQueueHandler(queue.SimpleQueue(), maxsize=1)
+    handler.handle(_record(msg="kept"))
+    handler.handle(_record(msg="dropped"))
+    assert handler.dropped == 1 and handler.queue.qsize() == 1
+
+
+_GEVENT_LOGGING_SCRIPT = """
+import io, logging
+from gevent import monkey
+from log_pipeline import configure_logging
+
+get_ident = monkey.get_original("_thread", "get_ident")
+writers = set()
+
+class Sink(io.StringIO):
+    def write(self, text):
+        writers.add(get_ident())
+        return super().write(text)
+
+pipeline = configure_logging("INFO", queue_size=10, stream=Sink())
+logging.getLogger("x").info("hello")
+pipeline.stop()
+print(bool(writers) and get_ident() not in writers)
+"""
+
+
+def test_queued_logging_writes_from_an_os_thread_under_gevent():
+    assert _run_under_gevent(_GEVENT_LOGGING_SCRIPT) == "True"
+
+
+@rsps_lib.activate
+def test_queued_json_access_log(capsys):
+    rsps_lib.add(rsps_lib.POST, f"{UPSTREAM}/chat/completions", json={"choices": []})
+    config = make_config(log_level="INFO", logging=LoggingConfig(format="json", queue_size=100))
+    app = create_app(config)
+    _post_json(app.test_client(), "/v1/chat/completions", {"model": "m"})
+    configure_logging("ERROR")  # replacing the pipeline drains its queue
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    access = [line for line in lines if line["logger"] == "app.access"]
+    assert len(access) == 1
+    assert access[0]["status"] == 200 and access[0]["model"] == "m" and "duration_ms" in access[0]
+
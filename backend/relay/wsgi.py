@@ -2,11 +2,14 @@
 WSGI entry point for Gunicorn.
 
 Loads config.yaml (or the path set in CONFIG_PATH) and creates the Flask app.
+The config is reloaded without a restart when the file changes (polled every
+CONFIG_RELOAD_INTERVAL seconds, 0 to disable) or when the worker gets SIGHUP.
 """
 
 import os
-from app import create_app, load_config
+from app import ConfigWatcher, create_app, load_config
 
 _config_path = os.environ.get("CONFIG_PATH", "config.yaml")
 _cfg = load_config(_config_path)
 application = create_app(_cfg)
+_watcher = ConfigWatcher(application, _config_path, float(os.environ.get("CONFIG_RELOAD_INTERVAL", "5"))).start()
@@ -5,6 +5,7 @@ from pymongo import MongoClient
 import uuid
 import logging
 import os
+import sys
 from datetime import datetime, timedelta
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
@@ -12,6 +13,13 @@ import redis
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+# log_pipeline.py lives in backend/common/ in a source checkout; the image copies it next to this file.
+_COMMON_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common")
+if os.path.isdir(_COMMON_DIR) and _COMMON_DIR not in sys.path:
+    sys.path.append(_COMMON_DIR)
+
+from log_pipeline import configure_logging  # noqa: E402
+
 app = Flask(__name__)
 
 # Check if we need SSL directly in the app
@@ -52,8 +60,14 @@ CORS(app, resources={
     }
 })
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
+# Set up logging. LOG_FORMAT=json writes one JSON object per line;
+# LOG_QUEUE_SIZE > 0 moves log writes off the request path (records are
+# dropped, and the drops logged, when the queue is full).
+log_pipeline = configure_logging(
+    os.getenv("LOG_LEVEL", "DEBUG"),
+    fmt=os.getenv("LOG_FORMAT", "text"),
+    queue_size=int(os.getenv("LOG_QUEUE_SIZE", "0")),
+)
 
 # When TESTING=true the app swaps real Mongo/Redis for in-memory mocks and
 # uses the limiter's memory backend. Lets unit tests import this module
@@ -111,13 +125,6 @@ if os.getenv("RATELIMIT_ENABLED", "true").lower() == "false":
     app.config["RATELIMIT_ENABLED"] = False
 limiter = Limiter(get_remote_address, app=app, storage_uri=LIMITER_STORAGE_URI)
 
-# Set up logging to print to a file
-logging.basicConfig(
-    filename="cleanup.log",
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
-
 # Constants
 MAX_FILE_LENGTH = 500000  # 500,000 bytes = 500 KB
 PROJECT_EXPIRY_DAYS = timedelta(
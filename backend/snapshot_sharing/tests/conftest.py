@@ -1,6 +1,6 @@
 """
-pytest configuration — adds the snapshot_sharing/ directory to sys.path so
-the `app` module can be imported, and provides a fresh Flask test client per
+pytest configuration — adds the snapshot_sharing/ and common/ directories to
+sys.path so the `app` module can be imported, and provides a fresh Flask test client per
 test with mongomock storage.
 """
 
@@ -12,6 +12,8 @@ import pytest
 # snapshot_sharing/tests/ -> snapshot_sharing/
 SERVICE_DIR = pathlib.Path(__file__).resolve().parents[1]
 sys.path.insert(0, str(SERVICE_DIR))
+# backend/common/ holds log_pipeline.py, shared with the relay
+sys.path.insert(0, str(SERVICE_DIR.parent / "common"))
 
 # Must be set before `import app` so the module-level setup picks it up.
 os.environ["TESTING"] = "true"
@@ -0,0 +1,77 @@
+"""
+Identifier classification micro-benchmark.
+
+Classifies a mix of CIDs, InChIKeys, InChIs, SMILES, names and junk with
+utils.classifyIdentifier and with the previous regexes, which were written as
+JavaScript literals ("/^...$/ig") and therefore never matched in Python, so
+every query was sent to PubChem's name search. Prints the namespace each
+approach picks and the cost per query.
+
+Usage (from the repository root):
+    python -m documentation_user.examples.mof_synthesis.bench_classify [--rounds 2000]
+"""
+
+import argparse
+import re
+import timeit
+from collections import Counter
+
+from documentation_user.examples.mof_synthesis.utils import Chem, classifyIdentifier
+
+OLD_RE_SMILES = re.compile(r"/^([^J][a-z0-9@+\-\[\]\(\)\\\/%=#$]{6,})$/ig")
+OLD_RE_INCHI = re.compile(r"/^((InChI=)?[^J][0-9BCOHNSOPrIFla+\-\(\)\\\/,pqbtmsih]{6,})$/ig")
+OLD_RE_INCHIKEY = re.compile(r"/^([0-9A-Z\-]+)$/")
+
+QUERIES = [
+    "24380",
+    "7489",
+    "RBTARNINKXHZNM-UHFFFAOYSA-K",
+    "KKEYFWRCBNTPAC-UHFFFAOYSA-N",
+    "InChI=1S/3ClH.Fe/h3*1H;/q;;;+3/p-3",
+    "InChI=1S/C8H6O4/c9-7(10)5-1-2-6(4-3-5)8(11)12/h1-4H,(H,9,10)(H,11,12)",
+    "Cl[Fe](Cl)Cl",
+    "C1=CC(=CC=C1C(=O)O)C(=O)O",
+    "CN(C)C=O",
+    "FeCl3",
+    "FeCl3.6H2O",
+    "Benzene-1,4-dicarboxylic acid",
+    "Zn(NO3)2",
+    "",
+    "   ",
+    "\x00\x01",
+]
+
+
+def oldClassify(query: str) -> str:
+    match query:
+        case query if query.isdigit():
+            return "cid"
+        case query if OLD_RE_SMILES.match(query):
+            return "smiles"
+        case query if OLD_RE_INCHI.match(query):
+            return "inchi"
+        case query if OLD_RE_INCHIKEY.match(query):
+            return "inchikey"
+        case _:
+            return "name"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"RDKit validation: {'on' if Chem is not None else 'off (rdkit not installed)'}\n")
+    print(f"{'query':<45} {'old':>9} {'new':>9}")
+    for query in QUERIES:
+        print(f"{query[:45]!r:<45} {oldClassify(query):>9} {str(classifyIdentifier(query)):>9}")
+
+    old = timeit.timeit(lambda: [oldClassify(q) for q in QUERIES], number=args.rounds)
+    new = timeit.timeit(lambda: [classifyIdentifier(q) for q in QUERIES], number=args.rounds)
+    count = args.rounds * len(QUERIES)
+    print(f"\nold: {old / count * 1e6:.2f} µs/query  {dict(Counter(map(oldClassify, QUERIES)))}")
+    print(f"new: {new / count * 1e6:.2f} µs/query  {dict(Counter(map(classifyIdentifier, QUERIES)))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,59 +1,349 @@
+import argparse
+import itertools
 import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
 
 from rdkit import Chem
 from rdkit.Chem import Draw
-from jsonschema import validate
 
-from documentation_user.examples.mof_synthesis.utils import collectMetadata
+from documentation_user.examples.mof_synthesis.utils import (
+    DAY,
+    CompoundCache,
+    collectMetadataConcurrently,
+    compileValidator,
+    fastjsonschema,
+    iterJsonArray,
+)
 
-# Load JSON document with synthesis data
-with open("ecmofsynthesis.json") as f:
-    data = json.load(f)
+INPUT_FILE = "ecmofsynthesis.json"
+SCHEMA_FILE = "ecmofsynthesis.schema.json"
+OUTPUT_FILE = "ecmofsynthesis_enriched.json"
+ENRICHED_SCHEMA_FILE = "ecmofsynthesis_enriched.schema.json"
+ARRAY_KEY = "ecmofsynthesis"
+CACHE_FILE = "pubchem_cache.sqlite"
 
-with open("ecmofsynthesis.schema.json") as f:
-    schema = json.load(f)
+# Maps each rendered PNG file to the SMILES it shows, so that unchanged images are not drawn again
+RENDERED_FILE = "rendered_molecules.json"
 
-# Validate the JSON document
-validate(data, schema)
-print("Data validated successfully")
+# Streaming mode appends enriched entries to this file, one JSON object per line.
+# It doubles as the checkpoint: --resume skips as many input entries as it has complete lines.
+PARTIAL_FILE = OUTPUT_FILE + ".partial.jsonl"
+# Size and modification time of the input the partial output was made from: --resume refuses to continue if they changed
+INPUT_STAMP_FILE = PARTIAL_FILE + ".input.json"
 
+# Validation errors printed before giving up; the remaining ones are only counted
+MAX_REPORTED_ERRORS = 50
 
-result_data = []
-# Iterate over the JSON document and enrich it with metadata
-for index, entry in enumerate(data[("ecmofsynthesis")]):
 
+def compoundRoles(entries) -> Iterator[tuple[str, str]]:
+    """
+    Yield ("metal_salt", name) and ("linker", name) for the compounds of synthesis entries
+    (entries without them are reported later by the validation)
+    """
+    for entry in entries:
+        for role in ("metal_salt", "linker"):
+            if isinstance(entry.get(f"{role}_name"), str):
+                yield role, entry[f"{role}_name"]
+
+
+def renderMolecule(smiles: str, path: str) -> bool:
+    """
+    Draw a molecule and save it as PNG (runs in a worker process)
+    :return: False if RDKit cannot parse the SMILES
+    """
+    mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        return False
+    Draw.MolToFile(mol, path)
+    return True
+
+
+def renderMolecules(images: dict[str, str], processes: int | None):
+    """
+    Draw the molecules of all compounds, each distinct SMILES only once.
+    Images that already exist for the same SMILES (according to RENDERED_FILE) are kept.
+    :param images: A dictionary from PNG file name to the SMILES to draw in it
+    :param processes: Number of worker processes (default: number of CPUs)
+    """
+    rendered = {}
+    if os.path.exists(RENDERED_FILE):
+        with open(RENDERED_FILE) as f:
+            rendered = json.load(f)
+
+    # Group the outdated images by SMILES: e.g. a compound used as metal salt and as linker is drawn once
+    pathsBySmiles: dict[str, list[str]] = {}
+    for path, smiles in images.items():
+        if rendered.get(path) != smiles or not os.path.exists(path):
+            pathsBySmiles.setdefault(smiles, []).append(path)
+    if not pathsBySmiles:
+        return
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        results = pool.map(renderMolecule, pathsBySmiles, [paths[0] for paths in pathsBySmiles.values()])
+        for (smiles, paths), ok in zip(pathsBySmiles.items(), results):
+            if not ok:
+                print("Error: Could not draw molecule with SMILES: " + smiles)
+                continue
+            for path in paths[1:]:
+                shutil.copyfile(paths[0], path)
+            rendered.update(dict.fromkeys(paths, smiles))
+
+    with open(RENDERED_FILE + ".tmp", "w") as f:
+        json.dump(rendered, f, indent=4)
+    os.replace(RENDERED_FILE + ".tmp", RENDERED_FILE)
+    print(f"Drew {len(pathsBySmiles)} molecules")
+
+
+def collectCompounds(
+    roles: set[tuple[str, str]], workers: int, cache: CompoundCache | None, processes: int | None
+) -> dict[str, dict]:
+    """
+    Query every distinct compound once and draw the molecules
+    :param roles: The distinct (role, name) pairs of the compounds, see compoundRoles
+    :return: Metadata of all compounds, by name
+    """
+    metadata = collectMetadataConcurrently((name for _, name in roles), workers, cache)
+    images = {
+        f"{role}_{name}.png": metadata[name]["smiles_code"]
+        for role, name in roles
+        if metadata[name].get("smiles_code")
+    }
+    renderMolecules(images, processes)
+    return metadata
+
+
+def enrichEntry(entry: dict, metadata: dict[str, dict]) -> dict:
+    """
+    Enrich one synthesis entry with PubChem metadata of its metal salt and linker
+    :param entry: The synthesis entry
+    :param metadata: Metadata of all compounds, by name (see collectMetadataConcurrently)
+    :return: The entry with the added metal_salt and linker objects
+    """
     metalSaltName = entry["metal_salt_name"]
     linkerName = entry["linker_name"]
 
-    # Collect metadata for both molecules
-    metalSaltMetadata = collectMetadata(metalSaltName)
-    linkerMetadata = collectMetadata(linkerName)
-
-    # draw both molecules and save to disk
-    if "smiles" in metalSaltMetadata:
-        mol1 = Chem.MolFromSmiles(metalSaltMetadata["smiles"])
-        Draw.MolToFile(mol1, f"metal_salt_{metalSaltName}.png")
-    if "smiles" in linkerMetadata:
-        mol2 = Chem.MolFromSmiles(linkerMetadata["smiles"])
-        Draw.MolToFile(mol2, f"linker_{linkerName}.png")
+    # Look up the metadata of both molecules
+    metalSaltMetadata = metadata[metalSaltName]
+    linkerMetadata = metadata[linkerName]
 
     # Append metadata to the entry
     result_entry = entry
     result_entry["metal_salt"] = metalSaltMetadata
     result_entry["linker"] = linkerMetadata
-    result_data.append(result_entry)
+    return result_entry
+
+
+def reportErrors(errors: list[str], what: str):
+    """
+    Print the validation errors of a document and exit if there are any
+    :param errors: All error messages, e.g. collected by a validator from compileValidator
+    :param what: Description of the validated document, for the messages
+    """
+    if not errors:
+        print(f"{what} validated successfully")
+        return
+    print(f"{what} is invalid ({len(errors)} errors):")
+    for error in errors[:MAX_REPORTED_ERRORS]:
+        print("  " + error)
+    if len(errors) > MAX_REPORTED_ERRORS:
+        print(f"  ... and {len(errors) - MAX_REPORTED_ERRORS} more")
+    raise SystemExit(1)
+
+
+def itemSchema(schemaFile: str) -> dict:
+    """
+    Load the schema of a single synthesis entry, keeping the shared $defs it refers to
+    :param schemaFile: Path of the schema of the whole document
+    """
+    with open(schemaFile) as f:
+        schema = json.load(f)
+    return {**schema["properties"][ARRAY_KEY]["items"], "$defs": schema.get("$defs", {})}
+
+
+def enrichInMemory(workers: int, cache: CompoundCache | None, processes: int | None, fast: bool):
+    """
+    Load the whole document, enrich all entries and write the result at once
+    :param workers: Maximum number of concurrent PubChem requests
+    :param cache: Persistent cache of PubChem results, if any
+    :param processes: Number of processes drawing molecules
+    :param fast: Validate with fastjsonschema if it is installed
+    """
+    # Load JSON document with synthesis data
+    with open(INPUT_FILE) as f:
+        data = json.load(f)
+
+    with open(SCHEMA_FILE) as f:
+        schema = json.load(f)
+
+    # Validate the JSON document, reporting all errors at once
+    reportErrors(compileValidator(schema, fast)(data), "Data")
+
+    # Query every distinct compound once, then enrich the entries from the results
+    metadata = collectCompounds(set(compoundRoles(data[ARRAY_KEY])), workers, cache, processes)
+    result_data = [enrichEntry(entry, metadata) for entry in data[ARRAY_KEY]]
+
+    # Save the result data
+    full_result = {ARRAY_KEY: result_data}
+    with open(OUTPUT_FILE, "w") as f:
+        json.dump(full_result, f, indent=4)
+
+    print(f"Enriched data saved to {OUTPUT_FILE}")
+
+    # Validate enriched data according to the schema for enriched files
+    with open(ENRICHED_SCHEMA_FILE) as f:
+        schema = json.load(f)
+
+    reportErrors(compileValidator(schema, fast)(full_result), "Enriched data")
+
+
+def completedEntries(partialFile: str) -> int:
+    """
+    Count the complete lines of a partial output file, dropping a line cut off by a crash
+    :param partialFile: Path of the partial JSON Lines output
+    :return: The number of entries that were already enriched
+    """
+    if not os.path.exists(partialFile):
+        return 0
+    count = 0
+    end = 0  # offset just after the last complete line
+    offset = 0
+    with open(partialFile, "rb") as f:
+        while chunk := f.read(1 << 16):
+            newlines = chunk.count(b"\n")
+            if newlines:
+                count += newlines
+                end = offset + chunk.rindex(b"\n") + 1
+            offset += len(chunk)
+    if end != offset:
+        with open(partialFile, "r+b") as f:
+            f.truncate(end)
+    return count
+
+
+def inputStamp(inputFile: str) -> dict:
+    """
+    :return: The size and modification time of a file, to tell whether it changed
+    """
+    stat = os.stat(inputFile)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def checkResumable(inputFile: str, stampFile: str):
+    """
+    Exit if the input changed since the partial output was started (or that is unknown),
+    because the partial output then no longer matches the input entries it would be continued with
+    """
+    stamp = None
+    if os.path.exists(stampFile):
+        with open(stampFile) as f:
+            stamp = json.load(f)
+    if stamp != inputStamp(inputFile):
+        print(f"Error: {inputFile} changed since the interrupted run (or it is unknown which input it used); "
+              f"run again without --resume to start over")
+        raise SystemExit(1)
+
+
+def writeDocument(partialFile: str, outputFile: str):
+    """
+    Turn the JSON Lines output into the final document, formatted like json.dump(..., indent=4)
+    """
+    tmpFile = outputFile + ".tmp"
+    with open(partialFile) as src, open(tmpFile, "w") as dst:
+        dst.write("{\n    " + json.dumps(ARRAY_KEY) + ": [")
+        for index, line in enumerate(src):
+            entry = json.dumps(json.loads(line), indent=4).replace("\n", "\n        ")
+            dst.write(("," if index else "") + "\n        " + entry)
+        dst.write("\n    ]\n}")
+    os.replace(tmpFile, outputFile)
+
+
+def enrichStreaming(resume: bool, workers: int, cache: CompoundCache | None, processes: int | None, fast: bool):
+    """
+    Enrich the document entry by entry, so memory use does not grow with the dataset
+    (only the metadata of the distinct compounds is kept).
+    Each entry is validated on its own against the item schema; all input errors are reported before PubChem is queried.
+    Enriched entries are appended to the partial output as soon as they are enriched.
+    :param resume: Continue from the partial output of an interrupted run instead of starting over
+    :param workers: Maximum number of concurrent PubChem requests
+    :param cache: Persistent cache of PubChem results, if any
+    :param processes: Number of processes drawing molecules
+    :param fast: Validate with fastjsonschema if it is installed
+    """
+    validateEntry = compileValidator(itemSchema(SCHEMA_FILE), fast)
+    validateEnrichedEntry = compileValidator(itemSchema(ENRICHED_SCHEMA_FILE), fast)
+
+    done = completedEntries(PARTIAL_FILE) if resume else 0
+    if done:
+        checkResumable(INPUT_FILE, INPUT_STAMP_FILE)
+        print(f"Resuming after {done} already enriched entries")
+    else:
+        resume = False  # nothing to continue: start over, with a new stamp
+        with open(INPUT_STAMP_FILE, "w") as f:
+            json.dump(inputStamp(INPUT_FILE), f)
+
+    # First pass: validate the remaining entries and collect their distinct compounds
+    roles = set()
+    errors = []
+    for index, entry in enumerate(itertools.islice(iterJsonArray(INPUT_FILE, ARRAY_KEY), done, None), done):
+        errors.extend(f"{ARRAY_KEY}/{index}/{error}" for error in validateEntry(entry))
+        roles.update(compoundRoles([entry]))
+    reportErrors(errors, "Data")
+
+    # Query every distinct compound once
+    metadata = collectCompounds(roles, workers, cache, processes)
 
-# Save the result data
-full_result = {"ecmofsynthesis": result_data}
-with open("ecmofsynthesis_enriched.json", "w") as f:
-    json.dump(full_result, f, indent=4)
+    errors = []
+    with open(PARTIAL_FILE, "a" if resume else "w") as out:
+        for index, entry in enumerate(itertools.islice(iterJsonArray(INPUT_FILE, ARRAY_KEY), done, None), done):
+            result_entry = enrichEntry(entry, metadata)
+            errors.extend(f"{ARRAY_KEY}/{index}/{error}" for error in validateEnrichedEntry(result_entry))
+            out.write(json.dumps(result_entry) + "\n")
+            out.flush()  # a crash loses at most the entry being enriched
 
-print("Enriched data saved to ecmofsynthesis_enriched.json")
+    writeDocument(PARTIAL_FILE, OUTPUT_FILE)
+    os.remove(PARTIAL_FILE)
+    os.remove(INPUT_STAMP_FILE)
+    print(f"Enriched data saved to {OUTPUT_FILE}")
+    reportErrors(errors, "Enriched data")
 
 
-# Validate enriched data according to the schema for enriched files
-with open("ecmofsynthesis_enriched.schema.json") as f:
-    schema = json.load(f)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Enrich the MOF synthesis data with metadata from PubChem.")
+    parser.add_argument(
+        "--stream", action="store_true", help="process the entries one at a time with constant memory use"
+    )
+    parser.add_argument(
+        "--resume", action="store_true", help="continue an interrupted --stream run (implies --stream)"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=5, help="maximum number of concurrent PubChem requests (default: 5)"
+    )
+    parser.add_argument(
+        "--cache", default=CACHE_FILE, help=f"SQLite file caching PubChem results (default: {CACHE_FILE}, '' to disable)"
+    )
+    parser.add_argument(
+        "--cache-days", type=float, default=30, help="days after which cached compounds are queried again (default: 30)"
+    )
+    parser.add_argument(
+        "--processes", type=int, default=None, help="number of processes drawing molecules (default: number of CPUs)"
+    )
+    parser.add_argument(
+        "--fast-validation", action="store_true", help="validate with fastjsonschema (only reports the first error of each entry)"
+    )
+    args = parser.parse_args()
+    if args.fast_validation and fastjsonschema is None:
+        print("fastjsonschema is not installed, validating with jsonschema")
 
-validate(full_result, schema)
-print("Enriched data validated successfully")
+    # Compounds PubChem did not find are retried after a day, in case of a transient error or a new PubChem entry
+    cache = CompoundCache(args.cache, ttl=args.cache_days * DAY) if args.cache else None
+    try:
+        if args.stream or args.resume:
+            enrichStreaming(args.resume, args.workers, cache, args.processes, args.fast_validation)
+        else:
+            enrichInMemory(args.workers, cache, args.processes, args.fast_validation)
+    finally:
+        if cache is not None:
+            cache.close()
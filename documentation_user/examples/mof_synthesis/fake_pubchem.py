@@ -0,0 +1,151 @@
+"""
+Local stand-in for the PubChem PUG-REST API, for trying out and testing enrich_data.py offline.
+
+Serves the two requests utils.py makes:
+    POST /rest/pug/compound/<namespace>/cids/JSON            (form field: <namespace>=<identifier>)
+    POST /rest/pug/compound/cid/property/<properties>/JSON   (form field: cid=<cid>,<cid>,...)
+Two compounds of the example dataset are known by name; any other name resolves to a generated
+compound, except names starting with "unknown", which are not found, and names starting with "error",
+whose lookup fails with HTTP 500. InChIs, InChIKeys and SMILES containing "invalid" (in any case) are
+rejected with HTTP 400, as PubChem rejects malformed identifiers.
+GET /stats returns the number of requests served per kind.
+
+Usage:
+    python fake_pubchem.py [--port 9200]
+    PUBCHEM_API_BASE=http://127.0.0.1:9200/rest/pug python enrich_data.py --cache ""
+"""
+
+import argparse
+import json
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+KNOWN_COMPOUNDS = {
+    "FeCl3": {
+        "CID": 24380,
+        "InChI": "InChI=1S/3ClH.Fe/h3*1H;/q;;;+3/p-3",
+        "IsomericSMILES": "Cl[Fe](Cl)Cl",
+        "IUPACName": "trichloroiron",
+        "MolecularWeight": "162.20",
+    },
+    "Benzene-1,4-dicarboxylic acid": {
+        "CID": 7489,
+        "InChI": "InChI=1S/C8H6O4/c9-7(10)5-1-2-6(4-3-5)8(11)12/h1-4H,(H,9,10)(H,11,12)",
+        "IsomericSMILES": "C1=CC(=CC=C1C(=O)O)C(=O)O",
+        "IUPACName": "terephthalic acid",
+        "MolecularWeight": "166.13",
+    },
+}
+
+
+class FakePubChem:
+    def __init__(self):
+        self.by_cid = {compound["CID"]: compound for compound in KNOWN_COMPOUNDS.values()}
+        self.requests = {"cids": 0, "property": 0}
+        self.lookups: list[tuple[str, str]] = []  # (namespace, identifier) of each CID lookup
+        self.lock = threading.Lock()
+
+    def resolve(self, identifier: str) -> int | None:
+        """
+        :return: The CID of the identifier, or None if it is not found
+        :raises LookupError: For identifiers starting with "error"
+        """
+        if identifier.startswith("error"):
+            raise LookupError(identifier)
+        if identifier in KNOWN_COMPOUNDS:
+            return KNOWN_COMPOUNDS[identifier]["CID"]
+        if identifier.startswith("unknown"):
+            return None
+        if identifier.isdigit():
+            cid = int(identifier)
+        else:
+            cid = 10_000_000 + zlib.crc32(identifier.encode()) % 10_000_000
+        with self.lock:
+            self.by_cid.setdefault(cid, {
+                "CID": cid,
+                "InChI": f"InChI=1S/fake{cid}",
+                "IsomericSMILES": "C" * (cid % 7 + 1),
+                "IUPACName": identifier,
+                "MolecularWeight": f"{cid % 500 + 10}.00",
+            })
+        return cid
+
+
+def _handler(pubchem: FakePubChem) -> type[BaseHTTPRequestHandler]:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True  # headers and body are separate writes
+
+        def log_message(self, format: str, *args: object) -> None:
+            pass
+
+        def _send_json(self, status: int, payload: dict) -> None:
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _not_found(self) -> None:
+            self._send_json(404, {"Fault": {"Code": "PUGREST.NotFound", "Message": "No CID found"}})
+
+        def do_GET(self) -> None:
+            if self.path == "/stats":
+                self._send_json(200, pubchem.requests)
+            else:
+                self._not_found()
+
+        def do_POST(self) -> None:
+            length = int(self.headers.get("Content-Length") or 0)
+            form = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+            parts = self.path.strip("/").split("/")
+            # rest/pug/compound/<namespace>/cids/JSON
+            if len(parts) == 6 and parts[2] == "compound" and parts[4] == "cids":
+                with pubchem.lock:
+                    pubchem.requests["cids"] += 1
+                    pubchem.lookups.append((parts[3], form.get(parts[3], "")))
+                if parts[3] != "name" and "invalid" in form.get(parts[3], "").lower():
+                    self._send_json(400, {"Fault": {"Code": "PUGREST.BadRequest", "Message": "Invalid input"}})
+                    return
+                try:
+                    cid = pubchem.resolve(form.get(parts[3], ""))
+                except LookupError:
+                    self._send_json(500, {"Fault": {"Code": "PUGREST.ServerError", "Message": "Lookup failed"}})
+                    return
+                if cid is None:
+                    self._not_found()
+                else:
+                    self._send_json(200, {"IdentifierList": {"CID": [cid]}})
+            # rest/pug/compound/cid/property/<properties>/JSON
+            elif len(parts) == 7 and parts[2:5] == ["compound", "cid", "property"]:
+                with pubchem.lock:
+                    pubchem.requests["property"] += 1
+                cids = [int(cid) for cid in form.get("cid", "").split(",") if cid.isdigit()]
+                rows = [pubchem.by_cid[cid] for cid in cids if cid in pubchem.by_cid]
+                if rows:
+                    self._send_json(200, {"PropertyTable": {"Properties": rows}})
+                else:
+                    self._not_found()
+            else:
+                self._not_found()
+
+    return Handler
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9200)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), _handler(FakePubChem()))
+    server.daemon_threads = True
+    print(f"fake PubChem on http://{args.host}:{args.port}/rest/pug")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""
+pytest configuration — adds the repository root to sys.path so that
+`from documentation_user.examples.mof_synthesis.utils import ...` works in tests,
+and provides a local fake PubChem server.
+"""
+
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+# mof_synthesis/tests/ -> repository root
+repo_root = os.path.abspath(os.path.join(os.path.dirname(__file__), *[os.pardir] * 4))
+if repo_root not in sys.path:
+    sys.path.insert(0, repo_root)
+
+from documentation_user.examples.mof_synthesis import utils  # noqa: E402
+from documentation_user.examples.mof_synthesis.fake_pubchem import FakePubChem, _handler  # noqa: E402
+
+
+@pytest.fixture
+def pubchem(monkeypatch):
+    """Serve a FakePubChem on a free port and point utils at it, without the PubChem rate limit."""
+    fake = FakePubChem()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _handler(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+    monkeypatch.setattr(utils, "PUBCHEM_API_BASE", f"http://127.0.0.1:{server.server_address[1]}/rest/pug")
+    monkeypatch.setattr(utils, "pubchem_rate_limiter", utils.TokenBucket(rate=10_000, capacity=10_000))
+    yield fake
+    server.shutdown()
+    server.server_close()
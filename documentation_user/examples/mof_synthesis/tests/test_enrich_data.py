@@ -0,0 +1,150 @@
+"""
+Tests for enrich_data.py, run against fake_pubchem.py in a temporary working directory.
+"""
+
+import itertools
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("rdkit")  # enrich_data draws the molecules with RDKit
+
+from documentation_user.examples.mof_synthesis import enrich_data  # noqa: E402
+
+EXAMPLE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def writeInput(path: str, count: int):
+    with open(os.path.join(EXAMPLE_DIR, enrich_data.INPUT_FILE)) as f:
+        examples = json.load(f)[enrich_data.ARRAY_KEY]
+    entries = [
+        {**example, "vial_no": f"S-{i}", "metal_salt_name": f"salt {i % 40}", "linker_name": f"linker {i % 25}"}
+        for i, example in zip(range(count), itertools.cycle(examples))
+    ]
+    with open(path, "w") as f:
+        json.dump({enrich_data.ARRAY_KEY: entries}, f, indent=4)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch, pubchem):
+    """Run in an empty directory holding the schemas and a 300-entry input, without drawing molecules."""
+    def chdir(name: str) -> str:
+        path = tmp_path / name
+        path.mkdir()
+        for schemaFile in (enrich_data.SCHEMA_FILE, enrich_data.ENRICHED_SCHEMA_FILE):
+            shutil.copy(os.path.join(EXAMPLE_DIR, schemaFile), path)
+        monkeypatch.chdir(path)
+        writeInput(enrich_data.INPUT_FILE, 300)
+        return str(path)
+
+    monkeypatch.setattr(enrich_data, "renderMolecules", lambda images, processes: None)
+    return chdir
+
+
+def enrichStreaming(resume: bool = False):
+    enrich_data.enrichStreaming(resume, workers=5, cache=None, processes=1, fast=False)
+
+
+def interruptAfter(monkeypatch, count: int):
+    """Make the next run crash after enriching `count` entries, leaving a cut-off line in the partial output."""
+    enrichEntry = enrich_data.enrichEntry
+    calls = itertools.count()
+
+    def crashing(entry, metadata):
+        if next(calls) == count:
+            raise KeyboardInterrupt
+        return enrichEntry(entry, metadata)
+
+    monkeypatch.setattr(enrich_data, "enrichEntry", crashing)
+    with pytest.raises(KeyboardInterrupt):
+        enrichStreaming()
+    monkeypatch.setattr(enrich_data, "enrichEntry", enrichEntry)
+    with open(enrich_data.PARTIAL_FILE, "a") as f:
+        f.write('{"vial_no": "S-')
+
+
+def readOutput() -> bytes:
+    with open(enrich_data.OUTPUT_FILE, "rb") as f:
+        return f.read()
+
+
+def test_streaming_output_matches_in_memory_output(workdir):
+    workdir("in-memory")
+    enrich_data.enrichInMemory(workers=5, cache=None, processes=1, fast=False)
+    inMemory = readOutput()
+
+    workdir("streaming")
+    enrichStreaming()
+    assert readOutput() == inMemory
+    assert not os.path.exists(enrich_data.PARTIAL_FILE)
+    assert not os.path.exists(enrich_data.INPUT_STAMP_FILE)
+
+
+def test_resumed_run_matches_full_run(workdir, monkeypatch):
+    workdir("full")
+    enrichStreaming()
+    full = readOutput()
+
+    workdir("resumed")
+    interruptAfter(monkeypatch, 120)
+    assert enrich_data.completedEntries(enrich_data.PARTIAL_FILE) == 120
+    enrichStreaming(resume=True)
+    assert readOutput() == full
+
+
+def test_resume_refuses_a_changed_input(workdir, monkeypatch):
+    workdir("changed")
+    interruptAfter(monkeypatch, 50)
+    writeInput(enrich_data.INPUT_FILE, 310)
+    with pytest.raises(SystemExit):
+        enrichStreaming(resume=True)
+    assert not os.path.exists(enrich_data.OUTPUT_FILE)
+
+
+def test_completed_entries_drops_a_cut_off_line(tmp_path):
+    partial = tmp_path / "partial.jsonl"
+    partial.write_bytes(b'{"a": 1}\n{"a": 2}\n{"a": ')
+    assert enrich_data.completedEntries(str(partial)) == 2
+    assert partial.read_bytes() == b'{"a": 1}\n{"a": 2}\n'
+    assert enrich_data.completedEntries(str(tmp_path / "missing.jsonl")) == 0
+
+
+def test_each_distinct_molecule_is_drawn_once(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(enrich_data, "ProcessPoolExecutor", ThreadPoolExecutor)  # so the stub's calls are seen
+    draws = []
+
+    def renderMolecule(smiles: str, path: str) -> bool:
+        draws.append(smiles)
+        if smiles == "invalid":
+            return False
+        with open(path, "w") as f:
+            f.write(smiles)
+        return True
+
+    def drawn(path: str) -> str:
+        with open(path) as f:
+            return f.read()
+
+    monkeypatch.setattr(enrich_data, "renderMolecule", renderMolecule)
+    images = {"metal_salt_A.png": "CCO", "linker_A.png": "CCO", "linker_B.png": "c1ccccc1", "linker_C.png": "invalid"}
+
+    enrich_data.renderMolecules(images, processes=2)
+    assert sorted(draws) == ["CCO", "c1ccccc1", "invalid"]
+    assert drawn("metal_salt_A.png") == drawn("linker_A.png") == "CCO"  # one drawing, copied
+    assert not os.path.exists("linker_C.png")
+
+    # Up-to-date images are kept; the one that could not be drawn is tried again
+    draws.clear()
+    enrich_data.renderMolecules(images, processes=2)
+    assert draws == ["invalid"]
+
+    # Images with a changed SMILES and deleted images are drawn again
+    draws.clear()
+    os.remove("linker_B.png")
+    enrich_data.renderMolecules({**images, "linker_A.png": "CCN"}, processes=2)
+    assert sorted(draws) == ["CCN", "c1ccccc1", "invalid"]
+    assert drawn("linker_A.png") == "CCN" and drawn("metal_salt_A.png") == "CCO"
@@ -0,0 +1,193 @@
+"""
+Tests for the PubChem lookups of the MOF synthesis example, run against fake_pubchem.py.
+"""
+
+import json
+import math
+import urllib.request
+
+import pytest
+
+from documentation_user.examples.mof_synthesis import utils
+from documentation_user.examples.mof_synthesis.bench_classify import QUERIES
+from documentation_user.examples.mof_synthesis.utils import (
+    PROPERTY_BATCH_SIZE,
+    Chem,
+    CompoundCache,
+    classifyIdentifier,
+    collectMetadataConcurrently,
+    compileValidator,
+    iterJsonArray,
+    queryCidFromPubChem,
+)
+
+# Namespace of each bench_classify query: (without RDKit, with RDKit)
+NAMESPACES = {
+    "24380": ("cid", "cid"),
+    "7489": ("cid", "cid"),
+    "RBTARNINKXHZNM-UHFFFAOYSA-K": ("inchikey", "inchikey"),
+    "KKEYFWRCBNTPAC-UHFFFAOYSA-N": ("inchikey", "inchikey"),
+    "InChI=1S/3ClH.Fe/h3*1H;/q;;;+3/p-3": ("inchi", "inchi"),
+    "InChI=1S/C8H6O4/c9-7(10)5-1-2-6(4-3-5)8(11)12/h1-4H,(H,9,10)(H,11,12)": ("inchi", "inchi"),
+    "Cl[Fe](Cl)Cl": ("smiles", "smiles"),
+    "C1=CC(=CC=C1C(=O)O)C(=O)O": ("smiles", "smiles"),
+    "CN(C)C=O": ("smiles", "smiles"),
+    "FeCl3": ("name", "name"),
+    "FeCl3.6H2O": ("name", "name"),
+    "Benzene-1,4-dicarboxylic acid": ("name", "name"),
+    "Zn(NO3)2": ("smiles", "name"),  # without RDKit, PubChem's 400 sends it on to the name search
+    "": (None, None),
+    "   ": (None, None),
+    "\x00\x01": (None, None),
+}
+
+
+def _stats() -> dict:
+    with urllib.request.urlopen(utils.PUBCHEM_API_BASE.removesuffix("/rest/pug") + "/stats") as response:
+        return json.load(response)
+
+
+def test_each_name_is_looked_up_once_and_properties_are_batched(pubchem, tmp_path):
+    names = [f"compound {i}" for i in range(2 * PROPERTY_BATCH_SIZE + 53)]
+    cache = CompoundCache(str(tmp_path / "cache.sqlite"))
+    result = collectMetadataConcurrently(names + names[:10], cache=cache)
+
+    assert len(result) == len(names) and all(metadata.get("cid") for metadata in result.values())
+    # 253 lookups, properties in 3 requests of at most 100 CIDs
+    expected = {"cids": len(names), "property": math.ceil(len(names) / PROPERTY_BATCH_SIZE)}
+    assert _stats() == expected
+
+    # A second run is served from the cache
+    assert collectMetadataConcurrently(names, cache=cache) == result
+    assert _stats() == expected
+    cache.close()
+
+
+def test_failed_lookups_are_reported_but_not_cached(pubchem, tmp_path):
+    cache = CompoundCache(str(tmp_path / "cache.sqlite"))
+    result = collectMetadataConcurrently(["FeCl3", "error-timeout", "unknown-x"], cache=cache)
+
+    assert result["FeCl3"]["cid"] == 24380
+    assert result["error-timeout"] == {}
+    assert result["unknown-x"] == {}
+    assert cache.get("FeCl3")["cid"] == 24380
+    assert cache.get("unknown-x") == {}  # not found: cached, and queried again after a day
+    assert cache.get("error-timeout") is None  # failed: queried again on the next run
+    cache.close()
+
+
+def test_identifiers_rejected_by_pubchem_are_not_found(pubchem):
+    # Without RDKit this InChI is sent to PubChem, which rejects it with HTTP 400
+    assert queryCidFromPubChem("InChI=1S/invalid") is None
+    assert queryCidFromPubChem("INVALIDAAAAAAA-UHFFFAOYSA-N") is None
+    assert queryCidFromPubChem("24380") == 24380
+    assert pubchem.requests["cids"] == (1 if Chem is not None else 2)
+
+
+def test_every_benchmark_query_has_an_expected_namespace():
+    assert list(NAMESPACES) == QUERIES
+
+
+@pytest.mark.parametrize("rdkit", [False, True], ids=["without-rdkit", "with-rdkit"])
+@pytest.mark.parametrize("query", QUERIES)
+def test_identifiers_are_looked_up_in_their_namespace(pubchem, monkeypatch, query, rdkit):
+    if not rdkit:
+        monkeypatch.setattr(utils, "Chem", None)
+    elif Chem is None:
+        pytest.skip("RDKit is not installed")
+    namespace = NAMESPACES[query][rdkit]
+
+    assert classifyIdentifier(query) == namespace
+    cid = queryCidFromPubChem(query)
+    if namespace is None:
+        assert cid is None
+    else:
+        assert cid is not None
+    # CIDs need no lookup; junk is rejected without a request
+    expected = [] if namespace in (None, "cid") else [(namespace, query)]
+    assert pubchem.lookups == expected
+
+
+ARRAY_DOCUMENT = {
+    "before": {"ecmofsynthesis": "not this one", "list": [1, 2]},
+    "ecmofsynthesis": [
+        1234567890,
+        -0.125e-3,
+        "a string with ] , [ and \\\" in it",
+        {"nested": [1, {"deeper": [True, False, None]}], "unicode": "Zn²⁺"},
+        [],
+        {},
+    ],
+    "after": 1,
+}
+
+
+@pytest.mark.parametrize("chunkSize", [1, 2, 3, 7, 1 << 16])
+def test_json_array_elements_are_read_across_chunk_boundaries(tmp_path, chunkSize):
+    # small chunks cut numbers (e.g. "1234567890" after "123"), strings and objects at every position
+    path = tmp_path / "data.json"
+    path.write_text(json.dumps(ARRAY_DOCUMENT, indent=4, ensure_ascii=False), encoding="utf-8")
+    assert list(iterJsonArray(str(path), "ecmofsynthesis", chunkSize)) == ARRAY_DOCUMENT["ecmofsynthesis"]
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        '{"other": []}',  # no such key
+        '{"other": {"ecmofsynthesis": []}}',  # not at the top level
+        '{"ecmofsynthesis": {}}',  # not an array
+        '{"ecmofsynthesis": [1, 2',  # truncated
+        '{"ecmofsynthesis": [1, 2}',  # invalid
+        '{"ecmofsynthesis": [1, , 2]}',
+    ],
+)
+def test_json_array_errors(tmp_path, text):
+    path = tmp_path / "data.json"
+    path.write_text(text)
+    with pytest.raises(ValueError):
+        list(iterJsonArray(str(path), "ecmofsynthesis", chunkSize=4))
+
+
+ENTRY_SCHEMA = {
+    "type": "object",
+    "required": ["vial_no", "linker_name"],
+    "properties": {"vial_no": {"type": "string"}, "mass": {"type": "integer"}, "unit": {"$ref": "#/$defs/unit"}},
+    "$defs": {"unit": {"enum": ["mg", "g"]}},
+}
+
+
+def test_validators_are_compiled_once_per_schema(monkeypatch):
+    compiled = []
+    validatorFor = utils.validator_for
+
+    def countingValidatorFor(schema):
+        compiled.append(schema)
+        return validatorFor(schema)
+
+    monkeypatch.setattr(utils, "validator_for", countingValidatorFor)
+    monkeypatch.setattr(utils, "_validators", {})
+    validate = compileValidator(ENTRY_SCHEMA)
+    # An equal schema, even with another key order, reuses the compiled validator
+    assert compileValidator(dict(reversed(list(ENTRY_SCHEMA.items())))) is validate
+    assert len(compiled) == 1
+    assert compileValidator({**ENTRY_SCHEMA, "required": ["vial_no"]}) is not validate
+    assert len(compiled) == 2
+
+
+def test_validator_reports_every_error():
+    errors = compileValidator(ENTRY_SCHEMA)({"vial_no": 1, "mass": "16", "unit": "kg"})
+    assert sorted(errors) == [
+        "(root): 'linker_name' is a required property",
+        "mass: '16' is not of type 'integer'",
+        "unit: 'kg' is not one of ['mg', 'g']",
+        "vial_no: 1 is not of type 'string'",
+    ]
+    assert compileValidator(ENTRY_SCHEMA)({"vial_no": "S-1", "linker_name": "x", "mass": 16, "unit": "mg"}) == []
+
+
+def test_fast_validator_reports_the_first_error():
+    pytest.importorskip("fastjsonschema")
+    validate = compileValidator(ENTRY_SCHEMA, fast=True)
+    assert validate is not compileValidator(ENTRY_SCHEMA)
+    assert len(validate({"vial_no": 1, "mass": "16", "unit": "kg"})) == 1
+    assert validate({"vial_no": "S-1", "linker_name": "x"}) == []
@@ -1,69 +1,457 @@
+import hashlib
+import json
+import os
 import re
-import pubchempy as pcp
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Iterable, Iterator
+
+from jsonschema.validators import validator_for
+
+try:  # optional: validates SMILES and InChI candidates locally before they are sent to PubChem
+    from rdkit import Chem, RDLogger
+
+    RDLogger.DisableLog("rdApp.*")  # invalid candidates are expected, don't print parser errors
+except ImportError:
+    Chem = None
+
+try:  # optional: faster validation backend, which reports only the first error of each instance
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
 
 # Partially copied and adapted from https://github.com/FAIRChemistry/substance-query/blob/main/substancewidget
 # /substancewidget.py
 
-# Regular expressions to differentiate between smiles code, inchi, and inchikey
-RE_SMILES = re.compile(r"/^([^J][a-z0-9@+\-\[\]\(\)\\\/%=#$]{6,})$/ig")
-RE_INCHI = re.compile(
-    r"/^((InChI=)?[^J][0-9BCOHNSOPrIFla+\-\(\)\\\/,pqbtmsih]{6,})$/ig"
-)
-RE_INCHIKEY = re.compile(r"/^([0-9A-Z\-]+)$/")
+# Regular expressions to differentiate between cid, smiles code, inchi, and inchikey
+RE_CID = re.compile(r"[1-9][0-9]{0,9}")
+RE_INCHIKEY = re.compile(r"[A-Z]{14}-[A-Z]{8}[SN][A-Z]-[A-Z]")
+RE_INCHI = re.compile(r"InChI=1S?/\S+")
+# SMILES characters only, with at least one bond, branch, bracket atom or stereo mark:
+# plain formulas such as "FeCl3" or "CCO" are left to the name search
+RE_SMILES = re.compile(r"(?=.*[=#()\[\]@/\\])[A-Za-z0-9@+\-\[\]()\\/%=#$.:*]+")
+# Anything printable with at least one letter or digit
+RE_NAME = re.compile(r"(?=.*[A-Za-z0-9])[^\x00-\x1f\x7f]+")
+MAX_QUERY_LENGTH = 1000
+
+# Set PUBCHEM_API_BASE to run against a local stand-in, e.g. fake_pubchem.py
+PUBCHEM_API_BASE = os.environ.get("PUBCHEM_API_BASE", "https://pubchem.ncbi.nlm.nih.gov/rest/pug").rstrip("/")
+PUBCHEM_PROPERTIES = ("InChI", "IsomericSMILES", "IUPACName", "MolecularWeight")
+# Compounds per property request; PUG-REST accepts long CID lists, but keeps each response fast at this size
+PROPERTY_BATCH_SIZE = 100
+PUBCHEM_RETRIES = 3
 
-# This data structure will store the PubChem compounds that have been queried, so that we don't have to query them again
-cached_compounds = {}
+# PubChem's usage policy allows at most 5 requests per second per user
+PUBCHEM_REQUESTS_PER_SECOND = 5
 
 
-def queryCompoundFromPubChem(query: str) -> pcp.Compound | None:
+class TokenBucket:
     """
-    Query a compound using the PubChemPy library. The query can be a CID, SMILES, InChI, or InChIKey.
-    :param query: The query string
+    Thread-safe rate limiter: acquire() blocks so that on average at most `rate` calls pass per second,
+    with bursts of up to `capacity` calls.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# Shared by all threads, so concurrent lookups together stay within the PubChem limit
+pubchem_rate_limiter = TokenBucket(PUBCHEM_REQUESTS_PER_SECOND)
+
+DAY = 24 * 60 * 60
+
+
+class CompoundCache:
+    """
+    Persistent cache of compound metadata in a SQLite file, so that repeated runs only query PubChem for new compounds.
+    Only the extracted metadata is stored; an empty dictionary records that PubChem did not find the compound.
+    Found compounds are queried again after `ttl` seconds, not found ones after `negativeTtl` seconds.
+    Beyond `maxEntries` entries, the entries stored longest ago are removed.
+    """
+
+    EVICTION_INTERVAL = 100  # stores between size checks
+
+    def __init__(self, path: str, ttl: float = 30 * DAY, negativeTtl: float = DAY, maxEntries: int = 100_000):
+        self.ttl = ttl
+        self.negativeTtl = negativeTtl
+        self.maxEntries = maxEntries
+        self._storesSinceEviction = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS compounds (query TEXT PRIMARY KEY, metadata TEXT NOT NULL, stored REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS compounds_stored ON compounds (stored)")
+
+    def get(self, query: str) -> dict | None:
+        """
+        :return: The cached metadata (empty if PubChem did not find the compound), or None if missing or expired
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT metadata, stored FROM compounds WHERE query = ?", (query,)).fetchone()
+        if row is None:
+            return None
+        metadata = json.loads(row[0])
+        ttl = self.ttl if metadata else self.negativeTtl
+        return metadata if time.time() - row[1] < ttl else None
+
+    def put(self, query: str, metadata: dict):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO compounds VALUES (?, ?, ?)", (query, json.dumps(metadata), time.time())
+            )
+            self._storesSinceEviction += 1
+            if self._storesSinceEviction >= self.EVICTION_INTERVAL:
+                self._storesSinceEviction = 0
+                self._conn.execute(
+                    "DELETE FROM compounds WHERE query IN "
+                    "(SELECT query FROM compounds ORDER BY stored DESC LIMIT -1 OFFSET ?)",
+                    (self.maxEntries,),
+                )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def pugRest(path: str, form: dict[str, str]) -> dict | None:
     """
-    if query in cached_compounds:
-        return cached_compounds[query]
+    POST a request to the PubChem PUG-REST API, within the shared request rate
+    :param path: The request path below the API base, e.g. "compound/name/cids/JSON"
+    :param form: The form fields carrying the identifiers
+    :return: The decoded JSON response, or None if PubChem found nothing
+    """
+    data = urllib.parse.urlencode(form).encode()
+    for attempt in range(PUBCHEM_RETRIES + 1):
+        pubchem_rate_limiter.acquire()
+        try:
+            with urllib.request.urlopen(f"{PUBCHEM_API_BASE}/{path}", data, timeout=30) as response:
+                return json.load(response)
+        except urllib.error.HTTPError as e:
+            if e.code == 404:  # PUGREST.NotFound
+                return None
+            # 503 means PubChem is busy (or throttling us): back off and try again
+            if e.code != 503 or attempt == PUBCHEM_RETRIES:
+                raise
+        time.sleep(2**attempt)
+
 
+def classifyIdentifier(query: str) -> str | None:
+    """
+    Determine the PubChem namespace of a query: "cid", "inchikey", "inchi", "smiles" or "name".
+    SMILES and InChI candidates are checked with RDKit if it is installed; SMILES that RDKit rejects
+    are searched as names (e.g. "Fe(NO3)3"), InChIs it rejects are invalid.
+    :param query: The query string
+    :return: The namespace, or None if the query cannot identify a compound
+    """
+    if not query or len(query) > MAX_QUERY_LENGTH:
+        return None
     match query:
-        case query if query.isdigit():
-            compound_options = [(pcp.Compound.from_cid(query))]
-        case query if RE_SMILES.match(query):
-            compound_options = pcp.get_compounds(query, "smiles")
-        case query if RE_INCHI.match(query):
-            compound_options = pcp.get_compounds(query, "inchi")
-        case query if RE_INCHIKEY.match(query):
-            compound_options = pcp.get_compounds(query, "inchikey")
+        case query if RE_CID.fullmatch(query):
+            return "cid"
+        case query if RE_INCHIKEY.fullmatch(query):
+            return "inchikey"
+        case query if RE_INCHI.fullmatch(query):
+            if Chem is not None and Chem.MolFromInchi(query) is None:
+                return None
+            return "inchi"
+        case query if RE_SMILES.fullmatch(query) and (Chem is None or Chem.MolFromSmiles(query) is not None):
+            return "smiles"
+        case query if RE_NAME.fullmatch(query.strip()):
+            return "name"
         case _:
-            compound_options = pcp.get_compounds(query, "name")
+            return None
+
+
+def queryCidFromPubChem(query: str) -> int | None:
+    """
+    Resolve a query to a PubChem compound ID. The query can be a CID, SMILES, InChI, InChIKey or name.
+    Queries that cannot identify a compound are rejected without a request.
+    :param query: The query string
+    """
+    namespace = classifyIdentifier(query)
+    if namespace is None:
+        return None
+    if namespace == "cid":
+        return int(query)
+    if namespace == "name":
+        query = query.strip()
+
+    try:
+        result = pugRest(f"compound/{namespace}/cids/JSON", {namespace: query})
+    except urllib.error.HTTPError as e:
+        if e.code != 400:
+            raise
+        # Without RDKit, well-formed but invalid InChIs reach PubChem, which rejects them: no such compound
+        if namespace in ("inchi", "inchikey"):
+            return None
+        # Likewise, formulas like "Zn(NO3)2" pass as SMILES candidates; PubChem rejects them as bad SMILES
+        if namespace != "smiles":
+            raise
+        result = pugRest("compound/name/cids/JSON", {"name": query})
+    # for now by default select first option (CID 0 means "no compound")
+    cids = [cid for cid in (result or {}).get("IdentifierList", {}).get("CID", []) if cid]
+    return cids[0] if cids else None
+
+
+def queryPropertiesFromPubChem(cids: Iterable[int]) -> dict[int, dict]:
+    """
+    Fetch the metadata of many compounds, with one PUG-REST property request per PROPERTY_BATCH_SIZE compounds
+    :param cids: PubChem compound IDs
+    :return: A dictionary from CID to metadata, for the CIDs PubChem knows
+    """
+    cids = list(dict.fromkeys(cids))
+    metadata = {}
+    for start in range(0, len(cids), PROPERTY_BATCH_SIZE):
+        batch = cids[start:start + PROPERTY_BATCH_SIZE]
+        result = pugRest(
+            f"compound/cid/property/{','.join(PUBCHEM_PROPERTIES)}/JSON", {"cid": ",".join(map(str, batch))}
+        )
+        for row in (result or {}).get("PropertyTable", {}).get("Properties", []):
+            metadata[row["CID"]] = {
+                "cid": row["CID"],
+                "inchi_code": row.get("InChI"),
+                # newer PubChem versions return the isomeric SMILES as "SMILES"
+                "smiles_code": row.get("IsomericSMILES", row.get("SMILES")),
+                "iupac_name": row.get("IUPACName"),
+                "molecular_weight": float(row["MolecularWeight"]),
+            }
+    return metadata
 
-    # for now by default select first option
-    if len(compound_options) > 0:
-        compound = compound_options[0]
-        cached_compounds[query] = compound
-        return compound
 
-    # Cache the compound
-    cached_compounds[query] = None
-    return None
+def queryCompoundFromPubChem(query: str) -> dict | None:
+    """
+    Query the metadata of a single compound. The query can be a CID, SMILES, InChI, InChIKey or name.
+    To query many compounds, use collectMetadataConcurrently, which batches the property requests.
+    :param query: The query string
+    :return: A dictionary with metadata, or None if PubChem does not know the compound
+    """
+    cid = queryCidFromPubChem(query)
+    if cid is None:
+        return None
+    return queryPropertiesFromPubChem([cid]).get(cid)
 
 
-def collectMetadata(compoundName: str):
+def collectMetadata(compoundName: str, cache: CompoundCache | None = None):
     """
     Collect metadata for a compound from PubChem
     :param compoundName: The name of the compound
+    :param cache: Cache to look the compound up in first, and to store the result in
     :return: A dictionary with metadata
     """
-    compound = queryCompoundFromPubChem(compoundName)
-    if compound is None:
-        print("Error: Could not find molecule in PubChem: " + compoundName)
-        return {}
-
-    # Append metadata
-    compoundMetadata = {
-        "cid": compound.cid,
-        "inchi_code": compound.inchi,
-        "smiles_code": compound.isomeric_smiles,
-        "iupac_name": compound.iupac_name,
-        "molecular_weight": float(compound.molecular_weight),
-    }
-
-    return compoundMetadata
+    return collectMetadataConcurrently([compoundName], maxWorkers=1, cache=cache)[compoundName]
+
+
+def collectMetadataConcurrently(
+    compoundNames: Iterable[str], maxWorkers: int = 5, cache: CompoundCache | None = None
+) -> dict[str, dict]:
+    """
+    Collect metadata for many compounds, querying each distinct name once.
+    Names are resolved to CIDs in a thread pool (the shared rate limiter keeps the requests within PubChem's
+    request rate); as the CIDs come in, their properties are fetched in batches of PROPERTY_BATCH_SIZE.
+    Each result is cached as soon as it is known, so an interrupted run keeps what it resolved.
+    Compounds whose lookup fails (network errors, PubChem errors) are reported and left out of the cache,
+    so that the next run queries them again.
+    :param compoundNames: Compound names, possibly with repetitions
+    :param maxWorkers: Maximum number of concurrent PubChem requests
+    :param cache: Optional persistent cache, see CompoundCache
+    :return: A dictionary from compound name to its metadata (empty if not found or failed)
+    """
+    uniqueNames = list(dict.fromkeys(compoundNames))
+    result = {}
+    if cache is not None:
+        for name in uniqueNames:
+            cached = cache.get(name)
+            if cached is not None:
+                result[name] = cached
+    missing = [name for name in uniqueNames if name not in result]
+
+    def failed(names: Iterable[str], error: Exception):
+        for name in names:
+            print(f"Error: Could not query PubChem for {name} ({error}); it is queried again on the next run")
+            result[name] = {}
+
+    def store(name: str, compoundMetadata: dict):
+        if not compoundMetadata:
+            print("Error: Could not find molecule in PubChem: " + name)
+        if cache is not None:
+            cache.put(name, compoundMetadata)
+        result[name] = compoundMetadata
+
+    def fetchProperties(batch: dict[str, int]):
+        try:
+            properties = queryPropertiesFromPubChem(batch.values())
+        except (OSError, ValueError) as e:  # URLError, HTTPError, timeouts, malformed responses
+            failed(batch, e)
+            return
+        for name, cid in batch.items():
+            store(name, properties.get(cid, {}))
+
+    pending: dict[str, int] = {}  # resolved names waiting for their property batch
+    with ThreadPoolExecutor(max_workers=maxWorkers) as pool:
+        futures = {pool.submit(queryCidFromPubChem, name): name for name in missing}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                cid = future.result()
+            except (OSError, ValueError) as e:
+                failed([name], e)
+                continue
+            if cid is None:
+                store(name, {})
+                continue
+            pending[name] = cid
+            if len(pending) == PROPERTY_BATCH_SIZE:
+                fetchProperties(pending)
+                pending = {}
+    if pending:
+        fetchProperties(pending)
+    return {name: result[name] for name in uniqueNames}
+
+
+# Characters that can continue a JSON number
+NUMBER_CHARS = frozenset("0123456789.eE+-")
+
+
+def iterJsonArray(path: str, key: str, chunkSize: int = 1 << 16) -> Iterator:
+    """
+    Yield the elements of the array stored under a top-level key of a JSON file, one at a time.
+    Only one element (plus one read chunk) is held in memory, regardless of the file size;
+    the values of other top-level keys before the array are decoded one at a time and skipped.
+    :param path: Path of the JSON file, e.g. {"ecmofsynthesis": [...]}
+    :param key: The top-level key holding the array
+    :param chunkSize: Number of characters read from the file at once
+    """
+    decoder = json.JSONDecoder()
+    token = json.dumps(key)
+    with open(path, encoding="utf-8") as f:
+        buffer = ""
+        eof = False
+
+        def invalid() -> ValueError:
+            return ValueError(f"Invalid JSON in {path}, or no array under key {token}")
+
+        def peek() -> str:
+            """The next non-whitespace character, reading more as needed"""
+            nonlocal buffer, eof
+            while True:
+                buffer = buffer.lstrip(" \t\r\n")
+                if buffer:
+                    return buffer[0]
+                if eof:
+                    raise invalid()
+                chunk = f.read(chunkSize)
+                eof = not chunk
+                buffer += chunk
+
+        def expect(chars: str) -> str:
+            """Consume the next non-whitespace character, which must be one of `chars`"""
+            nonlocal buffer
+            char = peek()
+            if char not in chars:
+                raise invalid()
+            buffer = buffer[1:]
+            return char
+
+        def nextValue():
+            """Decode the next value, reading until it is complete"""
+            nonlocal buffer, eof
+            peek()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer)
+                except json.JSONDecodeError:
+                    end = None
+                # A value that ends at the buffer end, or before a character that can continue a number,
+                # may be cut off (e.g. "-0" of "-0.125")
+                if end is not None and (eof or (end < len(buffer) and buffer[end] not in NUMBER_CHARS)):
+                    buffer = buffer[end:]
+                    return value
+                if eof:
+                    raise invalid()
+                chunk = f.read(chunkSize)
+                eof = not chunk
+                buffer += chunk
+
+        # Walk the top-level object up to the key, skipping the values of other keys
+        expect("{")
+        if peek() == "}":
+            raise invalid()
+        while nextValue() != key:
+            expect(":")
+            nextValue()
+            if expect(",}") == "}":
+                raise invalid()
+        expect(":")
+        expect("[")
+
+        if peek() == "]":
+            return
+        while True:
+            yield nextValue()
+            if expect(",]") == "]":
+                return
+
+
+# Compiled validators by schema hash and backend, so each schema is checked and compiled only once
+_validators: dict[tuple[str, bool], Callable[[object], list[str]]] = {}
+
+
+def compileValidator(schema: dict, fast: bool = False) -> Callable[[object], list[str]]:
+    """
+    Get a function that validates an instance against a schema and returns all error messages (empty if valid).
+    The schema itself is checked once, when it is first compiled; later calls with an equal schema reuse the result.
+    :param schema: The JSON schema
+    :param fast: Use fastjsonschema if it is installed; it only reports the first error of each instance
+    """
+    fast = fast and fastjsonschema is not None
+    key = (hashlib.sha256(json.dumps(schema, sort_keys=True).encode()).hexdigest(), fast)
+    if key in _validators:
+        return _validators[key]
+
+    if fast:
+        validateFast = fastjsonschema.compile(schema)
+
+        def errors(instance: object) -> list[str]:
+            try:
+                validateFast(instance)
+            except fastjsonschema.JsonSchemaValueException as e:
+                # e.name is like "data.linker_name" or "data[0].vial_no"; drop the "data" prefix
+                return [f"{e.name.removeprefix('data').lstrip('.') or '(root)'}: {e.message}"]
+            return []
+
+    else:
+        cls = validator_for(schema)
+        cls.check_schema(schema)
+        validator = cls(schema)
+
+        def errors(instance: object) -> list[str]:
+            return [
+                f"{'/'.join(map(str, error.absolute_path)) or '(root)'}: {error.message}"
+                for error in validator.iter_errors(instance)
+            ]
+
+    _validators[key] = errors
+    return errors